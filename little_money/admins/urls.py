@@ -3,6 +3,8 @@ from .views import (
     admin_dashboard,
     payouts_overview,
     assignments_api,
+    aggregator_health,
+    webhook_backlog,
     approve_payout,
     assignclient,
     risk_alerts,
@@ -29,6 +31,8 @@ urlpatterns = [
     path('assign-client/', assignclient, name='assignclient'),
     path('assignments/unassign/<int:assignment_id>/', unassign_client, name='unassign_client'),
     path('api/assignments/', assignments_api, name='assignments_api'),
+    path('api/aggregator-health/', aggregator_health, name='aggregator_health'),
+    path('api/webhook-backlog/', webhook_backlog, name='webhook_backlog'),
     path('risk-alerts/', risk_alerts, name='risk_alerts'),
     path('profile-admin/', profile_admin, name='profile_admin'),
     path('staff-user/', staff_user, name='staff_user'),
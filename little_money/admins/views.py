@@ -3,19 +3,25 @@ from django.contrib.admin.models import LogEntry
 from decimal import Decimal
 from clients.models import Client, RecentTransaction
 from config.aggregator import GetBalance
+from config.balance_cache import balance_cache
+from config.finalized_orders import finalized_orders
+from config.resilience import get_guards
 from core.mailcow import sync_mailcow_mailbox
+from webhooks.inbox import backlog
 from webhooks.models import PaymentNotification
 from .models import AdminCommissionHistory, AuthLog
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.shortcuts import render, redirect, get_object_or_404
 from .models import AuthLog
 from core.models import CustomUser
+from finance.ledger import PAYOUTS, InsufficientFunds, Journal, staff_account
 from finance.models import Payout, PlatformSettings, StaffCommissionAggregate, MonthlyEarnings, SystemEarnings
 from django.db.models.functions import TruncDate
 from django.contrib.admin.models import LogEntry, CHANGE, ADDITION, DELETION
+from django.db import transaction
 from django.db.models import Sum
 from finance.models import PlatformSettings, PlatformFeeHistory
-from staff.models import Balance, ClientAssignment, Staff, StaffCommissionHistory, WithdrawHistory
+from staff.models import ClientAssignment, Staff, StaffCommissionHistory, WithdrawHistory
 import json
 from django.contrib import messages
 from core.utils import is_admin
@@ -28,14 +34,19 @@ from django.core.paginator import Paginator
 @login_required
 @user_passes_test(is_admin)
 def admin_dashboard(request):
-    # Prepare the 10 most recent earnings for chart data
-    recent_earnings = SystemEarnings.objects.order_by('-last_updated')[:10][::-1]
+    # SystemEarnings rows are shards of the running month's total, so the chart's history
+    # comes from the monthly snapshots: the 9 most recent, then the running total (cached).
+    earnings = SystemEarnings.load(cached=True)
+    monthly = MonthlyEarnings.objects.order_by('-snapshot_date')[:9][::-1]
 
-    chart_labels = [e.last_updated.strftime("%Y-%m-%d") for e in recent_earnings]
-    chart_data = [float(e.total_earnings or 0.0) for e in recent_earnings]
+    chart_labels = [m.snapshot_date.strftime("%Y-%m-%d") for m in monthly]
+    chart_data = [float(m.total_earnings or 0.0) for m in monthly]
+    if earnings.last_updated:
+        chart_labels.append(earnings.last_updated.strftime("%Y-%m-%d"))
+        chart_data.append(float(earnings.total_earnings or 0.0))
 
     return render(request, 'dashboard/admin.html', {
-        'earnings': recent_earnings,
+        'earnings': earnings,
         'chart_labels': json.dumps(chart_labels),
         'chart_data': json.dumps(chart_data),
     })
@@ -50,7 +61,7 @@ def finance_dashboard(request):
     platform_earnings = latest_monthly_earnings.total_volume if latest_monthly_earnings else 0.00
 
     # System earnings
-    system_earnings = SystemEarnings.load()
+    system_earnings = SystemEarnings.load(cached=True)
     staff_commissions = StaffCommissionAggregate.load().total_commission
     net_platform_balance = system_earnings.net_platform_earnings
     total_balance = system_earnings.total_earnings
@@ -58,6 +69,9 @@ def finance_dashboard(request):
     # Admin personal balance (assuming profile)
     admin_balance = request.user.profile.balance if hasattr(request.user, 'profile') else 0.00
 
+    # Merchant balance at the aggregator, served from the background-refreshed cache
+    aggregator_balance = balance_cache.get()
+
     context = {
         'monthly_earnings': monthly_earnings,
         'platform_earnings': platform_earnings,
@@ -65,6 +79,8 @@ def finance_dashboard(request):
         'net_platform_balance': net_platform_balance,
         'staff_commissions': staff_commissions,
         'admin_balance': admin_balance,
+        'aggregator_balance': aggregator_balance.balance,
+        'aggregator_balance_age': int(aggregator_balance.age),
     }
     return render(request, 'dashboard/finance.html', context)
 
@@ -222,13 +238,16 @@ def payouts_overview(request):
 @require_POST
 def approve_payout(request, payout_id):
     payout = get_object_or_404(WithdrawHistory, id=payout_id, status='Pending')
-    balance = Balance.objects.filter(staff=payout.staff).first()
 
-    if balance and balance.balance >= payout.amount:
-        payout.status = 'Approved'
-        payout.save()
-        balance.balance -= payout.amount
-        balance.save()
+    # Approve and debit together, only once, and only if the balance covers it; otherwise it stays pending.
+    journal = Journal()
+    journal.add(f"payout:{payout.id}", [(staff_account(payout.staff_id), -payout.amount)], counter_account=PAYOUTS)
+    try:
+        with transaction.atomic():
+            if WithdrawHistory.objects.filter(id=payout.id, status='Pending').update(status='Approved'):
+                journal.write()
+    except InsufficientFunds:
+        pass
     return redirect('payouts')
 
 
@@ -298,6 +317,20 @@ def assignments_api(request):
     csrf_token = get_token(request)
     return JsonResponse({'assignments': assignments_data, 'csrf_token': csrf_token})
 
+@login_required
+@user_passes_test(is_admin)
+def aggregator_health(request):
+    # Breaker state and concurrency limits of the worker process serving this request.
+    return JsonResponse({'endpoints': get_guards().snapshot()})
+
+@login_required
+@user_passes_test(is_admin)
+def webhook_backlog(request):
+    # Notifications acknowledged to the aggregator but not yet applied by process_webhooks,
+    # with each worker's settled-order cache counters. finalized_order_cache is this web
+    # process's own, which answers redeliveries before they reach the inbox.
+    return JsonResponse({**backlog(), 'finalized_order_cache': finalized_orders.stats()})
+
 from django.db.models import Q, Exists, OuterRef
 
 @login_required
@@ -0,0 +1,268 @@
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+
+import openpyxl
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from config import base as settings
+from config.transaction_orchestrator import PaymentInitiator
+from .holds import place_hold, release_unused
+from .models import DisbursementBatch, DisbursementItem, Finances, RecentTransaction
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_CHANNELS = {'MTN': 1, 'Airtel': 2}
+MAX_AMOUNT = Decimal('1e10')  # DisbursementItem.amount has 10 integer digits
+
+def _cell_text(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # phone numbers typed into a numeric cell
+    return str(value).strip()
+
+
+def _validate_row(row) -> tuple:
+    """Returns (name, phone, amount, payment_method, error) for one sheet row."""
+    row = tuple(row[:4]) + (None,) * (4 - len(row[:4]))
+    name, phone, method = _cell_text(row[0]), _cell_text(row[1]), _cell_text(row[3])
+    error = None
+    try:
+        amount = Decimal(_cell_text(row[2]))
+        if not amount.is_finite() or amount <= 0 or amount >= MAX_AMOUNT:
+            raise InvalidOperation
+    except InvalidOperation:
+        amount = None
+        error = f"Invalid amount: {row[2]}."
+    if not name or not phone:
+        error = "Incomplete row data."
+    elif method not in PAYMENT_CHANNELS:
+        error = f"Invalid payment method: {row[3]}"
+    return name[:255], phone[:20], amount, method[:20], error
+
+
+def create_batch(client, payment_file) -> DisbursementBatch:
+    """
+    Stream the uploaded workbook into a DisbursementBatch in one read-only pass.
+
+    Every non-empty row becomes a DisbursementItem: valid rows as 'pending',
+    the rest as 'invalid' with the reason. The batch is queued for
+    process_disbursements, or rejected if the valid rows exceed the available
+    balance. Each row still reserves its own amount when it is dispatched.
+    """
+    batch = DisbursementBatch.objects.create(client=client, file_name=payment_file.name[:255])
+    chunk = []
+    total_rows = valid_rows = 0
+    total_amount = Decimal('0.00')
+
+    workbook = openpyxl.load_workbook(payment_file, read_only=True, data_only=True)
+    try:
+        for row_number, row in enumerate(workbook.active.iter_rows(min_row=2, values_only=True), start=2):
+            if not any(cell not in (None, "") for cell in row):
+                continue
+            name, phone, amount, method, error = _validate_row(row)
+            total_rows += 1
+            if error is None:
+                valid_rows += 1
+                total_amount += amount
+            chunk.append(DisbursementItem(
+                batch=batch,
+                row_number=row_number,
+                name=name,
+                phone=phone,
+                amount=amount,
+                payment_method=method,
+                status='pending' if error is None else 'invalid',
+                message=error,
+            ))
+            if len(chunk) >= settings.DISBURSEMENT_PARSE_CHUNK:
+                DisbursementItem.objects.bulk_create(chunk)
+                chunk = []
+    finally:
+        workbook.close()
+    DisbursementItem.objects.bulk_create(chunk)
+
+    batch.total_rows = total_rows
+    batch.valid_rows = valid_rows
+    batch.total_amount = total_amount
+    finances = Finances.objects.filter(client=client).first()
+    balance = finances.available if finances else Decimal('0.00')
+    if not valid_rows:
+        batch.status = 'rejected'
+        batch.message = "The file has no valid payment rows."
+    elif total_amount > balance:
+        batch.status = 'rejected'
+        batch.message = (
+            f"Insufficient balance. Total payment amount is {total_amount}, but your available balance is {balance}. "
+            f"You need {total_amount - balance}."
+        )
+    if batch.status == 'rejected':
+        batch.finished_at = timezone.now()
+    batch.save(update_fields=['total_rows', 'valid_rows', 'total_amount', 'status', 'message', 'finished_at'])
+    return batch
+
+
+class DisbursementEngine:
+    """
+    Dispatches queued batches row by row on a bounded worker pool.
+
+    Batches are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so several
+    process_disbursements workers can run side by side. A row is marked
+    'processing' before PaymentInitiator runs; rows still in that state when a
+    worker dies are marked 'unknown' rather than resent, since the order may
+    already have reached the aggregator.
+    """
+
+    def __init__(self, workers: int = None):
+        self.workers = workers or settings.DISBURSEMENT_WORKERS
+        self.max_retries = settings.DISBURSEMENT_MAX_RETRIES
+        self.stale_after = timedelta(seconds=settings.DISBURSEMENT_STALE_AFTER)
+
+    def claim_batch(self):
+        now = timezone.now()
+        with transaction.atomic():
+            batch = (
+                DisbursementBatch.objects.filter(status='queued')
+                .order_by('created_at')
+                .select_for_update(skip_locked=True)
+                .first()
+            )
+            if batch is None:
+                return None
+            batch.status = 'running'
+            batch.started_at = batch.started_at or now
+            batch.heartbeat_at = now
+            batch.save(update_fields=['status', 'started_at', 'heartbeat_at'])
+        return batch
+
+    def requeue_stale(self) -> int:
+        """Hand batches whose worker stopped heartbeating back to the queue."""
+        cutoff = timezone.now() - self.stale_after
+        requeued = 0
+        with transaction.atomic():
+            stale = list(
+                DisbursementBatch.objects.filter(status='running', heartbeat_at__lt=cutoff)
+                .select_for_update(skip_locked=True)
+                .values_list('id', flat=True)
+            )
+            for batch_id in stale:
+                DisbursementItem.objects.filter(batch_id=batch_id, status='processing').update(
+                    status='unknown',
+                    message="Worker stopped while submitting this payment. Check its status before sending it again.",
+                    processed_at=timezone.now(),
+                )
+                requeued += DisbursementBatch.objects.filter(id=batch_id).update(status='queued', heartbeat_at=None)
+        if requeued:
+            logger.warning(f"Requeued {requeued} stalled disbursement batch(es).")
+        return requeued
+
+    def run_once(self):
+        """Requeue stalled batches, then run the oldest queued batch. Returns it, or None if the queue was empty."""
+        self.requeue_stale()
+        batch = self.claim_batch()
+        if batch is not None:
+            self.run_batch(batch)
+        return batch
+
+    def run_forever(self, poll_interval: float = None):
+        poll_interval = poll_interval or settings.DISBURSEMENT_POLL_INTERVAL
+        while True:
+            if self.run_once() is None:
+                time.sleep(poll_interval)
+
+    def run_batch(self, batch: DisbursementBatch):
+        pending = list(batch.items.filter(status='pending').order_by('row_number').values_list('id', flat=True))
+        logger.info(f"Disbursement batch {batch.id}: dispatching {len(pending)} rows with {self.workers} workers.")
+
+        last_beat = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="disbursement") as pool:
+            futures = [pool.submit(self._dispatch_safely, item_id) for item_id in pending]
+            for future in as_completed(futures):
+                future.result()
+                if time.monotonic() - last_beat >= 5:
+                    DisbursementBatch.objects.filter(id=batch.id).update(heartbeat_at=timezone.now())
+                    last_beat = time.monotonic()
+
+        progress = batch.progress()
+        DisbursementBatch.objects.filter(id=batch.id).update(
+            status='completed',
+            finished_at=timezone.now(),
+            message=f"{progress['submitted']} of {batch.valid_rows} payments submitted, {progress['failed']} failed.",
+        )
+        logger.info(f"Disbursement batch {batch.id} completed: {progress}")
+
+    def _dispatch_safely(self, item_id: int):
+        close_old_connections()
+        try:
+            self._dispatch(item_id)
+        except Exception as e:
+            logger.exception(f"Disbursement item {item_id} failed")
+            DisbursementItem.objects.filter(id=item_id, status='processing').update(
+                status='failed', message=str(e), processed_at=timezone.now()
+            )
+        finally:
+            close_old_connections()
+
+    def _dispatch(self, item_id: int):
+        if not DisbursementItem.objects.filter(id=item_id, status='pending').update(status='processing'):
+            return
+        item = DisbursementItem.objects.select_related('batch').get(id=item_id)
+        message = f"Disbursement for {item.name} ({item.phone})"
+        initiator = PaymentInitiator(
+            channel=PAYMENT_CHANNELS[item.payment_method],
+            t_type=2,
+            client_id=item.batch.client_id,
+            base_amount=item.amount,
+            trader_id=item.phone,
+            message=message,
+            name=item.name,
+            idempotency_key=f"disbursement-{item.id}",
+        )
+        # Reserved against the client's balance, so single payments and other batches running alongside cannot spend it too.
+        hold = place_hold(item.batch.client_id, initiator.total_amount)
+        if hold is None:
+            self._finish(item, 'failed', "Insufficient balance for this payment.")
+            return
+        initiator.hold_id = hold.id
+
+        try:
+            for attempt in range(self.max_retries + 1):
+                result = initiator.initiate_transaction()
+                init = json.loads(result.content)
+                # 503 means the call was shed before it was sent, so it is safe to repeat.
+                if result.status_code != 503 or attempt == self.max_retries:
+                    break
+                time.sleep(float(init.get('retry_after') or 1))
+        finally:
+            # Kept only if an order went out against it; the order's webhook settles it.
+            release_unused(hold.id)
+
+        if init.get('status') not in ('success', 'pending'):
+            self._finish(item, 'failed', init.get('message') or "Payment could not be initiated.")
+            return
+
+        self._finish(item, 'submitted', init.get('message'))
+        if not initiator.replayed:
+            self._record_transaction(item, message)
+
+    def _finish(self, item: DisbursementItem, status: str, message: str):
+        DisbursementItem.objects.filter(id=item.id).update(status=status, message=message, processed_at=timezone.now())
+
+    def _record_transaction(self, item: DisbursementItem, message: str):
+        RecentTransaction.objects.create(
+            client_id=item.batch.client_id,
+            date=timezone.localtime().date(),
+            time=timezone.localtime().time(),
+            amount=item.amount,
+            recipient=item.name,
+            phone=item.phone,
+            payment_method=item.payment_method,
+            transaction_type='Cash Out',
+            status='Processing',
+            description=message,
+        )
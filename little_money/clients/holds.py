@@ -0,0 +1,104 @@
+import logging
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from config import base as settings
+from .models import BalanceHold, Finances
+
+logger = logging.getLogger(__name__)
+
+
+def place_hold(client_id: int, amount, ttl: float = None):
+    """
+    Reserve amount of the client's available balance (balance - held) for a
+    disbursement. The reservation is one conditional UPDATE, so concurrent
+    disbursements cannot reserve the same money and none of them queues behind
+    a row lock for longer than that statement. Returns the BalanceHold, or None
+    if the available balance does not cover the amount.
+    """
+    amount = Decimal(amount)
+    ttl = settings.BALANCE_HOLD_TTL if ttl is None else ttl
+    with transaction.atomic():
+        if not Finances.for_client(client_id).filter(balance__gte=F('held') + amount).update(held=F('held') + amount):
+            return None
+        return BalanceHold.objects.create(
+            client_id=client_id,
+            amount=amount,
+            expires_at=timezone.now() + timedelta(seconds=ttl),
+        )
+
+
+def attach_hold(hold_id: int, out_trade_no: str) -> bool:
+    """Tie an open hold to the order it pays for, so the order's webhook can settle it."""
+    return bool(
+        BalanceHold.objects.filter(id=hold_id, status='held', out_trade_no__isnull=True).update(out_trade_no=out_trade_no)
+    )
+
+
+def settle_holds(paid: dict) -> dict:
+    """
+    Close the open holds of settled disbursements, given as out_trade_no -> whether
+    it was paid: 'captured' for the paid ones, whose debit then spends the balance
+    the hold kept, 'released' for the failed ones. Call it in the transaction that
+    settles the orders. Returns out_trade_no -> amount for the holds it closed.
+    """
+    if not paid:
+        return {}
+    return _close(
+        "CASE WHEN out_trade_no = ANY(%s) THEN 'captured' ELSE 'released' END",
+        "out_trade_no = ANY(%s)",
+        [[out_trade_no for out_trade_no, was_paid in paid.items() if was_paid], list(paid)],
+    )
+
+
+def release_unused(hold_id: int) -> bool:
+    """
+    Release a hold no order was submitted against: the initiation failed, or it
+    was a replay answered by an earlier order with its own hold.
+    """
+    return bool(_close("'released'", "id = %s AND out_trade_no IS NULL", [hold_id]))
+
+
+def expire_holds() -> int:
+    """Release every open hold past its expires_at. Returns how many were released."""
+    now = timezone.now()
+    expired = BalanceHold.objects.filter(status='held', expires_at__lte=now)
+    with transaction.atomic():
+        # Lock the balances first, in id order, as batched webhooks do.
+        list(
+            Finances.objects.select_for_update().filter(client_id__in=expired.values('client_id'))
+            .order_by('client_id', 'id').values_list('id', flat=True)
+        )
+        count = len(_close("'expired'", "expires_at <= %s", [now]))
+    if count:
+        logger.warning(f"Released {count} balance hold(s) that were not settled in time.")
+    return count
+
+
+def _close(status_sql: str, where_sql: str, params: list) -> dict:
+    # One statement: close the holds, then take each client's total off the Finances row
+    # place_hold reserved it on (Finances.for_client). Only 'held' rows match, so a hold
+    # is taken off once however many callers race for it. Returns out_trade_no -> amount;
+    # holds never tied to an order are keyed by their id.
+    quote = connection.ops.quote_name
+    holds = quote(BalanceHold._meta.db_table)
+    finances = quote(Finances._meta.db_table)
+    sql = f"""
+        WITH closed AS (
+            UPDATE {holds} SET status = {status_sql}, resolved_at = NOW()
+            WHERE status = 'held' AND {where_sql}
+            RETURNING id, out_trade_no, client_id, amount
+        ), moved AS (
+            UPDATE {finances} SET held = {finances}.held - totals.amount
+            FROM (SELECT client_id, SUM(amount) AS amount FROM closed GROUP BY client_id) AS totals
+            WHERE {finances}.id = (SELECT MIN(f.id) FROM {finances} AS f WHERE f.client_id = totals.client_id)
+        )
+        SELECT COALESCE(out_trade_no, id::text), amount FROM closed
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return dict(cursor.fetchall())
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.3 on 2026-10-18 17:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0011_alter_recenttransaction_transaction_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DisbursementBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_name', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('completed', 'Completed'), ('rejected', 'Rejected')], default='queued', max_length=20)),
+                ('total_rows', models.PositiveIntegerField(default=0)),
+                ('valid_rows', models.PositiveIntegerField(default=0)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('message', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='disbursement_batches', to='clients.client')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='DisbursementItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('row_number', models.PositiveIntegerField()),
+                ('name', models.CharField(blank=True, max_length=255, null=True)),
+                ('phone', models.CharField(blank=True, max_length=20, null=True)),
+                ('amount', models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True)),
+                ('payment_method', models.CharField(blank=True, max_length=20, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('submitted', 'Submitted'), ('failed', 'Failed'), ('invalid', 'Invalid'), ('unknown', 'Unknown')], default='pending', max_length=20)),
+                ('message', models.TextField(blank=True, null=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='clients.disbursementbatch')),
+            ],
+            options={
+                'ordering': ['row_number'],
+                'indexes': [models.Index(fields=['batch', 'status'], name='clients_dis_batch_i_51cfde_idx')],
+            },
+        ),
+    ]
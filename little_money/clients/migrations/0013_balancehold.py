@@ -0,0 +1,35 @@
+# Generated by Django 5.2.3 on 2026-10-18 18:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0012_disbursementbatch_disbursementitem'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='finances',
+            name='held',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=20),
+        ),
+        migrations.CreateModel(
+            name='BalanceHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=20)),
+                ('status', models.CharField(choices=[('held', 'Held'), ('captured', 'Captured'), ('released', 'Released'), ('expired', 'Expired')], default='held', max_length=20)),
+                ('out_trade_no', models.CharField(blank=True, max_length=36, null=True, unique=True)),
+                ('expires_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('resolved_at', models.DateTimeField(blank=True, null=True)),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_holds', to='clients.client')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'expires_at'], name='clients_bal_status_330541_idx')],
+            },
+        ),
+    ]
@@ -1,5 +1,6 @@
 from datetime import timezone
 from core.models import CustomUser
+from config.ids import BlockAllocator
 from django.db import models
 from django.core.validators import MinValueValidator
 
@@ -31,10 +32,24 @@ class Finances(models.Model):
         default=0.00,
         validators=[MinValueValidator(0.00)]
     )
+    # Sum of the client's open BalanceHolds: reserved for disbursements that have not settled yet.
+    held = models.DecimalField(max_digits=20, decimal_places=2, default=0)
     last_updated = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.client.name} - Balance: {self.balance}"
+
+    @property
+    def available(self):
+        return self.balance - self.held
+
+    @classmethod
+    def for_client(cls, client_id):
+        """
+        The client's Finances row that balance holds and ledger postings move, as a
+        queryset: the oldest one, should get_or_create races have left several.
+        """
+        return cls.objects.filter(pk=models.Subquery(cls.objects.filter(client_id=client_id).order_by('id').values('pk')[:1]))
     
     class Meta:
         verbose_name_plural = "Client Finances"
@@ -70,14 +85,21 @@ class RecentTransaction(models.Model):
     
     def save(self, *args, **kwargs):
         if not self.transaction_id:
-            last = RecentTransaction.objects.all().order_by('-transaction_id').first()
-            self.transaction_id = 1 if not last else last.transaction_id + 1
+            self.transaction_id = transaction_ids.next()
         super().save(*args, **kwargs)
 
  
     class Meta:
         ordering = ['-date', '-created_at']
 
+
+def _next_recent_transaction_id():
+    # Rows numbered before the counter existed continue from the highest one.
+    return (RecentTransaction.objects.aggregate(last=models.Max('transaction_id'))['last'] or 0) + 1
+
+
+transaction_ids = BlockAllocator('recent_transaction', seed=_next_recent_transaction_id)
+
 class UpcomingPayment(models.Model):
     client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name='upcoming_payments')
     date = models.DateField()
@@ -143,3 +165,86 @@ class DailyPayment(models.Model):
 
     class Meta:
         ordering = ['date']
+
+class DisbursementBatch(models.Model):
+    """An uploaded payroll file. Its rows are DisbursementItems, dispatched by manage.py process_disbursements."""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('rejected', 'Rejected'),
+    ]
+    client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name='disbursement_batches')
+    file_name = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, default='queued', choices=STATUS_CHOICES)
+    total_rows = models.PositiveIntegerField(default=0)
+    valid_rows = models.PositiveIntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    message = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    heartbeat_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.client.name} - {self.file_name} - {self.status}"
+
+    def progress(self):
+        """Row counts by item status, e.g. {'pending': 10, 'submitted': 80, 'failed': 2}."""
+        counts = dict(self.items.values_list('status').annotate(models.Count('id')).order_by())
+        return {status: counts.get(status, 0) for status, _ in DisbursementItem.STATUS_CHOICES}
+
+    class Meta:
+        ordering = ['-created_at']
+
+class DisbursementItem(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('submitted', 'Submitted'),
+        ('failed', 'Failed'),
+        ('invalid', 'Invalid'),
+        ('unknown', 'Unknown'),
+    ]
+    batch = models.ForeignKey(DisbursementBatch, on_delete=models.CASCADE, related_name='items')
+    row_number = models.PositiveIntegerField()
+    name = models.CharField(max_length=255, blank=True, null=True)
+    phone = models.CharField(max_length=20, blank=True, null=True)
+    amount = models.DecimalField(max_digits=12, decimal_places=2, blank=True, null=True)
+    payment_method = models.CharField(max_length=20, blank=True, null=True)
+    status = models.CharField(max_length=20, default='pending', choices=STATUS_CHOICES)
+    message = models.TextField(blank=True, null=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"Row {self.row_number} - {self.name} - {self.amount} - {self.status}"
+
+    class Meta:
+        ordering = ['row_number']
+        indexes = [models.Index(fields=['batch', 'status'])]
+
+class BalanceHold(models.Model):
+    """
+    Part of a client's balance reserved for one disbursement, from before the
+    order is submitted until its webhook (or the reconciler) settles it.
+    Finances.held is the sum of the client's 'held' rows.
+    """
+    STATUS_CHOICES = [
+        ('held', 'Held'),
+        ('captured', 'Captured'),
+        ('released', 'Released'),
+        ('expired', 'Expired'),
+    ]
+    client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name='balance_holds')
+    amount = models.DecimalField(max_digits=20, decimal_places=2)
+    status = models.CharField(max_length=20, default='held', choices=STATUS_CHOICES)
+    out_trade_no = models.CharField(max_length=36, unique=True, null=True, blank=True)
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    resolved_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.client.name} - {self.amount} - {self.status}"
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'expires_at'])]
@@ -1,3 +1,177 @@
-from django.test import TestCase
+import io
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import openpyxl
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import close_old_connections, transaction
+from django.http import JsonResponse
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from config import base as settings
+from config.platform_config import get_platform_config
+from config.transaction_orchestrator import PaymentInitiator
+from core.models import CustomUser
+from finance.models import PlatformSettings
+from . import disbursements
+from .disbursements import DisbursementEngine, create_batch
+from .models import BalanceHold, Client, DisbursementBatch, DisbursementItem, Finances
+
+
+def workbook_upload(rows, name="payroll.xlsx"):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(["Name", "Phone", "Amount", "Method"])
+    for row in rows:
+        sheet.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return SimpleUploadedFile(name, buffer.getvalue())
+
+
+class DisbursementTestCase(TestCase):
+    """A client with 10,000 on balance and a 2% platform fee."""
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            PlatformSettings.objects.create(platform_fee_percent=Decimal("2.00"))
+        get_platform_config()
+        user = CustomUser.objects.create(username="payroll", role="client")
+        self.client_obj = Client.objects.create(user=user, name="Payroll")
+        Finances.objects.create(client=self.client_obj, balance=Decimal("10000.00"))
+
+    def queued_batch(self, amounts, **fields):
+        batch = DisbursementBatch.objects.create(client=self.client_obj, file_name="payroll.xlsx", **fields)
+        for row_number, amount in enumerate(amounts, start=2):
+            DisbursementItem.objects.create(
+                batch=batch, row_number=row_number, name=f"Payee {row_number}", phone=f"25670000{row_number:04d}",
+                amount=Decimal(amount), payment_method="MTN",
+            )
+        return batch
+
+
+class CreateBatchTests(DisbursementTestCase):
+    def test_rows_are_streamed_and_stored_in_chunks(self):
+        upload = workbook_upload([
+            ["Alice", "256700000001", 1000, "MTN"],
+            ["Bob", "256700000002", "lots", "MTN"],
+            [None, None, None, None],
+            ["Carol", 256700000003, 2000.0, "Airtel"],
+            ["Dan", "256700000004", 500, "Cash"],
+        ])
+        load_workbook = mock.Mock(wraps=openpyxl.load_workbook)
+        bulk_create = mock.Mock(wraps=DisbursementItem.objects.bulk_create)
+        with mock.patch.object(disbursements.openpyxl, "load_workbook", load_workbook), \
+                mock.patch.object(DisbursementItem.objects, "bulk_create", bulk_create), \
+                mock.patch.object(settings, "DISBURSEMENT_PARSE_CHUNK", 2):
+            batch = create_batch(self.client_obj, upload)
+
+        self.assertTrue(load_workbook.call_args.kwargs["read_only"])
+        self.assertEqual([len(call.args[0]) for call in bulk_create.call_args_list], [2, 2, 0])
+        self.assertEqual((batch.status, batch.total_rows, batch.valid_rows), ("queued", 4, 2))
+        self.assertEqual(batch.total_amount, Decimal("3000.00"))
+        statuses = dict(batch.items.values_list("row_number", "status"))
+        self.assertEqual(statuses, {2: "pending", 3: "invalid", 5: "pending", 6: "invalid"})
+        self.assertEqual(batch.items.get(row_number=5).phone, "256700000003")
+
+    def test_batch_over_the_available_balance_is_rejected(self):
+        batch = create_batch(self.client_obj, workbook_upload([["Alice", "256700000001", 20000, "MTN"]]))
+        self.assertEqual(batch.status, "rejected")
+        self.assertIsNotNone(batch.finished_at)
+
+
+class DisbursementDispatchTests(DisbursementTestCase):
+    """_dispatch reserves each row's own amount and retries only calls that were shed before sending."""
+
+    def setUp(self):
+        super().setUp()
+        self.engine = DisbursementEngine(workers=1)
+        self.calls = []
+
+    def respond(self, *responses):
+        responses = list(responses)
+
+        def initiate(initiator):
+            hold = BalanceHold.objects.get(id=initiator.hold_id)
+            self.calls.append((hold.id, hold.amount, Finances.objects.get(client=self.client_obj).held))
+            return responses.pop(0)
+        return mock.patch.object(PaymentInitiator, "initiate_transaction", autospec=True, side_effect=initiate)
+
+    def test_each_row_reserves_its_own_hold(self):
+        batch = self.queued_batch(["1000", "2000"])
+        success = JsonResponse({"status": "success", "message": "Transaction initiated successfully."})
+        with self.respond(success, success):
+            for item in batch.items.order_by("row_number"):
+                self.engine._dispatch(item.id)
+
+        (first_hold, first_amount, first_held), (second_hold, second_amount, second_held) = self.calls
+        self.assertNotEqual(first_hold, second_hold)
+        self.assertEqual((first_amount, first_held), (Decimal("1020.00"), Decimal("1020.00")))
+        self.assertEqual((second_amount, second_held), (Decimal("2040.00"), Decimal("2040.00")))
+        # No order was tied to either hold, so both were released once their call returned.
+        self.assertEqual(Finances.objects.get(client=self.client_obj).held, Decimal("0.00"))
+        self.assertEqual(set(batch.items.values_list("status", flat=True)), {"submitted"})
+
+    def test_row_the_balance_cannot_cover_fails_without_a_call(self):
+        batch = self.queued_batch(["20000"])
+        with self.respond():
+            self.engine._dispatch(batch.items.get().id)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(batch.items.get().status, "failed")
+        self.assertFalse(BalanceHold.objects.exists())
+
+    def test_shed_call_is_retried(self):
+        batch = self.queued_batch(["1000"])
+        shed = JsonResponse({"status": "error", "retry_after": 0.5}, status=503)
+        success = JsonResponse({"status": "success", "message": "Transaction initiated successfully."})
+        with self.respond(shed, success), mock.patch.object(disbursements.time, "sleep") as sleep:
+            self.engine._dispatch(batch.items.get().id)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(len({hold_id for hold_id, _, _ in self.calls}), 1)
+        sleep.assert_called_once_with(0.5)
+        self.assertEqual(batch.items.get().status, "submitted")
+
+    def test_rows_of_a_stalled_batch_are_marked_unknown_not_resent(self):
+        batch = self.queued_batch(["1000", "2000"], status="running", heartbeat_at=timezone.now() - timedelta(hours=1))
+        in_flight = batch.items.get(row_number=2)
+        DisbursementItem.objects.filter(id=in_flight.id).update(status="processing")
+
+        self.assertEqual(self.engine.requeue_stale(), 1)
+        self.assertEqual(DisbursementBatch.objects.get(id=batch.id).status, "queued")
+        self.assertEqual(dict(batch.items.values_list("row_number", "status")), {2: "unknown", 3: "pending"})
+        with self.respond():
+            self.engine._dispatch(in_flight.id)
+        self.assertEqual(self.calls, [])
+
+
+class DisbursementClaimTests(TransactionTestCase):
+    def test_batch_locked_by_another_worker_is_skipped(self):
+        user = CustomUser.objects.create(username="payroll", role="client")
+        client = Client.objects.create(user=user, name="Payroll")
+        first = DisbursementBatch.objects.create(client=client, file_name="first.xlsx")
+        second = DisbursementBatch.objects.create(client=client, file_name="second.xlsx")
+        locked, release = threading.Event(), threading.Event()
+
+        def hold_first():
+            try:
+                with transaction.atomic():
+                    DisbursementBatch.objects.select_for_update().get(id=first.id)
+                    locked.set()
+                    release.wait(5)
+            finally:
+                close_old_connections()
+
+        holder = threading.Thread(target=hold_first)
+        holder.start()
+        self.assertTrue(locked.wait(5))
+        try:
+            claimed = DisbursementEngine(workers=1).claim_batch()
+        finally:
+            release.set()
+            holder.join()
+        self.assertEqual(claimed.id, second.id)
+        self.assertEqual(DisbursementBatch.objects.get(id=first.id).status, "queued")
+        self.assertEqual(DisbursementBatch.objects.get(id=second.id).status, "running")
@@ -3,6 +3,8 @@ from .views import (
                     overview_dashboard, 
                     transactions, 
                     payments, 
+                    initiate_payment,
+                    disbursement_batch_status,
                     accounts, 
                     settings, 
                     help_support, 
@@ -19,6 +21,8 @@ urlpatterns = [
     path('transactions/statement/', download_statement, name='download_statement'),
     path('transactions/receipt/<str:transaction_id>/', download_receipt, name='download_receipt'),
     path('payments/', payments, name='payments'),
+    path('payments/initiate/', initiate_payment, name='initiate_payment'),
+    path('payments/batches/<int:batch_id>/', disbursement_batch_status, name='disbursement_batch_status'),
     path('accounts/', accounts, name='accounts'),
     path('settings/', settings, name='settings'),
     path('help-support/', help_support, name='help_support'),
@@ -1,18 +1,25 @@
 import datetime
 import json
+import uuid
+from asgiref.sync import sync_to_async
 from django.utils import timezone
+from django.views.decorators.http import require_POST
 from django.http import JsonResponse
 from django.shortcuts import render, redirect,get_object_or_404
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.http import HttpResponse
+from config.job_queue import enqueue_payment
 from config.transaction_orchestrator import PaymentInitiator
 from config.utils import generate_transaction_id
-from .models import Client, Finances, RecentTransaction, UpcomingPayment, LinkedAccount, UserSetting, FAQ, ContactInfo, KnowledgeBaseEntry, DailyPayment
+from .disbursements import create_batch
+from .holds import place_hold, release_unused
+from .models import Client, DisbursementBatch, Finances, RecentTransaction, UpcomingPayment, LinkedAccount, UserSetting, FAQ, ContactInfo, KnowledgeBaseEntry, DailyPayment
 from django.utils.timezone import now, localdate
 from core.utils import is_client
-import openpyxl
 from django.utils.dateparse import parse_date
 from django.contrib import messages
+from django.core.paginator import Paginator
+from django.db import transaction as db_transaction
 from django.db.models import Sum
 from calendar import monthrange
 from decimal import Decimal, InvalidOperation
@@ -216,6 +223,25 @@ def download_receipt(request, transaction_id):
     response['Content-Disposition'] = f'attachment; filename="receipt_{transaction_id}.pdf"'
     return response
 
+def _enqueue_payment(initiator, idempotency_key, **transaction_fields):
+    """
+    Queue the payment for manage.py run_payment_jobs and record it as a Pending
+    RecentTransaction, which the worker moves on as the job runs.
+    Returns False if the idempotency key was already queued.
+    """
+    with db_transaction.atomic():
+        job, created = enqueue_payment(initiator, idempotency_key)
+        if created:
+            job.recent_transaction = RecentTransaction.objects.create(
+                client=initiator.client,
+                date=timezone.localtime().date(),
+                time=timezone.localtime().time(),
+                status='Pending',
+                **transaction_fields,
+            )
+            job.save(update_fields=['recent_transaction'])
+    return created
+
 @login_required
 @user_passes_test(is_client)
 def payments(request):
@@ -244,9 +270,6 @@ def payments(request):
 
                 message = f"Disbursment for {name} ({phone})"
 
-                if amount_decimal > finances.balance:
-                    messages.error(request, f'Disbursement amount {amount} exceeds available balance {finances.balance}. Transaction cancelled.')
-                    return redirect('client:payments')
                 response = PaymentInitiator(
                     channel=channel,
                     t_type=2,
@@ -256,23 +279,25 @@ def payments(request):
                     message=message,
                     name=name
                 )
-                result_data = response.initiate_transaction()
-                init = json.loads(result_data.content)
-                if init.get('status') == 'success':
-                    RecentTransaction.objects.create(
-                        client =client,
-                        date=timezone.localtime().date(),
-                        time=timezone.localtime().time(),
-                        amount= amount_decimal,
-                        recipient = name,
-                        phone = phone,
-                        payment_method = payment_method,
-                        transaction_type = 'Cash Out',
-                        status = 'Processing',
-                        description = message,
-                    )
-                    messages.success(request, f'Disbursement for {name} ({phone}) initiated successful.')
+                # Reserve the amount now, so disbursements submitted together cannot overspend the balance.
+                hold = place_hold(client.id, response.total_amount)
+                if hold is None:
+                    finances.refresh_from_db()
+                    messages.error(request, f'Disbursement amount {response.total_amount} exceeds available balance {finances.available}. Transaction cancelled.')
                     return redirect('client:payments')
+                response.hold_id = hold.id
+                try:
+                    queued = _enqueue_payment(response, request.POST.get('idempotency_key'), amount=amount_decimal, recipient=name, phone=phone,
+                                              payment_method=payment_method, transaction_type='Cash Out', description=message)
+                except Exception:
+                    release_unused(hold.id)
+                    raise
+                if queued:
+                    messages.success(request, f'Disbursement for {name} ({phone}) queued. Its status is updated under Transactions.')
+                else:
+                    release_unused(hold.id)
+                    messages.info(request, f'Disbursement for {name} ({phone}) was already submitted.')
+                return redirect('client:payments')
             except Exception as e:
                 message = f"failed due to{str(e)}"
                 return redirect('client:payments')
@@ -285,82 +310,19 @@ def payments(request):
                         'status': 'error', 'message': 'No file uploaded.'
                         },
                         status=400)
-                if not payment_file.name.endswith(('.xls', '.xlsx')):
-                    return JsonResponse({'status': 'error', 'message': 'Invalid file type. Please upload an Excel file.'}, status=400)
-
-                wb = openpyxl.load_workbook(payment_file)
-                sheet = wb.active
-
-                total_requested = Decimal('0.00')
-                errors = []
-                valid_rows = []
-
-                for idx, row in enumerate(sheet.iter_rows(min_row=2, values_only=True), start=2):
-                    if len(row) < 4:
-                        errors.append({'row': idx, 'message': 'Incomplete row data.'})
-                        continue
-
-                    name, phone, amount, payment_method = row[:4]
-
-                    if payment_method not in ['MTN', 'Airtel']:
-                        errors.append({'row': idx, 'message': f'Invalid payment method: {payment_method}'})
-                        continue
-
-                    try:
-                        amount_decimal = Decimal(str(amount))
-                        if amount_decimal <= 0:
-                            raise ValueError("Amount must be greater than zero.")
-                        total_requested += amount_decimal
-                        valid_rows.append((name, phone, amount_decimal, payment_method))
-                    except (InvalidOperation, ValueError) as e:
-                        errors.append({'row': idx, 'message': f'Invalid amount: {amount}. {str(e)}'})
+                if not payment_file.name.endswith('.xlsx'):
+                    return JsonResponse({'status': 'error', 'message': 'Invalid file type. Please upload an Excel (.xlsx) file.'}, status=400)
 
-                if total_requested > finances.balance:
-                    required_top_up = total_requested - finances.balance
-
-                    messages.warning({request, f'Insufficient balance. Total payment amount is {total_requested}, but your balance is {finances.balance}. you need {required_top_up}.'})
-                    return redirect('client:payments')
-
-                # Process all valid transactions
-                payments_processed = 0
-                for name, phone, amount_decimal, payment_method in valid_rows:
-                    try:
-                        map_channel = {'MTN': 1, 'Airtel': 2}
-                        channel = map_channel[payment_method]
-                        base_amount = int(amount_decimal)
-                        trader_id = client.trader_id if hasattr(client, 'trader_id') else str(client.id)
-                        message = f"Disbursement for {name} ({phone})"
-
-                        result = PaymentInitiator(
-                            channel=channel,
-                            t_type=2,
-                            client_id=client.id,
-                            base_amount=base_amount,
-                            trader_id=trader_id,
-                            message=message,
-                            name=name
-                        )
-                        result_data = result.initiate_transaction()
-                        init = json.loads(result_data.content)
-                        if init.get('status') == 'success':
-                            RecentTransaction.objects.create(
-                                client =client,
-                                date=timezone.localtime().date(),
-                                time=timezone.localtime().time(), 
-                                amount= amount_decimal,
-                                recipient = name,
-                                phone = phone,
-                                payment_method = payment_method,
-                                transaction_type = 'Cash Out',
-                                status = 'Pending',
-                                description = message,
-                            )
-                            payments_processed+=1
-                            messages.success(request, f'Disbursement for {name} ({phone}) successful.')
-                            return redirect('client:payments')
-                    except Exception as e:
-                        errors.append({'row': name, 'message': str(e)})
-                messages.success(request, f"A total of {payments_processed} out of {valid_rows} were successfully processed.")
+                batch = create_batch(client, payment_file)
+                if batch.status == 'rejected':
+                    messages.warning(request, batch.message)
+                else:
+                    invalid_rows = batch.total_rows - batch.valid_rows
+                    messages.success(
+                        request,
+                        f"Batch #{batch.id} queued: {batch.valid_rows} payments totalling {batch.total_amount}"
+                        + (f", {invalid_rows} invalid rows skipped." if invalid_rows else ".")
+                    )
                 return redirect('client:payments')
 
             except Exception as e:
@@ -368,13 +330,130 @@ def payments(request):
 
     # For GET request
     scheduled_payments = UpcomingPayment.objects.filter(client=client).order_by('date')
+    disbursement_batches = DisbursementBatch.objects.filter(client=client)[:10]
     context = {
         'client': client,
         'payment_methods': ['MTN', 'Airtel'],
         'scheduled_payments': scheduled_payments,
+        'disbursement_batches': disbursement_batches,
+        'idempotency_key': uuid.uuid4().hex,
     }
     return render(request, 'dashboard/payments.html', context)
 
+@login_required
+@user_passes_test(is_client)
+def disbursement_batch_status(request, batch_id):
+    """Progress and per-row results of a bulk upload. Filter rows with ?status= and page through them with ?page=."""
+    client = get_object_or_404(Client, user=request.user)
+    batch = get_object_or_404(DisbursementBatch, id=batch_id, client=client)
+
+    items = batch.items.all()
+    if request.GET.get('status'):
+        items = items.filter(status=request.GET['status'])
+    page = Paginator(items.values('row_number', 'name', 'phone', 'amount', 'payment_method', 'status', 'message'), 500)
+    rows = page.get_page(request.GET.get('page'))
+
+    return JsonResponse({
+        'status': 'success',
+        'batch': {
+            'id': batch.id,
+            'file_name': batch.file_name,
+            'status': batch.status,
+            'message': batch.message,
+            'total_rows': batch.total_rows,
+            'valid_rows': batch.valid_rows,
+            'total_amount': str(batch.total_amount),
+            'progress': batch.progress(),
+            'created_at': batch.created_at,
+            'started_at': batch.started_at,
+            'finished_at': batch.finished_at,
+        },
+        'page': rows.number,
+        'pages': page.num_pages,
+        'items': [dict(row, amount=str(row['amount']) if row['amount'] is not None else None) for row in rows],
+    })
+
+@login_required
+@user_passes_test(is_client)
+@require_POST
+async def initiate_payment(request):
+    """
+    Async JSON endpoint for a single disbursement ('Cash Out') or collection ('Cash In').
+    Under the ASGI entry point the worker keeps serving other requests while the aggregator responds.
+    """
+    user = await request.auser()
+    client, _ = await Client.objects.aget_or_create(user=user, defaults={'name': user.username})
+
+    name = request.POST.get('name')
+    phone = request.POST.get('phone')
+    amount = request.POST.get('amount')
+    payment_method = request.POST.get('payment_method')
+    transaction_type = request.POST.get('transaction_type', 'Cash Out')
+
+    if not all([name, phone, amount, payment_method]):
+        return JsonResponse({'status': 'error', 'message': 'All fields (name, phone, amount, payment method) are required.'}, status=400)
+    if payment_method not in ['MTN', 'Airtel']:
+        return JsonResponse({'status': 'error', 'message': 'Invalid payment method selected.'}, status=400)
+    if transaction_type not in ['Cash In', 'Cash Out']:
+        return JsonResponse({'status': 'error', 'message': 'Invalid transaction type.'}, status=400)
+
+    try:
+        amount_decimal = Decimal(amount)
+    except InvalidOperation:
+        return JsonResponse({'status': 'error', 'message': 'Invalid amount provided.'}, status=400)
+    if amount_decimal <= 0:
+        return JsonResponse({'status': 'error', 'message': 'Amount must be greater than zero.'}, status=400)
+
+    map_channel = {'MTN': 1, 'Airtel': 2}
+    if transaction_type == 'Cash Out':
+        t_type = 2
+        message = f"Disbursment for {name} ({phone})"
+    else:
+        t_type = 1
+        message = f"Collection for {name}"
+
+    initiator = await sync_to_async(PaymentInitiator)(
+        channel=map_channel[payment_method],
+        t_type=t_type,
+        client_id=client.id,
+        base_amount=int(amount_decimal),
+        trader_id=phone,
+        message=message,
+        name=name,
+        idempotency_key=request.headers.get('Idempotency-Key') or request.POST.get('idempotency_key')
+    )
+    if t_type == 2:
+        hold = await sync_to_async(place_hold)(client.id, initiator.total_amount)
+        if hold is None:
+            finances, _ = await Finances.objects.aget_or_create(client=client, defaults={'balance': Decimal('0.00')})
+            return JsonResponse({'status': 'error', 'message': f'Disbursement amount {initiator.total_amount} exceeds available balance {finances.available}.'}, status=400)
+        initiator.hold_id = hold.id
+    try:
+        result_data = await initiator.ainitiate_transaction()
+    finally:
+        if initiator.hold_id:
+            # Only kept if an order went out against it.
+            await sync_to_async(release_unused)(initiator.hold_id)
+    init = json.loads(result_data.content)
+    if init.get('status') != 'success':
+        return JsonResponse(init, status=result_data.status_code)
+    if initiator.replayed:
+        return JsonResponse({'status': 'success', 'message': init.get('message'), 'replayed': True})
+
+    await RecentTransaction.objects.acreate(
+        client=client,
+        date=timezone.localtime().date(),
+        time=timezone.localtime().time(),
+        amount=amount_decimal,
+        recipient=name,
+        phone=phone,
+        payment_method=payment_method,
+        transaction_type=transaction_type,
+        status='Processing' if t_type == 2 else 'Pending',
+        description=message,
+    )
+    return JsonResponse({'status': 'success', 'message': init.get('message')})
+
 @login_required
 @user_passes_test(is_client)
 def accounts(request):
@@ -418,37 +497,11 @@ def accounts(request):
                             message=message,
                             name=name
                         )
-            try:
-                # Parse the JSON content from the JsonResponse object
-                result_data = result_response.initiate_transaction()
-                init = json.loads(result_data.content)
-                if init.get('status') == 'success': # Use .get() for safer access
-                    # Record the fund addition as a RecentTransaction
-                    # Ensure amount is Decimal when creating RecentTransaction
-                    RecentTransaction.objects.create(
-                    client=client,
-                    date=timezone.localtime().date(),
-                    time=timezone.localtime().time(), 
-                    amount=Decimal(amount),  # Ensure Decimal for money
-                    recipient=name,
-                    phone=phone,
-                    payment_method=payment_method,
-                    transaction_type='Cash In',  # Or 'Cash Out'
-                    status='Pending',  #
-                    description=message,
-                    )
-                    messages.success(request, f'Funds of {amount} added for {name} ({phone}) via {payment_method}.')
-                else:
-                    # Display the error message from the transaction handler
-                    error_message = result_data.get('message', 'An unknown error occurred during transaction.')
-                    messages.error(request, f'Transaction failed: {error_message}')
-
-            except json.JSONDecodeError:
-                messages.error(request, 'Received an invalid response from the transaction system.')
-            except Exception as e:
-                # Catch any other unexpected errors during response processing
-                messages.error(request, f'An unexpected error occurred while processing transaction response: {e}')
-            # --- FIX ENDS HERE ---
+            if _enqueue_payment(result_response, request.POST.get('idempotency_key'), amount=Decimal(amount), recipient=name, phone=phone,
+                                payment_method=payment_method, transaction_type='Cash In', description=message):
+                messages.success(request, f'Request for funds of {amount} from {name} ({phone}) via {payment_method} queued.')
+            else:
+                messages.info(request, f'Funds of {amount} for {name} ({phone}) were already requested.')
 
         return redirect('client:accounts')
 
@@ -456,6 +509,7 @@ def accounts(request):
         'client': client,
         'linked_accounts': linked_accounts,
         'finances': finances,
+        'idempotency_key': uuid.uuid4().hex,
     }
     return render(request, 'dashboard/accounts.html', context)
 
@@ -1,21 +1,45 @@
 from config.models import BalanceRequest, OrderQueryRequest, PrepaidBillRequest, StatementRequest, UnifiedOrderRequest
 from . import base as settings
-from .utils import generate_signature, generate_timestamp, generate_unique_id, verify_signature
+from .audit import record_audit
+from .finalized_orders import FinalizedOrderCache
+from .ids import generate_unique_id
+from .resilience import AggregatorUnavailable, unavailable_error
+from .transport import get_transport
+from .utils import Signer, generate_timestamp, verify_signature
 import requests
 import json
+import logging
 import time
 from typing import Dict, Any
 
+logger = logging.getLogger(__name__)
+
 merchant_id = settings.PAYMENT_MERCHANT_ID
 apikey = settings.PAYMENT_AGGREGATOR_API_KEY
 notifyurl = settings.PAYMENT_AGGREGATOR_WEBHOOK_URL
 base_url = settings.PAYMENT_AGGREGATOR_BASE_URL
 
+# Request signers, compiled once per endpoint field order.
+unified_order_signer = Signer([
+    "Version", "MchID", "TimeStamp", "Channel", "OutTradeNo", "Amount",
+    "TransactionType", "TraderID", "TraderFullName", "Description", "NotifyUrl"
+], apikey)
+order_query_signer = Signer(["Version", "MchID", "TimeStamp", "OutTradeNo"], apikey)
+bill_signer = Signer(["Version", "MchID", "TimeStamp", "Channel", "TransactionType", "TraderID", "Amount"], apikey)
+balance_signer = Signer(["Version", "MchID", "TimeStamp"], apikey)
+statement_signer = Signer(["Version", "MchID", "TimeStamp", "StartTime", "EndTime"], apikey)
+
+def order_response(body: dict, request_data: dict) -> dict:
+    """The /unifiedorder body with the OutTradeNo it was sent with, which a rejection's body does not carry."""
+    body["OutTradeNo"] = request_data["OutTradeNo"]
+    return body
+
+
 class UnifiedOrder:
     def __init__(self):
         pass
 
-    def create_order(self, trader_id: str, amount: int, channel: int, transaction_type: int, name: str, message: str) -> dict:
+    def build_request(self, trader_id: str, amount: int, channel: int, transaction_type: int, name: str, message: str):
         timestamp = generate_timestamp()
         out_trade_no = generate_unique_id()
 
@@ -32,16 +56,7 @@ class UnifiedOrder:
             "Description": message,
             "NotifyUrl": notifyurl,
         }
-        field_order = [
-            "Version", "MchID", "TimeStamp", "Channel", "OutTradeNo", "Amount",
-            "TransactionType", "TraderID", "TraderFullName", "Description", "NotifyUrl"
-        ]
-        request_data["Sign"] = generate_signature(request_data,field_order,apikey)
-
-        url = f"{base_url}/unifiedorder"
-        headers = {
-            'Content-Type': 'application/json',
-        }
+        request_data["Sign"] = unified_order_signer.sign(request_data)
 
         order = UnifiedOrderRequest(
             timestamp=timestamp,
@@ -53,27 +68,31 @@ class UnifiedOrder:
             trader_full_name=name,
             description=message,
         )
+        return request_data, order
+
+    def create_order(self, trader_id: str, amount: int, channel: int, transaction_type: int, name: str, message: str) -> dict:
+        request_data, order = self.build_request(trader_id, amount, channel, transaction_type, name, message)
         order.save()
         try:
-            resp = requests.post(url, json=request_data, headers=headers, timeout=10)
-            print("Request URL:", url)
-            print("Request Data:", request_data)
-            print("Response Status:", resp.status_code)
-            print("Response Headers:", resp.headers)
-            print("Response Body:", resp.text)
+            resp = get_transport().post("unifiedorder", request_data)
+            logger.info(f"Aggregator /unifiedorder {request_data['OutTradeNo']} returned {resp.status_code}")
+            logger.debug(f"Aggregator /unifiedorder response body: {resp.text}")
             resp.raise_for_status()
+            return order_response(resp.json(), request_data), resp.status_code
+        except AggregatorUnavailable as e:
+            return unavailable_error(e), 503
         except requests.RequestException as e:
-            print("Request Exception:", str(e))
-            return {"error": f"Failed to connect to aggregator: {str(e)}"}, 503
+            logger.error(f"Aggregator /unifiedorder {request_data['OutTradeNo']} failed: {e}")
+            return {"error": f"Failed to connect to aggregator: {str(e)}", "OutTradeNo": request_data["OutTradeNo"]}, 503
         except json.JSONDecodeError:
-            return {"error": "Invalid response from aggregator"}, 502
+            return {"error": "Invalid response from aggregator", "OutTradeNo": request_data["OutTradeNo"]}, 502
 
 
 class PaymentResults:
     def __init__(self):
         pass
 
-    def get_result(self, unique_id: str) -> dict:
+    def build_request(self, unique_id: str):
         timestamp = generate_timestamp()
         request_data = {
             "Version": "v1.0",
@@ -82,22 +101,23 @@ class PaymentResults:
             "OutTradeNo": unique_id,
         }
 
-        field_order =["Version","MchID", "TimeStamp", "OutTradeNo"]
-        request_data["Sign"] = generate_signature(request_data, field_order, apikey)
+        request_data["Sign"] = order_query_signer.sign(request_data)
 
-        url = f"{base_url}/orderquery"
-        headers = {
-            'Content-Type': 'application/json',
-        }
         get_result=OrderQueryRequest(
             timestamp=timestamp,
             out_trade_no=unique_id
         )
-        get_result.save()
+        return request_data, get_result
+
+    def get_result(self, unique_id: str) -> dict:
+        request_data, get_result = self.build_request(unique_id)
+        record_audit(get_result)
         try:
-            resp = requests.post(url, json=request_data, headers=headers, timeout=10)
+            resp = get_transport().post("orderquery", request_data)
             resp.raise_for_status()
             return resp.json(), resp.status_code
+        except AggregatorUnavailable as e:
+            return unavailable_error(e), 503
         except requests.RequestException as e:
             return {"error": f"Failed to connect to aggregator: {str(e)}"}, 503
         except json.JSONDecodeError:
@@ -107,42 +127,42 @@ class PaymentResults:
 class PaymentResultsCallback:
     def __init__(self, apikey: str):
         self.apikey = apikey
-        self.order_status = {}
+        self.order_status = FinalizedOrderCache(max_entries=settings.FINALIZED_ORDER_CACHE_SIZE)
 
     def handle_notification(self, data: Dict[str, Any]) -> str:
         if not data:
-            print("No data received in notification.")
+            logger.warning("No data received in notification.")
             return "FAILED"
 
         if not verify_signature(data, self.apikey):
-            print("Signature verification failed.")
+            logger.warning("Signature verification failed.")
             return "FAILED"
 
         order_id = data.get("OutTradeNo")
         if not order_id:
-            print("Missing OutTradeNo.")
+            logger.warning("Missing OutTradeNo.")
             return "FAILED"
 
         if self.is_duplicate(order_id):
-            print(f"Duplicate notification for {order_id}. Ignoring.")
+            logger.info(f"Duplicate notification for {order_id}. Ignoring.")
             return "SUCCESS"
 
         try:
             pay_status = int(data.get("PayStatus", -1))
         except (ValueError, TypeError):
-            print("Invalid PayStatus value.")
+            logger.warning("Invalid PayStatus value.")
             return "FAILED"
 
         if pay_status == 1:
-            self.order_status[order_id] = "processed"
-            print(f"Payment for order {order_id} processed successfully.")
+            self.order_status.put(order_id, "processed")
+            logger.info(f"Payment for order {order_id} processed successfully.")
             return "SUCCESS"
         elif pay_status == 2:
-            self.order_status[order_id] = "failed"
-            print(f"Payment for order {order_id} failed.")
+            self.order_status.put(order_id, "failed")
+            logger.info(f"Payment for order {order_id} failed.")
             return "FAILED"
         else:
-            print(f"Unhandled PayStatus: {pay_status}")
+            logger.warning(f"Unhandled PayStatus: {pay_status}")
             return "FAILED"
 
     def is_duplicate(self, order_id: str) -> bool:
@@ -153,7 +173,7 @@ class PrepaidBill:
     def __init__(self):
         pass
 
-    def get_bill(self, trader_id: str, amount: int, channel: int, transaction_type: int) -> dict:
+    def build_request(self, trader_id: str, amount: int, channel: int, transaction_type: int):
         timestamp = generate_timestamp()
         request_data = {
             "Version": "v1.0",
@@ -164,11 +184,8 @@ class PrepaidBill:
             "TraderID": trader_id,
             "Amount": amount
         }
-        field_order = ["Version", "MchID", "TimeStamp", "Channel", "TransactionType", "TraderID", "Amount"]
-        request_data["Sign"] = generate_signature(request_data,field_order, apikey)
-        url = f"{base_url}/bill"
-        headers = {'Content-Type': 'application/json'}
-        
+        request_data["Sign"] = bill_signer.sign(request_data)
+
         get_bill_request = PrepaidBillRequest(
             timestamp=timestamp,
             channel=channel,
@@ -176,18 +193,24 @@ class PrepaidBill:
             trader_id=trader_id,
             amount=amount
         )
-        get_bill_request.save()
+        return request_data, get_bill_request
+
+    def get_bill(self, trader_id: str, amount: int, channel: int, transaction_type: int) -> dict:
+        request_data, get_bill_request = self.build_request(trader_id, amount, channel, transaction_type)
+        record_audit(get_bill_request)
 
         try:
-            resp = requests.post(url, json=request_data, headers=headers, timeout=10)
+            resp = get_transport().post("bill", request_data)
             resp.raise_for_status()
             response_json = resp.json()
             return response_json
+        except AggregatorUnavailable as e:
+            return unavailable_error(e)
         except requests.RequestException as e:
-            print("Request failed:", str(e))
+            logger.error(f"Aggregator /bill failed: {e}")
             return {"error": f"Connection failed: {str(e)}"}
         except json.JSONDecodeError:
-            print("Invalid JSON response")
+            logger.error("Aggregator /bill returned invalid JSON")
             return {"error": "Invalid JSON response from aggregator"}
 
 
@@ -196,29 +219,29 @@ class GetBalance:
     def __init__(self):
         pass
 
-    def get_balance(self) -> dict:
+    def build_request(self):
         timestamp = generate_timestamp()
         request_data = {
             "Version": "v1.0",
             "MchID": merchant_id,
             "TimeStamp": timestamp
         }
-        field_order=["Version","MchID", "TimeStamp"]
-        request_data["Sign"] = generate_signature(request_data, field_order, apikey)
-
-        url = f"{base_url}/balance"
-        headers = {
-            'Content-Type': 'application/json',
-        }
+        request_data["Sign"] = balance_signer.sign(request_data)
 
         get_baalance_request = BalanceRequest(
             timestamp=timestamp
         )
-        get_baalance_request.save()
+        return request_data, get_baalance_request
+
+    def get_balance(self) -> dict:
+        request_data, get_baalance_request = self.build_request()
+        record_audit(get_baalance_request)
         try:
-            resp = requests.post(url, json=request_data, headers=headers, timeout=10)
+            resp = get_transport().post("balance", request_data)
             resp.raise_for_status()
             return resp.json()
+        except AggregatorUnavailable as e:
+            return unavailable_error(e)
         except requests.RequestException as e:
             return {"error": f"Connection failed: {str(e)}"}
         except json.JSONDecodeError:
@@ -229,7 +252,7 @@ class GetStatementOfAccount:
     def __init__(self):
         pass
 
-    def fetch(self, start_date: str = None, end_date: str = None) -> dict:
+    def build_request(self, start_date: str = None, end_date: str = None):
         timestamp = generate_timestamp()
         request_data = {
             "Version": "v1.0",
@@ -241,25 +264,24 @@ class GetStatementOfAccount:
             request_data["StartTime"] = start_date
         if end_date:
             request_data["EndTime"] = end_date
-        field_order= ["Version","MchID","TimeStamp","StartTime","EndTime"]
-        request_data["Sign"] = generate_signature(request_data,field_order, apikey)
-
-
-        url = f"{base_url}/statement"
-        headers = {
-            'Content-Type': 'application/json',
-        }
+        request_data["Sign"] = statement_signer.sign(request_data)
 
         fetch = StatementRequest(
             timestamp=timestamp,
             start_time=start_date,
             end_time=end_date
         )
-        fetch.save()
+        return request_data, fetch
+
+    def fetch(self, start_date: str = None, end_date: str = None) -> dict:
+        request_data, fetch = self.build_request(start_date, end_date)
+        record_audit(fetch)
         try:
-            resp = requests.post(url, json=request_data, headers=headers, timeout=10)
+            resp = get_transport().post("statement", request_data)
             resp.raise_for_status()
             return resp.json()
+        except AggregatorUnavailable as e:
+            return unavailable_error(e)
         except requests.RequestException as e:
             return {"error": f"Connection failed: {str(e)}"}
         except json.JSONDecodeError:
@@ -6,6 +6,6 @@ class ConfigConfig(AppConfig):
     name = 'config'
 
     def ready(self):
-        from .signals import auth_signals
+        from .signals import auth_signals, config_signals
         # Ensure signals are imported when the app is ready
         # This will register the signal handlers defined in config/signals.py   
\ No newline at end of file
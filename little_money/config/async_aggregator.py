@@ -0,0 +1,178 @@
+import asyncio
+import json
+import logging
+import random
+import weakref
+
+import httpx
+
+from . import base as settings
+from .audit import arecord_audit
+from .aggregator import GetBalance, GetStatementOfAccount, PaymentResults, PrepaidBill, UnifiedOrder, order_response
+from .resilience import AggregatorUnavailable, get_guards, unavailable_error
+from .transport import IDEMPOTENT_ENDPOINTS, RETRY_STATUS_CODES
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncAggregatorTransport:
+    """
+    asyncio twin of transport.AggregatorTransport.
+    One httpx.AsyncClient per event loop keeps many aggregator calls in flight on a single ASGI worker.
+    """
+
+    def __init__(self, base_url: str, max_connections: int, connect_timeout: float,
+                 read_timeouts: dict, max_retries: int, retry_backoff: float, guards=None):
+        self.base_url = base_url.rstrip("/")
+        self.connect_timeout = connect_timeout
+        self.read_timeouts = dict(read_timeouts)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        # Shared with the sync transport, so both see one breaker per endpoint.
+        self.guards = guards or get_guards()
+        self.client = httpx.AsyncClient(
+            headers={'Content-Type': 'application/json'},
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    def timeout_for(self, endpoint: str) -> httpx.Timeout:
+        read = self.read_timeouts.get(endpoint, 10)
+        return httpx.Timeout(read, connect=self.connect_timeout)
+
+    async def post(self, endpoint: str, payload: dict) -> httpx.Response:
+        """
+        POST `payload` to `{base_url}/{endpoint}` with the same retry rules as the sync transport.
+        Raises resilience.AggregatorUnavailable when the call is shed and httpx.HTTPError when all attempts fail.
+        """
+        url = f"{self.base_url}/{endpoint}"
+        attempts = self.max_retries + 1 if endpoint in IDEMPOTENT_ENDPOINTS else 1
+        timeout = self.timeout_for(endpoint)
+        guard = self.guards.get(endpoint)
+
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            started = guard.acquire()
+            try:
+                resp = await self.client.post(url, json=payload, timeout=timeout)
+            except httpx.TransportError as e:
+                guard.release(started, ok=False)
+                if last_attempt:
+                    raise
+                logger.warning(f"Aggregator /{endpoint} attempt {attempt + 1} failed: {e}. Retrying.")
+            except BaseException:
+                # Includes cancellation: the slot must not leak.
+                guard.release(started, ok=False)
+                raise
+            else:
+                guard.release(started, ok=resp.status_code < 500)
+                if resp.status_code not in RETRY_STATUS_CODES or last_attempt:
+                    return resp
+                logger.warning(f"Aggregator /{endpoint} attempt {attempt + 1} returned {resp.status_code}. Retrying.")
+            await asyncio.sleep(random.uniform(0, self.retry_backoff * (2 ** attempt)))
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+_transports = weakref.WeakKeyDictionary()
+
+
+def get_async_transport() -> AsyncAggregatorTransport:
+    """
+    Return the transport bound to the running event loop.
+    httpx connections cannot move between loops, so each loop gets its own pool.
+    """
+    loop = asyncio.get_running_loop()
+    transport = _transports.get(loop)
+    if transport is None:
+        transport = AsyncAggregatorTransport(
+            base_url=settings.PAYMENT_AGGREGATOR_BASE_URL,
+            max_connections=settings.AGGREGATOR_ASYNC_MAX_CONNECTIONS,
+            connect_timeout=settings.AGGREGATOR_CONNECT_TIMEOUT,
+            read_timeouts=settings.AGGREGATOR_READ_TIMEOUTS,
+            max_retries=settings.AGGREGATOR_MAX_RETRIES,
+            retry_backoff=settings.AGGREGATOR_RETRY_BACKOFF,
+        )
+        _transports[loop] = transport
+    return transport
+
+
+class AsyncUnifiedOrder(UnifiedOrder):
+    async def create_order(self, trader_id: str, amount: int, channel: int, transaction_type: int, name: str, message: str) -> dict:
+        request_data, order = self.build_request(trader_id, amount, channel, transaction_type, name, message)
+        await order.asave()
+        try:
+            resp = await get_async_transport().post("unifiedorder", request_data)
+            logger.info(f"Aggregator /unifiedorder {request_data['OutTradeNo']} returned {resp.status_code}")
+            resp.raise_for_status()
+            return order_response(resp.json(), request_data), resp.status_code
+        except AggregatorUnavailable as e:
+            return unavailable_error(e), 503
+        except httpx.HTTPError as e:
+            return {"error": f"Failed to connect to aggregator: {str(e)}", "OutTradeNo": request_data["OutTradeNo"]}, 503
+        except json.JSONDecodeError:
+            return {"error": "Invalid response from aggregator", "OutTradeNo": request_data["OutTradeNo"]}, 502
+
+
+class AsyncPaymentResults(PaymentResults):
+    async def get_result(self, unique_id: str) -> dict:
+        request_data, get_result = self.build_request(unique_id)
+        await arecord_audit(get_result)
+        try:
+            resp = await get_async_transport().post("orderquery", request_data)
+            resp.raise_for_status()
+            return resp.json(), resp.status_code
+        except AggregatorUnavailable as e:
+            return unavailable_error(e), 503
+        except httpx.HTTPError as e:
+            return {"error": f"Failed to connect to aggregator: {str(e)}"}, 503
+        except json.JSONDecodeError:
+            return {"error": "Invalid response from aggregator"}, 502
+
+
+class AsyncPrepaidBill(PrepaidBill):
+    async def get_bill(self, trader_id: str, amount: int, channel: int, transaction_type: int) -> dict:
+        request_data, get_bill_request = self.build_request(trader_id, amount, channel, transaction_type)
+        await arecord_audit(get_bill_request)
+        try:
+            resp = await get_async_transport().post("bill", request_data)
+            resp.raise_for_status()
+            return resp.json()
+        except AggregatorUnavailable as e:
+            return unavailable_error(e)
+        except httpx.HTTPError as e:
+            return {"error": f"Connection failed: {str(e)}"}
+        except json.JSONDecodeError:
+            return {"error": "Invalid JSON response from aggregator"}
+
+
+class AsyncGetBalance(GetBalance):
+    async def get_balance(self) -> dict:
+        request_data, get_balance_request = self.build_request()
+        await arecord_audit(get_balance_request)
+        try:
+            resp = await get_async_transport().post("balance", request_data)
+            resp.raise_for_status()
+            return resp.json()
+        except AggregatorUnavailable as e:
+            return unavailable_error(e)
+        except httpx.HTTPError as e:
+            return {"error": f"Connection failed: {str(e)}"}
+        except json.JSONDecodeError:
+            return {"error": "Invalid JSON response from aggregator"}
+
+
+class AsyncGetStatementOfAccount(GetStatementOfAccount):
+    async def fetch(self, start_date: str = None, end_date: str = None) -> dict:
+        request_data, fetch = self.build_request(start_date, end_date)
+        await arecord_audit(fetch)
+        try:
+            resp = await get_async_transport().post("statement", request_data)
+            resp.raise_for_status()
+            return resp.json()
+        except AggregatorUnavailable as e:
+            return unavailable_error(e)
+        except httpx.HTTPError as e:
+            return {"error": f"Connection failed: {str(e)}"}
+        except json.JSONDecodeError:
+            return {"error": "Invalid JSON response from aggregator"}
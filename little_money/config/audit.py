@@ -0,0 +1,208 @@
+import atexit
+import logging
+import os
+import threading
+import uuid
+from pathlib import Path
+
+from django.core import serializers
+from django.core.serializers.base import DeserializationError
+from django.db import DataError, IntegrityError, close_old_connections, transaction
+
+from . import base as settings
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class AuditSink:
+    """
+    Buffers aggregator audit rows in memory and writes them with bulk_create.
+
+    Every row is appended to this process's spool segment before it is buffered.
+    A segment is deleted only after its rows are committed, so rows from a crashed
+    process are replayed by the next sink that starts. Delivery is at-least-once:
+    a crash between commit and delete replays that segment again.
+    """
+
+    def __init__(self, spool_dir: str, batch_size: int, flush_interval: float, fsync: bool = False):
+        self.spool_dir = Path(spool_dir)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._segment = None
+        self._wake = threading.Event()
+        self._thread = None
+
+    def add(self, instance):
+        """Spool and buffer an unsaved model instance. Never touches the database."""
+        line = serializers.serialize("json", [instance])
+        with self._lock:
+            if self._segment is None:
+                self._segment = self._open_segment()
+            self._segment.write(line + "\n")
+            self._segment.flush()
+            if self.fsync:
+                os.fsync(self._segment.fileno())
+            self._buffer.append(instance)
+            full = len(self._buffer) >= self.batch_size
+        self._ensure_thread()
+        if full:
+            self._wake.set()
+
+    def flush(self) -> int:
+        """Write all buffered rows. Returns the number of rows written."""
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+            segment, self._segment = self._segment, None
+        if segment is None:
+            return 0
+        try:
+            self._write(batch)
+            # Deleted before close() releases the lock, so no replay() can claim the committed rows.
+            self._unlink(segment.name)
+        finally:
+            # A failed segment stays on disk for replay().
+            segment.close()
+        return len(batch)
+
+    def replay(self) -> int:
+        """Write rows from spool segments no live sink owns, then delete those segments."""
+        replayed = 0
+        for path in sorted(self.spool_dir.glob("*.jsonl")):
+            try:
+                handle = open(path, "r+", encoding="utf-8")
+            except FileNotFoundError:
+                continue
+            with handle:
+                if not self._try_lock(handle) or os.fstat(handle.fileno()).st_nlink == 0:
+                    # Owned by a live sink, or flushed and deleted between open() and the lock.
+                    continue
+                instances = []
+                for line in handle:
+                    if not line.strip():
+                        continue
+                    try:
+                        instances.extend(obj.object for obj in serializers.deserialize("json", line))
+                    except DeserializationError:
+                        logger.warning(f"Skipping unreadable audit spool line in {path.name}")
+                self._write(instances)
+                self._unlink(path)
+            replayed += len(instances)
+        if replayed:
+            logger.info(f"Replayed {replayed} audit rows from spool.")
+        return replayed
+
+    def _write(self, instances):
+        by_model = {}
+        for instance in instances:
+            by_model.setdefault(type(instance), []).append(instance)
+        for model, rows in by_model.items():
+            try:
+                with transaction.atomic():
+                    model.objects.bulk_create(rows)
+            except (IntegrityError, DataError):
+                # One bad row must not block the rest of the batch forever.
+                for row in rows:
+                    try:
+                        with transaction.atomic():
+                            row.save()
+                    except (IntegrityError, DataError) as e:
+                        logger.error(f"Dropping invalid {model.__name__} audit row: {e}")
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _open_segment(self):
+        path = self.spool_dir / f"{os.getpid()}-{uuid.uuid4().hex}.jsonl"
+        handle = open(path, "a", encoding="utf-8")
+        if fcntl:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        return handle
+
+    def _try_lock(self, handle) -> bool:
+        if self._segment is not None and handle.name == self._segment.name:
+            return False
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="audit-sink", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        self._safely(self.replay)
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if not self._safely(self.flush):
+                self._safely(self.replay)
+
+    def _safely(self, func) -> bool:
+        close_old_connections()
+        try:
+            func()
+            return True
+        except Exception:
+            logger.exception("Audit sink write failed; rows remain spooled.")
+            return False
+        finally:
+            close_old_connections()
+
+
+_sink = None
+_sink_pid = None
+_sink_lock = threading.Lock()
+
+
+def get_audit_sink() -> AuditSink:
+    global _sink, _sink_pid
+    pid = os.getpid()
+    if _sink is not None and _sink_pid == pid:
+        return _sink
+    with _sink_lock:
+        if _sink is None or _sink_pid != pid:
+            _sink = AuditSink(
+                spool_dir=settings.AUDIT_SPOOL_DIR,
+                batch_size=settings.AUDIT_BATCH_SIZE,
+                flush_interval=settings.AUDIT_FLUSH_INTERVAL,
+                fsync=settings.AUDIT_SPOOL_FSYNC,
+            )
+            _sink_pid = pid
+            atexit.register(_sink._safely, _sink.flush)
+    return _sink
+
+
+def record_audit(instance):
+    """Persist an aggregator audit row, buffered unless AUDIT_BUFFERED is off."""
+    if settings.AUDIT_BUFFERED:
+        get_audit_sink().add(instance)
+    else:
+        instance.save()
+
+
+async def arecord_audit(instance):
+    if settings.AUDIT_BUFFERED:
+        get_audit_sink().add(instance)
+    else:
+        await instance.asave()
@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+from decimal import Decimal, InvalidOperation
+
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from . import base as settings
+from .aggregator import GetBalance
+
+logger = logging.getLogger(__name__)
+
+# Shared through Django's cache so a webhook in one worker invalidates the
+# balance in every worker when a shared cache backend is configured.
+INVALIDATED_AT_KEY = "aggregator-balance-invalidated-at"
+
+
+class BalanceSnapshot:
+    def __init__(self, response: dict, fetched_at: float):
+        self.response = response
+        self.fetched_at = fetched_at
+
+    @property
+    def balance(self):
+        data = self.response.get("Data") if isinstance(self.response, dict) else None
+        if not isinstance(data, dict) or data.get("Balance") is None:
+            return None
+        try:
+            return Decimal(str(data["Balance"]))
+        except InvalidOperation:
+            return None
+
+    @property
+    def error(self):
+        return self.response.get("error") if isinstance(self.response, dict) else "Invalid balance response"
+
+    @property
+    def age(self) -> float:
+        """Seconds since the aggregator returned this balance."""
+        return time.time() - self.fetched_at
+
+
+class BalanceCache:
+    """
+    Stale-while-revalidate cache in front of GetBalance.
+    get() returns the last snapshot at once and, when it is older than max_age
+    or has been invalidated, refreshes it on a background thread.
+    Only the very first call in a process waits for the aggregator.
+    """
+
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._retry_after = 0
+
+    def get(self) -> BalanceSnapshot:
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = self._fetch()
+                return self._snapshot
+        if self.is_stale(snapshot):
+            self._refresh_in_background()
+        return snapshot
+
+    def invalidate(self):
+        """Mark the balance stale in every worker; the next get() triggers a refresh."""
+        cache.set(INVALIDATED_AT_KEY, time.time(), None)
+
+    def is_stale(self, snapshot: BalanceSnapshot) -> bool:
+        if snapshot.error or snapshot.age > self.max_age:
+            return True
+        return cache.get(INVALIDATED_AT_KEY, 0) >= snapshot.fetched_at
+
+    def _fetch(self) -> BalanceSnapshot:
+        fetched_at = time.time()
+        return BalanceSnapshot(GetBalance().get_balance(), fetched_at)
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing or time.time() < self._retry_after:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, name="balance-refresh", daemon=True).start()
+
+    def _refresh(self):
+        close_old_connections()
+        try:
+            snapshot = self._fetch()
+            if snapshot.error and self._snapshot and not self._snapshot.error:
+                logger.warning(f"Balance refresh failed, keeping previous value: {snapshot.error}")
+                self._retry_after = time.time() + self.max_age
+            else:
+                self._snapshot = snapshot
+        except Exception:
+            logger.exception("Balance refresh failed")
+            self._retry_after = time.time() + self.max_age
+        finally:
+            self._refreshing = False
+            close_old_connections()
+
+
+balance_cache = BalanceCache(max_age=settings.BALANCE_CACHE_MAX_AGE)
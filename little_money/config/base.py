@@ -33,4 +33,156 @@ if not MAILCOW_ADMIN_PASSWORD:
     raise ValueError("AILCOW_ADMIN_PASSWORD is required but not set.")
 MAILCOW_API_KEY = os.getenv("MAILCOW_API_KEY")
 if not MAILCOW_API_KEY:
-    raise ValueError("MAILCOW_API_KEY is required but not set.")
\ No newline at end of file
+    raise ValueError("MAILCOW_API_KEY is required but not set.")
+
+# Outbound aggregator transport. The connection pool is sized to the number of
+# gunicorn threads so every request thread can hold a warm keep-alive socket.
+AGGREGATOR_POOL_MAXSIZE = int(os.getenv("AGGREGATOR_POOL_MAXSIZE", os.getenv("GUNICORN_THREADS", "4")))
+AGGREGATOR_CONNECT_TIMEOUT = float(os.getenv("AGGREGATOR_CONNECT_TIMEOUT", "3.05"))
+AGGREGATOR_MAX_RETRIES = int(os.getenv("AGGREGATOR_MAX_RETRIES", "2"))
+AGGREGATOR_RETRY_BACKOFF = float(os.getenv("AGGREGATOR_RETRY_BACKOFF", "0.2"))
+# Read timeouts (seconds) per aggregator endpoint.
+AGGREGATOR_READ_TIMEOUTS = {
+    "bill": float(os.getenv("AGGREGATOR_BILL_TIMEOUT", "10")),
+    "unifiedorder": float(os.getenv("AGGREGATOR_UNIFIEDORDER_TIMEOUT", "10")),
+    "orderquery": float(os.getenv("AGGREGATOR_ORDERQUERY_TIMEOUT", "10")),
+    "balance": float(os.getenv("AGGREGATOR_BALANCE_TIMEOUT", "10")),
+    "statement": float(os.getenv("AGGREGATOR_STATEMENT_TIMEOUT", "30")),
+}
+# Upper bound on concurrent sockets held by the asyncio aggregator client in one ASGI worker.
+AGGREGATOR_ASYNC_MAX_CONNECTIONS = int(os.getenv("AGGREGATOR_ASYNC_MAX_CONNECTIONS", "200"))
+
+# Aggregator audit rows (bill/query/balance/statement requests and responses) are
+# buffered and written with bulk_create. Each row is first appended to a local
+# spool segment that is replayed if the process dies before the flush.
+AUDIT_BUFFERED = os.getenv("AUDIT_BUFFERED", "True") == "True"
+AUDIT_SPOOL_DIR = os.getenv("AUDIT_SPOOL_DIR", str(BASE_DIR / "audit_spool"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "200"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "2"))
+AUDIT_SPOOL_FSYNC = os.getenv("AUDIT_SPOOL_FSYNC", "False") == "True"
+
+# /bill service-charge quotes are cached per (channel, transaction type, amount
+# bucket[, trader]). Amounts are in the aggregator's minor units; a bucket of 1
+# only reuses quotes for identical amounts.
+QUOTE_CACHE_TTL = float(os.getenv("QUOTE_CACHE_TTL", "300"))
+QUOTE_CACHE_MAX_ENTRIES = int(os.getenv("QUOTE_CACHE_MAX_ENTRIES", "1024"))
+QUOTE_CACHE_AMOUNT_BUCKET = int(os.getenv("QUOTE_CACHE_AMOUNT_BUCKET", "1"))
+QUOTE_CACHE_PER_TRADER = os.getenv("QUOTE_CACHE_PER_TRADER", "False") == "True"
+
+# Merchant balance is served from a per-process cache and refreshed in the
+# background once it is older than this many seconds.
+BALANCE_CACHE_MAX_AGE = float(os.getenv("BALANCE_CACHE_MAX_AGE", "15"))
+
+# Statement sync fetches one day per /statement call with this many concurrent workers.
+STATEMENT_SYNC_WORKERS = int(os.getenv("STATEMENT_SYNC_WORKERS", "4"))
+
+# Per-endpoint circuit breaker: opens when at least FAILURE_RATE of the last WINDOW
+# calls (and no fewer than MIN_CALLS) failed or took longer than SLOW_CALL seconds,
+# then lets a single probe through after OPEN_SECONDS.
+AGGREGATOR_BREAKER_FAILURE_RATE = float(os.getenv("AGGREGATOR_BREAKER_FAILURE_RATE", "0.5"))
+AGGREGATOR_BREAKER_WINDOW = int(os.getenv("AGGREGATOR_BREAKER_WINDOW", "20"))
+AGGREGATOR_BREAKER_MIN_CALLS = int(os.getenv("AGGREGATOR_BREAKER_MIN_CALLS", "10"))
+AGGREGATOR_BREAKER_SLOW_CALL = float(os.getenv("AGGREGATOR_BREAKER_SLOW_CALL", "5"))
+AGGREGATOR_BREAKER_OPEN_SECONDS = float(os.getenv("AGGREGATOR_BREAKER_OPEN_SECONDS", "30"))
+# AIMD concurrency limit per endpoint and process. Calls over the limit fail fast
+# with a 503 instead of queueing behind a slow aggregator.
+AGGREGATOR_LIMIT_INITIAL = int(os.getenv("AGGREGATOR_LIMIT_INITIAL", "10"))
+AGGREGATOR_LIMIT_MIN = int(os.getenv("AGGREGATOR_LIMIT_MIN", "1"))
+AGGREGATOR_LIMIT_MAX = int(os.getenv("AGGREGATOR_LIMIT_MAX", "200"))
+AGGREGATOR_LIMIT_LATENCY_TARGET = float(os.getenv("AGGREGATOR_LIMIT_LATENCY_TARGET", "2"))
+
+# Background order-status reconciler (manage.py reconcile_orders). Unresolved orders
+# are first queried INITIAL_DELAY seconds after submission, giving the webhook a
+# chance to arrive, then with exponential backoff from BASE_DELAY up to MAX_DELAY.
+RECONCILER_INITIAL_DELAY = float(os.getenv("RECONCILER_INITIAL_DELAY", "30"))
+RECONCILER_BASE_DELAY = float(os.getenv("RECONCILER_BASE_DELAY", "15"))
+RECONCILER_MAX_DELAY = float(os.getenv("RECONCILER_MAX_DELAY", "600"))
+RECONCILER_MAX_ATTEMPTS = int(os.getenv("RECONCILER_MAX_ATTEMPTS", "30"))
+RECONCILER_CONCURRENCY = int(os.getenv("RECONCILER_CONCURRENCY", "8"))
+RECONCILER_BATCH_SIZE = int(os.getenv("RECONCILER_BATCH_SIZE", "100"))
+RECONCILER_POLL_INTERVAL = float(os.getenv("RECONCILER_POLL_INTERVAL", "5"))
+
+# Log the string-to-sign and both signatures for every verified webhook (debug only).
+SIGNATURE_DEBUG = os.getenv("SIGNATURE_DEBUG", "False") == "True"
+
+# Bulk disbursement uploads (manage.py process_disbursements). Rows are saved in
+# chunks of PARSE_CHUNK while the workbook streams, then dispatched WORKERS at a
+# time. A row shed by the aggregator guard is retried up to MAX_RETRIES times, and
+# a batch whose worker has not heartbeated for STALE_AFTER seconds is requeued.
+DISBURSEMENT_WORKERS = int(os.getenv("DISBURSEMENT_WORKERS", "8"))
+DISBURSEMENT_PARSE_CHUNK = int(os.getenv("DISBURSEMENT_PARSE_CHUNK", "500"))
+DISBURSEMENT_MAX_RETRIES = int(os.getenv("DISBURSEMENT_MAX_RETRIES", "3"))
+DISBURSEMENT_STALE_AFTER = float(os.getenv("DISBURSEMENT_STALE_AFTER", "300"))
+DISBURSEMENT_POLL_INTERVAL = float(os.getenv("DISBURSEMENT_POLL_INTERVAL", "5"))
+
+# Idempotency keys for payment initiation. A repeated key replays the first
+# response for TTL seconds; keys derived from the request itself (no key sent)
+# only cover DERIVED_WINDOW seconds, enough to absorb a double submit. A duplicate
+# waits up to WAIT_TIMEOUT seconds for the original to finish. An original that
+# has not finished after LEASE seconds (its worker died) is taken over by the next
+# duplicate, so keep it above the slowest quote-and-submit round trip.
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_DERIVED_WINDOW = float(os.getenv("IDEMPOTENCY_DERIVED_WINDOW", "60"))
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT", "60"))
+IDEMPOTENCY_POLL_INTERVAL = float(os.getenv("IDEMPOTENCY_POLL_INTERVAL", "0.2"))
+IDEMPOTENCY_LEASE = float(os.getenv("IDEMPOTENCY_LEASE", "120"))
+
+# Order submission queue (manage.py run_payment_jobs). A job that fails with a 5xx
+# or is shed by the aggregator guard is retried with exponential backoff from
+# RETRY_BASE_DELAY up to RETRY_MAX_DELAY, at most MAX_ATTEMPTS times. A claimed
+# job is leased for LEASE seconds; one still running after that is marked unknown.
+PAYMENT_JOB_WORKERS = int(os.getenv("PAYMENT_JOB_WORKERS", "4"))
+PAYMENT_JOB_MAX_ATTEMPTS = int(os.getenv("PAYMENT_JOB_MAX_ATTEMPTS", "5"))
+PAYMENT_JOB_RETRY_BASE_DELAY = float(os.getenv("PAYMENT_JOB_RETRY_BASE_DELAY", "5"))
+PAYMENT_JOB_RETRY_MAX_DELAY = float(os.getenv("PAYMENT_JOB_RETRY_MAX_DELAY", "300"))
+PAYMENT_JOB_LEASE = float(os.getenv("PAYMENT_JOB_LEASE", "120"))
+PAYMENT_JOB_POLL_INTERVAL = float(os.getenv("PAYMENT_JOB_POLL_INTERVAL", "1"))
+
+# Webhook ingestion. With WEBHOOK_DEFERRED the handler only stores the verified
+# body and answers SUCCESS; manage.py process_webhooks applies it in order per
+# OutTradeNo. A notification that fails is retried with backoff from
+# RETRY_BASE_DELAY to RETRY_MAX_DELAY seconds, at most MAX_ATTEMPTS times.
+# WEBHOOK_COALESCE applies each claimed batch in one transaction, summing the
+# balance changes so every client, staff and system row is written once.
+WEBHOOK_DEFERRED = os.getenv("WEBHOOK_DEFERRED", "True") == "True"
+WEBHOOK_COALESCE = os.getenv("WEBHOOK_COALESCE", "True") == "True"
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "100"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "10"))
+WEBHOOK_RETRY_BASE_DELAY = float(os.getenv("WEBHOOK_RETRY_BASE_DELAY", "5"))
+WEBHOOK_RETRY_MAX_DELAY = float(os.getenv("WEBHOOK_RETRY_MAX_DELAY", "300"))
+WEBHOOK_LEASE = float(os.getenv("WEBHOOK_LEASE", "60"))
+WEBHOOK_POLL_INTERVAL = float(os.getenv("WEBHOOK_POLL_INTERVAL", "0.5"))
+
+# Order numbers each process remembers as settled, so repeated notifications for
+# them are acknowledged without touching the database. Settled orders are also
+# kept in the Django cache for SHARED_TTL seconds, so with a shared cache backend
+# the web process drops redeliveries of orders a webhook worker settled.
+FINALIZED_ORDER_CACHE_SIZE = int(os.getenv("FINALIZED_ORDER_CACHE_SIZE", "10000"))
+FINALIZED_ORDER_SHARED_TTL = float(os.getenv("FINALIZED_ORDER_SHARED_TTL", "86400"))
+
+# OutTradeNo generation. Each process leases a node number (0-1023) from the
+# IdNode table on first use and renews it in the background; IDs are then made
+# in-process with no coordination. Set OUT_TRADE_NO_NODE_ID to pin a number
+# instead (it must be unique across every running process).
+OUT_TRADE_NO_NODE_ID = int(os.getenv("OUT_TRADE_NO_NODE_ID")) if os.getenv("OUT_TRADE_NO_NODE_ID") else None
+OUT_TRADE_NO_NODE_LEASE = float(os.getenv("OUT_TRADE_NO_NODE_LEASE", "600"))
+
+# Sequential ids (RecentTransaction.transaction_id, MP transaction codes) are
+# reserved from core.TransactionIDCounter this many at a time per process.
+ID_BLOCK_SIZE = int(os.getenv("ID_BLOCK_SIZE", "1000"))
+
+# SystemEarnings is striped over this many rows, each payment incrementing a
+# random one. Dashboards may read a cached sum up to SYSTEM_EARNINGS_CACHE_SECONDS old.
+SYSTEM_EARNINGS_SHARDS = int(os.getenv("SYSTEM_EARNINGS_SHARDS", "16"))
+SYSTEM_EARNINGS_CACHE_SECONDS = float(os.getenv("SYSTEM_EARNINGS_CACHE_SECONDS", "30"))
+
+# Ledger snapshots fold in postings older than this many seconds, so a slow
+# transaction whose postings carry an earlier timestamp has committed by then.
+LEDGER_SNAPSHOT_LAG = float(os.getenv("LEDGER_SNAPSHOT_LAG", "300"))
+
+# A disbursement reserves its amount from the client's balance before it is
+# submitted. Holds the webhook or reconciler has not settled within this many
+# seconds are released by the reconciler, so the longest reconcile window
+# (RECONCILER_MAX_ATTEMPTS at up to RECONCILER_MAX_DELAY) should fit inside it.
+BALANCE_HOLD_TTL = float(os.getenv("BALANCE_HOLD_TTL", "86400"))
@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+from . import base as settings
+
+
+class FinalizedOrderCache:
+    """
+    Bounded LRU of order numbers (OutTradeNo) that reached a final status, and that status.
+
+    Sits in front of the database so repeated notifications for an order this
+    process already settled are answered without a query. Only ever a shortcut:
+    a miss falls through to the database, which stays the source of truth.
+
+    With shared_prefix, settled orders are also written to the Django cache and a
+    local miss is looked up there, so the web process knows what a process_webhooks
+    worker settled when a shared cache backend is configured.
+    """
+
+    def __init__(self, max_entries: int, shared_prefix: str = None):
+        self.max_entries = max_entries
+        self.shared_prefix = shared_prefix
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, out_trade_no: str):
+        with self._lock:
+            status = self._entries.get(out_trade_no)
+            if status is not None:
+                self._entries.move_to_end(out_trade_no)
+                self.hits += 1
+                return status
+        status = cache.get(self.shared_prefix + out_trade_no) if self.shared_prefix else None
+        with self._lock:
+            if status is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.shared_hits += 1
+            self._store(out_trade_no, status)
+            return status
+
+    def __contains__(self, out_trade_no: str) -> bool:
+        return self.get(out_trade_no) is not None
+
+    def put(self, out_trade_no: str, status: str):
+        with self._lock:
+            self._store(out_trade_no, status)
+        if self.shared_prefix:
+            cache.set(self.shared_prefix + out_trade_no, status, settings.FINALIZED_ORDER_SHARED_TTL)
+
+    def _store(self, out_trade_no: str, status: str):
+        self._entries[out_trade_no] = status
+        self._entries.move_to_end(out_trade_no)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+finalized_orders = FinalizedOrderCache(max_entries=settings.FINALIZED_ORDER_CACHE_SIZE, shared_prefix="finalized-order:")
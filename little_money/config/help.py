@@ -1,144 +1,282 @@
 from decimal import Decimal
+import math
+from asgiref.sync import sync_to_async
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 from django.http import JsonResponse
-from django.db import transaction # Import transaction
-from .models import PrepaidBillResponse, UnifiedOrderResponse, OrderQueryResponse
-from .aggregator import PaymentResults, PrepaidBill, UnifiedOrder
+from .models import PrepaidBillResponse, UnifiedOrderResponse
+from .audit import arecord_audit, record_audit
+from .idempotency import arun_idempotent, fingerprint, retryable, run_idempotent
+from .order_status import FAILED, PENDING
+from .aggregator import UnifiedOrder
+from .async_aggregator import AsyncUnifiedOrder
+from .quote_cache import aget_bill_quote, get_bill_quote
+from .reconciler import first_reconcile_at
+from . import base as settings
+from clients.holds import attach_hold
 from clients.models import Client
 from finance.models import SystemEarnings
+import logging
 import time
 
-def process_transaction(channel: int, t_type: int, client_id: int, base_amount: int, trader_id: str, message: str, name: str):
+logger = logging.getLogger(__name__)
+
+
+def _bill_response_obj(bill_response: dict, data: dict, trader_id: str, name: str, base_amount_decimal: Decimal) -> PrepaidBillResponse:
+    return PrepaidBillResponse(
+        status_code=bill_response.get("StatusCode", 0),
+        succeeded=bill_response.get("Succeeded"),
+        errors=bill_response.get("Errors"),
+        extras=bill_response.get("Extras"),
+        timestamp=bill_response.get("Timestamp", int(time.time())),
+        trader_id=data.get("TraderID", trader_id),
+        full_name=data.get("FullName", name),
+        amount=base_amount_decimal,
+        service_charge=Decimal(str(data.get("ServiceCharge", '0.00'))),
+        service_charge_rate=Decimal(str(data.get("ServiceChargeRate", '0.00'))),
+    )
+
+
+def _order_rejected(unifiedorder_response: dict) -> bool:
+    # The aggregator answered and refused the order, so nothing was sent. Without a StatusCode
+    # the call itself failed and the order may still have gone out.
+    return "StatusCode" in unifiedorder_response and unifiedorder_response["StatusCode"] != 200
+
+
+def _unified_order_response_obj(unifiedorder_response: dict, base_amount_decimal: Decimal, client: Client) -> UnifiedOrderResponse:
+    # create_order always reports the OutTradeNo it sent; a failed or rejected submission has no Data.
+    order_data = unifiedorder_response.get("Data") or {}
+    rejected = _order_rejected(unifiedorder_response)
+    return UnifiedOrderResponse(
+        status_code=unifiedorder_response.get("StatusCode", 0),
+        succeeded=unifiedorder_response.get("Succeeded", False),
+        errors=unifiedorder_response.get("Errors") or unifiedorder_response.get("error"),
+        extras=unifiedorder_response.get("Extras"),
+        timestamp=unifiedorder_response.get("Timestamp", int(time.time())),
+        status=FAILED if rejected else PENDING,
+        out_trade_no=unifiedorder_response["OutTradeNo"],
+        transaction_id=order_data.get("TransactionId", ""),
+        amount=Decimal(str(order_data.get("Amount", base_amount_decimal))),
+        actual_payment_amount=Decimal(str(order_data.get("ActualPaymentAmount", base_amount_decimal))), # Consistent
+        actual_collect_amount=Decimal(str(order_data.get("ActualCollectAmount", base_amount_decimal))), # Consistent
+        payer_charge=Decimal(str(order_data.get("PayerCharge", '0.00'))),
+        payee_charge=Decimal(str(order_data.get("Payee_Charge", '0.00'))),
+        channel_charge=Decimal(str(order_data.get("ChannelCharge", '0.00'))),
+        client=client,
+        next_reconcile_at=None if rejected else first_reconcile_at()
+    )
+
+
+def _save_order(unified_order_resp_obj: UnifiedOrderResponse, hold_id: int = None):
+    # The hold is tied to the order in the same transaction, so a webhook that finds the order also finds its hold.
+    # A rejected order keeps no hold: the caller releases it as unused.
+    with transaction.atomic():
+        unified_order_resp_obj.save()
+        if hold_id and unified_order_resp_obj.status != FAILED:
+            attach_hold(hold_id, unified_order_resp_obj.out_trade_no)
+
+
+def _rejected_response(unified_order_resp_obj: UnifiedOrderResponse) -> JsonResponse:
+    logger.warning(f"Unified order {unified_order_resp_obj.out_trade_no} rejected: {unified_order_resp_obj.errors}")
+    return JsonResponse({
+        "status": "error",
+        "message": unified_order_resp_obj.errors or "The payment provider rejected the order."
+    }, status=400)
+
+
+def _unavailable_response(error: dict) -> JsonResponse:
+    # The call was shed before reaching the aggregator; tell the caller when to come back.
+    response = JsonResponse({"status": "error", "message": error["error"], "retry_after": error["retry_after"]}, status=503)
+    response["Retry-After"] = str(max(1, math.ceil(error["retry_after"])))
+    return retryable(response)
+
+
+def _pending_response() -> JsonResponse:
+    return JsonResponse({
+        "status": "pending",
+        "message": "Transaction submitted. Its final status will be confirmed by the payment provider."
+    }, status=202)
+
+
+def _record_system_earnings(transaction_succeeded: bool):
+    # One increment on a random shard; no read, so concurrent orders cannot lose each other's counts.
+    SystemEarnings.add(
+        total_transactions=1, # Increment for every transaction attempt
+        total_successful_transactions=1 if transaction_succeeded else 0,
+    )
+
+
+def _idempotency_key(idempotency_key, request_hash: str, client_id: int) -> tuple:
+    """Scope the caller's key to the client, or derive a short-lived one from the request itself."""
+    if idempotency_key:
+        return f"{client_id}:{idempotency_key}", settings.IDEMPOTENCY_TTL
+    return f"{client_id}:derived:{request_hash}", settings.IDEMPOTENCY_DERIVED_WINDOW
+
+
+def process_transaction(channel: int, t_type: int, client_id: int, base_amount: int, trader_id: str, message: str, name: str, revalidate_trader: bool = False, idempotency_key: str = None, hold_id: int = None):
+    """
+    Quote and submit one order. Repeats of the same idempotency key (or of an
+    identical request within IDEMPOTENCY_DERIVED_WINDOW when no key is given)
+    get the first response back instead of a second order.
+    """
+    request_hash = fingerprint(channel=channel, t_type=t_type, client_id=client_id, base_amount=base_amount, trader_id=trader_id)
+    key, ttl = _idempotency_key(idempotency_key, request_hash, client_id)
+    return run_idempotent(
+        key, request_hash,
+        lambda: _process_transaction(channel, t_type, client_id, base_amount, trader_id, message, name, revalidate_trader, hold_id),
+        ttl=ttl,
+    )
+
+
+def _process_transaction(channel: int, t_type: int, client_id: int, base_amount: int, trader_id: str, message: str, name: str, revalidate_trader: bool = False, hold_id: int = None):
+    submitted = False
     try:
         client = get_object_or_404(Client, id=client_id)
         base_amount_decimal = Decimal(base_amount) # Convert to Decimal early
 
-        # --- PrepaidBill Logic ---
-        bill = PrepaidBill()
-        bill_response = bill.get_bill(
+        # --- PrepaidBill Logic (served from the quote cache unless the trader must be re-validated) ---
+        bill_response = get_bill_quote(
             trader_id=trader_id,
             amount=int(base_amount_decimal * 100), # Use decimal version for multiplication
             channel=channel,
-            transaction_type=t_type
+            transaction_type=t_type,
+            bypass_cache=revalidate_trader
         )
 
+        if bill_response.get("unavailable"):
+            return _unavailable_response(bill_response)
         if "error" in bill_response:
-            return JsonResponse({"status": "error", "message": bill_response["error"]}, status=500)
+            return retryable(JsonResponse({"status": "error", "message": bill_response["error"]}, status=500))
 
         data = bill_response.get("Data")
         if not isinstance(data, dict):
-            return JsonResponse({
+            return retryable(JsonResponse({
                 "status": "error",
                 "message": "Invalid or missing 'Data' in bill response."
-            }, status=500)
-
-        prepaid_bill_resp_obj = PrepaidBillResponse(
-            status_code=bill_response.get("StatusCode", 0),
-            succeeded=bill_response.get("Succeeded"),
-            errors=bill_response.get("Errors"),
-            extras=bill_response.get("Extras"),
-            timestamp=bill_response.get("Timestamp", int(time.time())),
-            trader_id=data.get("TraderID", trader_id),
-            full_name=data.get("FullName", name),
-            amount=base_amount_decimal,
-            service_charge=Decimal(str(data.get("ServiceCharge", '0.00'))),
-            service_charge_rate=Decimal(str(data.get("ServiceChargeRate", '0.00'))),
-        )
-        prepaid_bill_resp_obj.save()
+            }, status=500))
+
+        prepaid_bill_resp_obj = _bill_response_obj(bill_response, data, trader_id, name, base_amount_decimal)
+        record_audit(prepaid_bill_resp_obj)
 
         if prepaid_bill_resp_obj.status_code != 200:
             error_message = prepaid_bill_resp_obj.errors or "Bill request failed with unknown error."
             return JsonResponse({"status": "error", "message": error_message}, status=400)
 
         # --- UnifiedOrder Logic ---
+        submitted = True  # from here on the order may reach the aggregator
         unifiedorder = UnifiedOrder()
         unifiedorder_response, _ = unifiedorder.create_order( # status_code is returned but not used
             trader_id=trader_id,
             amount=int(base_amount_decimal * 100), # Use decimal version
             channel=channel,
             transaction_type=t_type,
-            name=data.get("FullName"),
+            name=data.get("FullName", name),
             message=message
         )
-        print(f"order_response: {unifiedorder_response}")
-
-        unified_order_resp_obj = UnifiedOrderResponse(
-            status_code=unifiedorder_response.get("StatusCode", 0),
-            succeeded=unifiedorder_response.get("Succeeded", False),
-            errors=unifiedorder_response.get("Errors"),
-            extras=unifiedorder_response.get("Extras"),
-            timestamp=unifiedorder_response.get("Timestamp", int(time.time())),
-            status = "pending",
-            out_trade_no=unifiedorder_response["Data"].get("OutTradeNo", "100000006"),
-            transaction_id=unifiedorder_response["Data"].get("TransactionId", "100000006"),
-            amount=Decimal(str(unifiedorder_response["Data"].get("Amount", base_amount_decimal))),
-            actual_payment_amount=Decimal(str(unifiedorder_response["Data"].get("ActualPaymentAmount", base_amount_decimal))), # Consistent
-            actual_collect_amount=Decimal(str(unifiedorder_response["Data"].get("ActualCollectAmount", base_amount_decimal))), # Consistent
-            payer_charge=Decimal(str(unifiedorder_response["Data"].get("PayerCharge", '0.00'))),
-            payee_charge=Decimal(str(unifiedorder_response["Data"].get("Payee_Charge", '0.00'))),
-            channel_charge=Decimal(str(unifiedorder_response["Data"].get("ChannelCharge", '0.00'))),
-            client=client
+        if unifiedorder_response.get("unavailable"):
+            return _unavailable_response(unifiedorder_response)
+
+        unified_order_resp_obj = _unified_order_response_obj(unifiedorder_response, base_amount_decimal, client)
+        _save_order(unified_order_resp_obj, hold_id)
+
+        if unified_order_resp_obj.status == FAILED:
+            _record_system_earnings(False)
+            return _rejected_response(unified_order_resp_obj)
+
+        if unified_order_resp_obj.status_code != 200:
+            # The order may still have reached the aggregator; the reconciler (manage.py reconcile_orders) resolves it.
+            logger.warning(f"Unified order {unified_order_resp_obj.out_trade_no} was not confirmed; leaving it to the reconciler.")
+            return _pending_response()
+
+        logger.info(f"Unified order {unified_order_resp_obj.out_trade_no} accepted.")
+        _record_system_earnings(True)
+
+        return JsonResponse({"status": "success"})
+
+    except Exception as e:
+        logger.exception(f"Transaction for client {client_id} failed: {e}")
+        if submitted:
+            # A retry could pay twice; the webhook or the reconciler settles whatever went out.
+            return _pending_response()
+        return retryable(JsonResponse({"status": "error", "message": str(e)}, status=500))
+
+
+async def aprocess_transaction(channel: int, t_type: int, client_id: int, base_amount: int, trader_id: str, message: str, name: str, revalidate_trader: bool = False, idempotency_key: str = None, hold_id: int = None):
+    """
+    asyncio version of process_transaction for ASGI views.
+    Aggregator calls are awaited, so the worker serves other requests while they are in flight.
+    """
+    request_hash = fingerprint(channel=channel, t_type=t_type, client_id=client_id, base_amount=base_amount, trader_id=trader_id)
+    key, ttl = _idempotency_key(idempotency_key, request_hash, client_id)
+    return await arun_idempotent(
+        key, request_hash,
+        lambda: _aprocess_transaction(channel, t_type, client_id, base_amount, trader_id, message, name, revalidate_trader, hold_id),
+        ttl=ttl,
+    )
+
+
+async def _aprocess_transaction(channel: int, t_type: int, client_id: int, base_amount: int, trader_id: str, message: str, name: str, revalidate_trader: bool = False, hold_id: int = None):
+    submitted = False
+    try:
+        client = await sync_to_async(get_object_or_404)(Client, id=client_id)
+        base_amount_decimal = Decimal(base_amount)
+
+        bill_response = await aget_bill_quote(
+            trader_id=trader_id,
+            amount=int(base_amount_decimal * 100),
+            channel=channel,
+            transaction_type=t_type,
+            bypass_cache=revalidate_trader
         )
-        print("Unified order response:",unified_order_resp_obj)
-        unified_order_resp_obj.save()
 
-        transaction_succeeded = False # Flag to track overall success for system earnings
-
-        if unified_order_resp_obj.status_code == 200:
-            print("Unified order API call succeeded immediately.")
-            transaction_succeeded = True
-        else:
-            print("Unified order API call failed initially. Attempting retry via query...")
-            max_attempts = 3
-            attempt = 0
-            query_response = None
-            while attempt < max_attempts:
-                query_result = PaymentResults()
-                query_response = query_result.get_result(unified_order_resp_obj.out_trade_no) # Use saved OutTradeNo
-                if query_response and query_response.get("StatusCode") == 200 and query_response.get("Succeeded"):
-                    transaction_succeeded = True
-                    break
-                attempt += 1
-                time.sleep(1)
-
-            order_query_resp_obj = OrderQueryResponse(
-                status_code=query_response.get("StatusCode") if query_response else 0,
-                succeeded=query_response.get("Succeeded", False) if query_response else False,
-                errors=query_response.get("Errors") if query_response else "No query response",
-                extras=query_response.get("Extras") if query_response else {},
-                timestamp=query_response.get("Timestamp", int(time.time())) if query_response else int(time.time()),
-                pay_status=query_response["Data"].get("PayStatus") if query_response and "Data" in query_response else None,
-                pay_time=query_response["Data"].get("PayTime") if query_response and "Data" in query_response else None,
-                out_trade_no=query_response["Data"].get("OutTradeNo", unified_order_resp_obj.out_trade_no) if query_response and "Data" in query_response else unified_order_resp_obj.out_trade_no,
-                transaction_id=query_response["Data"].get("TransactionId", "100000006") if query_response and "Data" in query_response else "100000006",
-                amount=Decimal(str(query_response["Data"].get("Amount", base_amount_decimal))) if query_response and "Data" in query_response else base_amount_decimal,
-                actual_payment_amount=Decimal(str(query_response["Data"].get("ActualPaymentAmount", base_amount_decimal))) if query_response and "Data" in query_response else base_amount_decimal,
-                actual_collect_amount=Decimal(str(query_response["Data"].get("ActualCollectAmount", base_amount_decimal))) if query_response and "Data" in query_response else base_amount_decimal,
-                payer_charge=Decimal(str(query_response["Data"].get("PayerCharge", '0.00'))) if query_response and "Data" in query_response else Decimal('0.00'),
-                payee_charge=Decimal(str(query_response["Data"].get("PayeeCharge", '0.00'))) if query_response and "Data" in query_response else Decimal('0.00'),
-                pay_message=query_response["Data"].get("PayMessage", "") if query_response and "Data" in query_response else ""
-            )
-            order_query_resp_obj.save()
-
-            if not transaction_succeeded: # If still not succeeded after retries
-                return JsonResponse({"status": "error", "message": order_query_resp_obj.errors or "Transaction failed after multiple attempts."}, status=400)
-
-
-        # --- System Earnings Update (Atomic) ---
-        with transaction.atomic():
-            system = SystemEarnings.load() # Reload inside atomic block to get freshest data
-            system.total_transactions += 1 # Increment for every transaction attempt
-            if transaction_succeeded:
-                system.total_successful_transactions += 1
-                # total_volume and total_earnings would be updated here if they are part of this function's scope.
-                # As per your simplification, they are not, which is fine.
-            system.save()
+        if bill_response.get("unavailable"):
+            return _unavailable_response(bill_response)
+        if "error" in bill_response:
+            return retryable(JsonResponse({"status": "error", "message": bill_response["error"]}, status=500))
+
+        data = bill_response.get("Data")
+        if not isinstance(data, dict):
+            return retryable(JsonResponse({
+                "status": "error",
+                "message": "Invalid or missing 'Data' in bill response."
+            }, status=500))
+
+        prepaid_bill_resp_obj = _bill_response_obj(bill_response, data, trader_id, name, base_amount_decimal)
+        await arecord_audit(prepaid_bill_resp_obj)
+
+        if prepaid_bill_resp_obj.status_code != 200:
+            error_message = prepaid_bill_resp_obj.errors or "Bill request failed with unknown error."
+            return JsonResponse({"status": "error", "message": error_message}, status=400)
+
+        submitted = True  # from here on the order may reach the aggregator
+        unifiedorder_response, _ = await AsyncUnifiedOrder().create_order(
+            trader_id=trader_id,
+            amount=int(base_amount_decimal * 100),
+            channel=channel,
+            transaction_type=t_type,
+            name=data.get("FullName", name),
+            message=message
+        )
+        if unifiedorder_response.get("unavailable"):
+            return _unavailable_response(unifiedorder_response)
+
+        unified_order_resp_obj = _unified_order_response_obj(unifiedorder_response, base_amount_decimal, client)
+        await sync_to_async(_save_order)(unified_order_resp_obj, hold_id)
+
+        if unified_order_resp_obj.status == FAILED:
+            await sync_to_async(_record_system_earnings)(False)
+            return _rejected_response(unified_order_resp_obj)
+
+        if unified_order_resp_obj.status_code != 200:
+            return _pending_response()
+
+        await sync_to_async(_record_system_earnings)(True)
 
         return JsonResponse({"status": "success"})
 
     except Exception as e:
-        print(f"An error occurred: {e}")
-        # Consider logging the full traceback here for debugging in production
-        # import traceback
-        # traceback.print_exc()
-        return JsonResponse({"status": "error", "message": str(e)}, status=500)
\ No newline at end of file
+        logger.exception(f"Transaction for client {client_id} failed: {e}")
+        if submitted:
+            # A retry could pay twice; the webhook or the reconciler settles whatever went out.
+            return _pending_response()
+        return retryable(JsonResponse({"status": "error", "message": str(e)}, status=500))
@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.http import JsonResponse
+from django.utils import timezone
+
+from . import base as settings
+from .models import IdempotencyRecord
+
+# Header set on a response that was replayed from an earlier request with the same key.
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+# Keys being executed by this process, so local duplicates wake as soon as the
+# original finishes instead of polling the database.
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def fingerprint(**params) -> str:
+    """Stable hash of the request parameters a key is bound to."""
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _claim(key: str, request_hash: str, ttl: float):
+    """
+    Insert an in-progress record for key, leased for IDEMPOTENCY_LEASE seconds.
+    Returns (record, owned): owned is True if this caller inserted it and must run
+    the request. A record whose ttl, or in-progress lease, ran out is replaced.
+    """
+    while True:
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                IdempotencyRecord.objects.filter(key=key, expires_at__lte=now).delete()
+                record = IdempotencyRecord.objects.create(
+                    key=key, fingerprint=request_hash,
+                    expires_at=now + timedelta(seconds=min(ttl, settings.IDEMPOTENCY_LEASE)),
+                )
+        except IntegrityError:
+            record = IdempotencyRecord.objects.filter(key=key).first()
+            if record is None:
+                continue  # Finished with a 5xx or abandoned between our insert and this read.
+            return record, False
+        with _in_flight_lock:
+            _in_flight[key] = threading.Event()
+        return record, True
+
+
+def retryable(response: JsonResponse) -> JsonResponse:
+    """
+    Mark a response returned before anything was submitted (shed, or the quote
+    failed). run_idempotent forgets its key instead of storing it, so a retry
+    runs the request again.
+    """
+    response.idempotency_retryable = True
+    return response
+
+
+def _finish(record: IdempotencyRecord, response: JsonResponse, ttl: float):
+    # Filtered on the record's id: if the lease ran out and another request took
+    # the key over, this one must not overwrite or delete that request's record.
+    if getattr(response, "idempotency_retryable", False):
+        IdempotencyRecord.objects.filter(pk=record.pk, status="in_progress").delete()
+    else:
+        # Kept even for a 5xx: without the retryable() marker the order may have gone out.
+        IdempotencyRecord.objects.filter(pk=record.pk).update(
+            status="completed",
+            response_status=response.status_code,
+            response_body=json.loads(response.content),
+            expires_at=record.created_at + timedelta(seconds=ttl),
+        )
+    _release(record.key)
+
+
+def _abandon(record: IdempotencyRecord):
+    IdempotencyRecord.objects.filter(pk=record.pk, status="in_progress").delete()
+    _release(record.key)
+
+
+def _release(key: str):
+    with _in_flight_lock:
+        event = _in_flight.pop(key, None)
+    if event is not None:
+        event.set()
+
+
+def _existing_response(record: IdempotencyRecord, request_hash: str):
+    """The response for a duplicate, or None if it has to wait (or retry the claim)."""
+    if record.fingerprint != request_hash:
+        return JsonResponse({
+            "status": "error",
+            "message": "This idempotency key was already used for a different request."
+        }, status=422)
+    if record.status == "completed":
+        response = JsonResponse(record.response_body, status=record.response_status)
+        response[REPLAYED_HEADER] = "true"
+        return response
+    return None
+
+
+def _in_progress_response() -> JsonResponse:
+    return JsonResponse({
+        "status": "error",
+        "message": "An identical request is still being processed. Check its status before trying again."
+    }, status=409)
+
+
+def run_idempotent(key: str, request_hash: str, call, ttl: float = None) -> JsonResponse:
+    """
+    Run call() once per key within ttl seconds and replay its JsonResponse for repeats.
+    Responses marked retryable() are not kept, so a retry after one runs call() again.
+
+    A duplicate that arrives while the original is running waits for it (up to
+    IDEMPOTENCY_WAIT_TIMEOUT) and gets the same response, marked with the
+    Idempotent-Replayed header. If the original died without finishing, the
+    first duplicate after its IDEMPOTENCY_LEASE runs call() in its place.
+    """
+    ttl = ttl or settings.IDEMPOTENCY_TTL
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_TIMEOUT
+    while True:
+        record, owned = _claim(key, request_hash, ttl)
+        if owned:
+            try:
+                response = call()
+            except BaseException:
+                _abandon(record)
+                raise
+            _finish(record, response, ttl)
+            return response
+
+        response = _existing_response(record, request_hash)
+        if response is not None:
+            return response
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return _in_progress_response()
+        with _in_flight_lock:
+            event = _in_flight.get(key)
+        if event is not None:
+            event.wait(remaining)
+        else:
+            time.sleep(min(settings.IDEMPOTENCY_POLL_INTERVAL, remaining))
+
+
+async def arun_idempotent(key: str, request_hash: str, call, ttl: float = None) -> JsonResponse:
+    """asyncio version of run_idempotent; call is a coroutine function."""
+    ttl = ttl or settings.IDEMPOTENCY_TTL
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_TIMEOUT
+    while True:
+        record, owned = await sync_to_async(_claim)(key, request_hash, ttl)
+        if owned:
+            try:
+                response = await call()
+            except BaseException:
+                await sync_to_async(_abandon)(record)
+                raise
+            await sync_to_async(_finish)(record, response, ttl)
+            return response
+
+        response = _existing_response(record, request_hash)
+        if response is not None:
+            return response
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return _in_progress_response()
+        await asyncio.sleep(min(settings.IDEMPOTENCY_POLL_INTERVAL, remaining))
@@ -0,0 +1,307 @@
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from core.models import TransactionIDCounter
+from . import base as settings
+from .models import IdNode
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "UGMP"
+EAT = ZoneInfo("Africa/Nairobi")  # the date in an OutTradeNo is East African Time
+
+# 64-bit id: 41 bits of milliseconds since EPOCH_MS, 10 bits of node, 12 bits of sequence.
+EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z; 41 bits of milliseconds last until 2093
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+MAX_NODE = (1 << NODE_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+def _closing_connection(func):
+    try:
+        return func()
+    finally:
+        connection.close()
+
+
+def _on_own_connection(func):
+    """
+    Run func on a short-lived thread, so what it writes commits on its own
+    connection even when called from async code or inside a caller's transaction.
+    """
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="ids") as pool:
+        return pool.submit(_closing_connection, func).result()
+
+
+class NodeLease:
+    """
+    Leases a node number from the IdNode table and keeps it renewed from a
+    background thread. The database is only touched when the lease is taken,
+    renewed or released, never per id.
+    """
+
+    def __init__(self, lease_seconds: float):
+        self.lease = timedelta(seconds=lease_seconds)
+        self.node_id = None
+        self._stop = threading.Event()
+        self._on_lost = None
+
+    def acquire(self, on_lost=None) -> int:
+        """Take an expired node number, or else the lowest one never used."""
+        self._on_lost = on_lost
+        self.node_id = _on_own_connection(self._acquire)
+        self._stop.clear()
+        threading.Thread(target=self._renew_forever, name="id-node-renew", daemon=True).start()
+        return self.node_id
+
+    def release(self):
+        self._stop.set()
+        if self.node_id is None:
+            return
+        node_id, self.node_id = self.node_id, None
+        try:
+            _closing_connection(
+                lambda: IdNode.objects.filter(node_id=node_id, **self._owner()).update(leased_until=timezone.now())
+            )
+        except Exception:
+            logger.warning(f"Could not release OutTradeNo node {node_id}; it frees itself when the lease runs out.")
+
+    def _acquire(self) -> int:
+        now = timezone.now()
+        owner = self._owner()
+        with transaction.atomic():
+            expired = (
+                IdNode.objects.filter(leased_until__lt=now)
+                .order_by("node_id")
+                .select_for_update(skip_locked=True)
+                .first()
+            )
+            if expired is not None:
+                IdNode.objects.filter(id=expired.id).update(leased_until=now + self.lease, **owner)
+                return expired.node_id
+            taken = set(IdNode.objects.values_list("node_id", flat=True))
+        for node_id in range(MAX_NODE + 1):
+            if node_id in taken:
+                continue
+            try:
+                with transaction.atomic():
+                    IdNode.objects.create(node_id=node_id, leased_until=now + self.lease, **owner)
+                return node_id
+            except IntegrityError:
+                continue  # another process took it first
+        raise RuntimeError(f"All {MAX_NODE + 1} OutTradeNo node numbers are leased.")
+
+    def _renew_forever(self):
+        while not self._stop.wait(self.lease.total_seconds() / 3):
+            node_id = self.node_id
+            if node_id is None:
+                return
+            try:
+                renewed = _closing_connection(
+                    lambda: IdNode.objects.filter(node_id=node_id, **self._owner()).update(
+                        leased_until=timezone.now() + self.lease
+                    )
+                )
+            except Exception:
+                logger.exception(f"Renewing OutTradeNo node {node_id} failed; retrying")
+                continue
+            if not renewed:
+                # Stalled past the lease and someone else took the number: stop using it.
+                logger.error(f"Lost the lease on OutTradeNo node {node_id}; taking a new one.")
+                self.node_id = None
+                if self._on_lost:
+                    self._on_lost()
+                return
+
+    @staticmethod
+    def _owner() -> dict:
+        return {"hostname": socket.gethostname()[:255], "pid": os.getpid()}
+
+
+class OutTradeNoGenerator:
+    """
+    Snowflake-style OutTradeNo: UGMP-YYYYMMDD-<19-digit id>.
+
+    The id packs the millisecond, this process's node number and a sequence
+    within the millisecond, so two processes with different node numbers can
+    never produce the same id and neither has to ask the other. Ids from one
+    process are strictly increasing: if the clock steps back, or more than 4096
+    ids are asked for in one millisecond, the generator carries on from the last
+    millisecond it issued instead of waiting or reusing one.
+
+    The node number is pinned with node_id, or leased from the database on first
+    use and again after a fork.
+    """
+
+    def __init__(self, node_id: int = None, lease_seconds: float = None, clock=None):
+        if node_id is not None and not 0 <= node_id <= MAX_NODE:
+            raise ValueError(f"node_id must be between 0 and {MAX_NODE}")
+        self._pinned_node = node_id
+        self._lease = None if node_id is not None else NodeLease(lease_seconds or settings.OUT_TRADE_NO_NODE_LEASE)
+        self._clock = clock or (lambda: time.time_ns() // 1_000_000)
+        self._lock = threading.Lock()
+        self._reset()
+
+    @property
+    def node_id(self) -> int:
+        if self._node is None:
+            with self._lock:
+                self._ensure_node()
+        return self._node
+
+    def next_id(self) -> int:
+        with self._lock:
+            if self._node is None:
+                self._ensure_node()
+            now_ms = self._clock()
+            if now_ms <= self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                now_ms = self._last_ms + 1 if self._sequence == 0 else self._last_ms
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+            return ((now_ms - EPOCH_MS) << (NODE_BITS + SEQUENCE_BITS)) | (self._node << SEQUENCE_BITS) | self._sequence
+
+    def next(self) -> str:
+        unique_id = self.next_id()
+        return f"{PREFIX}-{self._date_for(self._ms_of(unique_id))}-{unique_id:019d}"
+
+    @staticmethod
+    def _ms_of(unique_id: int) -> int:
+        return (unique_id >> (NODE_BITS + SEQUENCE_BITS)) + EPOCH_MS
+
+    def _date_for(self, ms: int) -> str:
+        day = self._day
+        if not day[0] <= ms < day[1]:
+            local = datetime.fromtimestamp(ms / 1000, EAT)
+            start = local.replace(hour=0, minute=0, second=0, microsecond=0)
+            day = self._day = (
+                int(start.timestamp() * 1000),
+                int((start + timedelta(days=1)).timestamp() * 1000),
+                local.strftime("%Y%m%d"),
+            )
+        return day[2]
+
+    def _ensure_node(self):
+        if self._pinned_node is not None:
+            self._node = self._pinned_node
+            return
+        try:
+            self._node = self._lease.acquire(on_lost=self._lost_node)
+            logger.info(f"Leased OutTradeNo node {self._node} for pid {os.getpid()}.")
+        except Exception:
+            # Keep payments flowing; a hashed node is unique only with high probability.
+            self._node = zlib.crc32(f"{socket.gethostname()}:{os.getpid()}".encode()) & MAX_NODE
+            logger.exception(f"Could not lease an OutTradeNo node; falling back to hashed node {self._node}.")
+
+    def _lost_node(self):
+        self._node = None
+
+    def _reset(self):
+        self._node = None
+        self._last_ms = -1
+        self._sequence = 0
+        self._day = (0, 0, "")
+
+    def _after_fork_in_child(self):
+        # The child must not share the parent's node: it leases its own on first use.
+        self._lock = threading.Lock()
+        if self._lease is not None:
+            self._lease = NodeLease(self._lease.lease.total_seconds())
+        self._reset()
+
+    def close(self):
+        if self._lease is not None:
+            self._lease.release()
+
+
+out_trade_no_generator = OutTradeNoGenerator(node_id=settings.OUT_TRADE_NO_NODE_ID)
+os.register_at_fork(after_in_child=out_trade_no_generator._after_fork_in_child)
+atexit.register(out_trade_no_generator.close)
+
+
+def generate_unique_id() -> str:
+    """A new OutTradeNo, unique across every process sharing the database."""
+    return out_trade_no_generator.next()
+
+
+class BlockAllocator:
+    """
+    Hi/lo allocator for a named sequence in core.TransactionIDCounter.
+
+    Reserves block_size values at a time with a single UPDATE ... RETURNING and
+    hands them out in memory, so writers only meet on the counter row once per
+    block instead of once per id. The reservation commits on its own connection:
+    a caller rolling back never returns values to the sequence, so no value is
+    handed out twice (a rollback just leaves a gap). `seed` gives the first value
+    when the sequence row does not exist yet.
+    """
+
+    def __init__(self, name: str, block_size: int = None, seed=None):
+        self.name = name
+        self.block_size = block_size or settings.ID_BLOCK_SIZE
+        self.seed = seed or (lambda: 1)
+        self._lock = threading.Lock()
+        self._next = self._end = 0
+        os.register_at_fork(after_in_child=self._forget)
+
+    def next(self) -> int:
+        with self._lock:
+            if self._next >= self._end:
+                self._next, self._end = self._reserve(self.block_size)
+            value = self._next
+            self._next += 1
+            return value
+
+    def take(self, n: int) -> list:
+        """n values at once, e.g. to pre-assign ids before a bulk_create."""
+        with self._lock:
+            values = list(range(self._next, min(self._next + n, self._end)))
+            self._next += len(values)
+            if len(values) < n:
+                start, end = self._reserve(max(self.block_size, n - len(values)))
+                needed = n - len(values)
+                values.extend(range(start, start + needed))
+                self._next, self._end = start + needed, end
+            return values
+
+    def _reserve(self, size: int) -> tuple:
+        end = _on_own_connection(lambda: self._reserve_in_db(size))
+        return end - size, end
+
+    def _reserve_in_db(self, size: int) -> int:
+        table = connection.ops.quote_name(TransactionIDCounter._meta.db_table)
+        quote = connection.ops.quote_name
+        update = (
+            f"UPDATE {table} SET {quote('next_value')} = {quote('next_value')} + %s "
+            f"WHERE {quote('name')} = %s RETURNING {quote('next_value')}"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(update, [size, self.name])
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute(
+                    f"INSERT INTO {table} ({quote('name')}, {quote('next_value')}) VALUES (%s, %s) "
+                    f"ON CONFLICT ({quote('name')}) DO NOTHING",
+                    [self.name, self.seed()],
+                )
+                cursor.execute(update, [size, self.name])
+                row = cursor.fetchone()
+        return row[0]
+
+    def _forget(self):
+        # A forked child must not hand out the rest of its parent's block.
+        self._lock = threading.Lock()
+        self._next = self._end = 0
@@ -0,0 +1,221 @@
+import json
+import logging
+import random
+import threading
+import uuid
+from datetime import timedelta
+
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from clients.holds import release_unused
+from clients.models import RecentTransaction
+from . import base as settings
+from .models import PaymentJob
+from .transaction_orchestrator import PaymentInitiator
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_payment(initiator, idempotency_key: str = None) -> tuple:
+    """
+    Queue a PaymentInitiator call for run_payment_jobs. Returns (job, created);
+    a repeat of the same idempotency key returns the existing job.
+    """
+    key = f"{initiator.client_id}:{idempotency_key}" if idempotency_key else uuid.uuid4().hex
+    return PaymentJob.objects.get_or_create(
+        idempotency_key=key,
+        defaults={
+            "client_id": initiator.client_id,
+            "channel": initiator.channel,
+            "t_type": initiator.t_type,
+            "base_amount": initiator.base_amount,
+            "trader_id": initiator.trader_id,
+            "message": initiator.message,
+            "name": initiator.name,
+            "revalidate_trader": initiator.revalidate_trader,
+            "hold_id": initiator.hold_id,
+        },
+    )
+
+
+class PaymentJobWorker:
+    """
+    Runs queued payment jobs on `workers` consumer threads.
+
+    Each consumer claims one due job at a time with SELECT ... FOR UPDATE SKIP
+    LOCKED and leases it for PAYMENT_JOB_LEASE seconds, so any number of worker
+    processes can share the queue. A job still running when its lease runs out
+    lost its worker mid-call and is marked 'unknown' rather than run again, since
+    the order may already have reached the aggregator.
+    """
+
+    def __init__(self, workers: int = None):
+        self.workers = workers or settings.PAYMENT_JOB_WORKERS
+        self.max_attempts = settings.PAYMENT_JOB_MAX_ATTEMPTS
+        self.base_delay = settings.PAYMENT_JOB_RETRY_BASE_DELAY
+        self.max_delay = settings.PAYMENT_JOB_RETRY_MAX_DELAY
+        self.lease = timedelta(seconds=settings.PAYMENT_JOB_LEASE)
+        self._stopping = threading.Event()
+
+    def stop(self):
+        """Let every consumer finish its current job, then exit."""
+        self._stopping.set()
+
+    def claim(self):
+        now = timezone.now()
+        with transaction.atomic():
+            job = (
+                PaymentJob.objects.filter(status="queued", run_at__lte=now)
+                .order_by("run_at")
+                .select_for_update(skip_locked=True)
+                .first()
+            )
+            if job is None:
+                return None
+            job.status = "running"
+            job.attempts += 1
+            job.locked_until = now + self.lease
+            job.save(update_fields=["status", "attempts", "locked_until", "updated_at"])
+        return job
+
+    def mark_stale(self) -> int:
+        """Mark running jobs whose lease ran out 'unknown'. The reconciler settles any order they sent."""
+        now = timezone.now()
+        with transaction.atomic():
+            stale = list(
+                PaymentJob.objects.filter(status="running", locked_until__lte=now)
+                .select_for_update(skip_locked=True)
+                .values_list("id", flat=True)
+            )
+            marked = PaymentJob.objects.filter(id__in=stale).update(
+                status="unknown",
+                locked_until=None,
+                result={"status": "error", "message": "Worker stopped while submitting this payment. Check its status before sending it again."},
+                updated_at=now,
+            )
+        if marked:
+            logger.warning(f"Marked {marked} stalled payment job(s) unknown.")
+        return marked
+
+    def run_forever(self, poll_interval: float = None):
+        poll_interval = poll_interval or settings.PAYMENT_JOB_POLL_INTERVAL
+        threads = [
+            threading.Thread(target=self._consume, args=(poll_interval,), name=f"payment-job-{i}")
+            for i in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            # Joined with a timeout so the main thread keeps receiving signals.
+            while thread.is_alive():
+                thread.join(0.5)
+
+    def run_until_empty(self) -> int:
+        """Run due jobs on all consumers until none are left. Returns how many were run."""
+        counts = [0] * self.workers
+
+        def drain(i):
+            close_old_connections()
+            try:
+                while not self._stopping.is_set():
+                    self.mark_stale()
+                    job = self.claim()
+                    if job is None:
+                        return
+                    self._run_safely(job)
+                    counts[i] += 1
+            finally:
+                close_old_connections()
+
+        threads = [threading.Thread(target=drain, args=(i,)) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sum(counts)
+
+    def _consume(self, poll_interval: float):
+        while not self._stopping.is_set():
+            close_old_connections()
+            self.mark_stale()
+            job = self.claim()
+            if job is None:
+                self._stopping.wait(poll_interval)
+                continue
+            self._run_safely(job)
+        close_old_connections()
+
+    def _run_safely(self, job: PaymentJob):
+        try:
+            self.run_job(job)
+        except Exception as e:
+            logger.exception(f"Payment job {job.id} raised")
+            self._retry_or_fail(job, 500, {"status": "error", "message": str(e)})
+
+    def run_job(self, job: PaymentJob):
+        initiator = PaymentInitiator(
+            channel=job.channel,
+            t_type=job.t_type,
+            client_id=job.client_id,
+            base_amount=job.base_amount,
+            trader_id=job.trader_id,
+            message=job.message,
+            name=job.name,
+            revalidate_trader=job.revalidate_trader,
+            idempotency_key=f"job-{job.id}",
+            hold_id=job.hold_id,
+        )
+        response = initiator.initiate_transaction()
+        result = json.loads(response.content)
+
+        if response.status_code < 300:
+            # 200 submitted, or 202 left to the reconciler: either way the order is with the aggregator.
+            self._finish(job, "succeeded", response.status_code, result)
+            # What the payment forms recorded for a submitted order; the webhook settles it.
+            self._set_transaction_status(job, "Processing" if job.t_type == 2 else "Pending")
+        elif response.status_code >= 500 or response.status_code == 409:
+            self._retry_or_fail(job, response.status_code, result)
+        else:
+            self._fail(job, response.status_code, result)
+
+    def _retry_or_fail(self, job: PaymentJob, status_code: int, result: dict):
+        if job.attempts >= self.max_attempts:
+            logger.error(f"Payment job {job.id} failed after {job.attempts} attempts: {result.get('message')}")
+            self._fail(job, status_code, result)
+            return
+        delay = min(self.max_delay, self.base_delay * (2 ** (job.attempts - 1)))
+        delay = random.uniform(delay / 2, delay)
+        delay = max(delay, float(result.get("retry_after") or 0))
+        PaymentJob.objects.filter(id=job.id).update(
+            status="queued",
+            run_at=timezone.now() + timedelta(seconds=delay),
+            locked_until=None,
+            result_status=status_code,
+            result=result,
+            updated_at=timezone.now(),
+        )
+        logger.warning(f"Payment job {job.id} attempt {job.attempts} got {status_code}; retrying in {delay:.0f}s.")
+
+    def _fail(self, job: PaymentJob, status_code: int, result: dict):
+        self._finish(job, "failed", status_code, result)
+        self._set_transaction_status(job, "Failed")
+
+    def _finish(self, job: PaymentJob, status: str, status_code: int, result: dict):
+        PaymentJob.objects.filter(id=job.id).update(
+            status=status,
+            locked_until=None,
+            result_status=status_code,
+            result=result,
+            updated_at=timezone.now(),
+        )
+        if job.hold_id:
+            # Kept across retries; once the job is done it is only needed if an order went out.
+            release_unused(job.hold_id)
+
+    def _set_transaction_status(self, job: PaymentJob, status: str):
+        # Saved rather than updated, so post_save keeps the staff Transaction in step as it did for the forms.
+        recent_transaction = RecentTransaction.objects.filter(id=job.recent_transaction_id).first() if job.recent_transaction_id else None
+        if recent_transaction is not None:
+            recent_transaction.status = status
+            recent_transaction.save(update_fields=["status", "updated_at"])
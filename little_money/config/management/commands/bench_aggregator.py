@@ -0,0 +1,140 @@
+import asyncio
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+
+from config import base as settings
+from config.aggregator import UnifiedOrder
+from config.async_aggregator import AsyncAggregatorTransport
+from config.resilience import build_registry
+from config.transport import AggregatorTransport
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.2
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        time.sleep(self.latency)
+        body = json.dumps({
+            "StatusCode": 200,
+            "Succeeded": True,
+            "Timestamp": int(time.time()),
+            "Data": {"OutTradeNo": payload.get("OutTradeNo"), "TransactionId": "BENCH", "Amount": payload.get("Amount")},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare concurrent /unifiedorder throughput of the WSGI model (a fixed pool of request threads "
+        "on the sync transport) against the ASGI model (one event loop on the async transport), "
+        "using a local aggregator stub. No database rows are written."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--orders", type=int, default=500)
+        parser.add_argument("--threads", type=int, default=settings.AGGREGATOR_POOL_MAXSIZE,
+                            help="Request threads per WSGI worker.")
+        parser.add_argument("--concurrency", type=int, default=200,
+                            help="Maximum in-flight calls on the ASGI event loop.")
+        parser.add_argument("--latency-ms", type=int, default=200, help="Stub response latency.")
+        parser.add_argument("--base-url", default=None,
+                            help="Benchmark against an already running aggregator (e.g. the simulator) instead of the stub.")
+
+    def handle(self, *args, **options):
+        server = None
+        base_url = options["base_url"]
+        if not base_url:
+            _StubHandler.latency = options["latency_ms"] / 1000
+            server = _StubServer(("127.0.0.1", 0), _StubHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            base_url = f"http://127.0.0.1:{server.server_port}"
+
+        payloads = [self._payload(i) for i in range(options["orders"])]
+        try:
+            wsgi = self._run_wsgi(base_url, payloads, options["threads"])
+            asgi = asyncio.run(self._run_asgi(base_url, payloads, options["concurrency"]))
+        finally:
+            if server:
+                server.shutdown()
+
+        self.stdout.write(f"{len(payloads)} orders against {base_url}")
+        self._report(f"WSGI ({options['threads']} threads)", wsgi)
+        self._report(f"ASGI ({options['concurrency']} in flight)", asgi)
+
+    def _payload(self, i):
+        request_data, _ = UnifiedOrder().build_request(
+            trader_id=f"0770{i:06d}", amount=100000, channel=1, transaction_type=2,
+            name="Bench Trader", message="benchmark",
+        )
+        return request_data
+
+    def _transport_kwargs(self, base_url, concurrency):
+        return dict(
+            base_url=base_url,
+            connect_timeout=settings.AGGREGATOR_CONNECT_TIMEOUT,
+            read_timeouts=settings.AGGREGATOR_READ_TIMEOUTS,
+            max_retries=0,
+            retry_backoff=0,
+            # Pin the adaptive limit to the benchmark's own concurrency so no call is shed.
+            guards=build_registry(initial_limit=concurrency, min_limit=concurrency, max_limit=concurrency),
+        )
+
+    def _run_wsgi(self, base_url, payloads, threads):
+        transport = AggregatorTransport(pool_maxsize=threads, **self._transport_kwargs(base_url, threads))
+
+        def call(payload):
+            started = time.perf_counter()
+            transport.post("unifiedorder", payload).raise_for_status()
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            latencies = list(pool.map(call, payloads))
+        elapsed = time.perf_counter() - started
+        transport.close()
+        return elapsed, latencies
+
+    async def _run_asgi(self, base_url, payloads, concurrency):
+        transport = AsyncAggregatorTransport(max_connections=concurrency, **self._transport_kwargs(base_url, concurrency))
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def call(payload):
+            async with semaphore:
+                started = time.perf_counter()
+                (await transport.post("unifiedorder", payload)).raise_for_status()
+                return time.perf_counter() - started
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(call(p) for p in payloads))
+        elapsed = time.perf_counter() - started
+        await transport.aclose()
+        return elapsed, latencies
+
+    def _report(self, label, result):
+        elapsed, latencies = result
+        latencies = sorted(latencies)
+        p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0
+        self.stdout.write(
+            f"{label:<28} {len(latencies) / elapsed:8.1f} orders/s  "
+            f"p50 {statistics.median(latencies) * 1000:7.1f} ms  p95 {p95 * 1000:7.1f} ms  total {elapsed:6.2f} s"
+        )
@@ -0,0 +1,76 @@
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pytz
+from django.core.management.base import BaseCommand
+
+from config.ids import OutTradeNoGenerator
+
+_legacy_counter = 0
+
+
+def _legacy_generate():
+    # generate_unique_id before OutTradeNoGenerator: a per-process counter, so two
+    # processes starting together hand out the same numbers.
+    global _legacy_counter
+    now_eat = datetime.now(pytz.timezone('Africa/Nairobi'))
+    auto_number = f"{int(now_eat.timestamp() * 1000)}{_legacy_counter:05d}"
+    _legacy_counter = (_legacy_counter + 1) % 100000
+    return f"UGMP-{now_eat.strftime('%Y%m%d')}-{auto_number}"
+
+
+def _generate_in_process(args):
+    kind, node_id, n = args
+    generate = _legacy_generate if kind == "legacy" else OutTradeNoGenerator(node_id=node_id).next
+    return [generate() for _ in range(n)]
+
+
+class Command(BaseCommand):
+    help = (
+        "Micro-benchmark OutTradeNo generation, the old per-process counter against the Snowflake "
+        "generator, in one thread, across threads and across processes, and count duplicate ids."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=200000)
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument("--processes", type=int, default=4)
+
+    def handle(self, *args, **options):
+        n = options["iterations"]
+        threads = options["threads"]
+        processes = options["processes"]
+
+        generator = OutTradeNoGenerator(node_id=0)
+        results = [
+            ("1 thread: generate_unique_id (old)", *self._time(n, 1, _legacy_generate)),
+            ("1 thread: OutTradeNoGenerator", *self._time(n, 1, generator.next)),
+            (f"{threads} threads: OutTradeNoGenerator", *self._time(n, threads, OutTradeNoGenerator(node_id=0).next)),
+            (f"{processes} processes: generate_unique_id (old)", *self._time_processes("legacy", n, processes)),
+            (f"{processes} processes: OutTradeNoGenerator", *self._time_processes("snowflake", n, processes)),
+        ]
+        for label, elapsed, duplicates in results:
+            self.stdout.write(
+                f"{label:<40} {n / elapsed:12,.0f} ids/s  {elapsed / n * 1e6:7.2f} us/id  {duplicates:>8} duplicates"
+            )
+
+    def _time(self, n, threads, generate):
+        per_thread = n // threads
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            batches = list(pool.map(lambda _: [generate() for _ in range(per_thread)], range(threads)))
+        elapsed = time.perf_counter() - started
+        ids = [unique_id for batch in batches for unique_id in batch]
+        return elapsed, len(ids) - len(set(ids))
+
+    def _time_processes(self, kind, n, processes):
+        per_process = n // processes
+        context = multiprocessing.get_context("fork")
+        with context.Pool(processes) as pool:
+            started = time.perf_counter()
+            batches = pool.map(_generate_in_process, [(kind, node_id, per_process) for node_id in range(processes)])
+            elapsed = time.perf_counter() - started
+        ids = [unique_id for batch in batches for unique_id in batch]
+        return elapsed, len(ids) - len(set(ids))
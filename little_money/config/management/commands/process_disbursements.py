@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from clients.disbursements import DisbursementEngine
+
+
+class Command(BaseCommand):
+    help = (
+        "Dispatch uploaded bulk disbursement batches on a bounded worker pool. "
+        "Runs until stopped unless --once is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Run the oldest queued batch, then exit.")
+        parser.add_argument("--workers", type=int, default=None, help="Concurrent payments per batch.")
+        parser.add_argument("--interval", type=float, default=None, help="Seconds to sleep when no batch is queued.")
+
+    def handle(self, *args, **options):
+        engine = DisbursementEngine(workers=options["workers"])
+        if options["once"]:
+            batch = engine.run_once()
+            if batch is None:
+                self.stdout.write("No queued disbursement batches.")
+                return
+            batch.refresh_from_db()
+            self.stdout.write(f"Batch {batch.id} ({batch.file_name}): {batch.message}")
+            return
+        self.stdout.write("Disbursement worker running. Press Ctrl+C to stop.")
+        try:
+            engine.run_forever(poll_interval=options["interval"])
+        except KeyboardInterrupt:
+            self.stdout.write("Disbursement worker stopped.")
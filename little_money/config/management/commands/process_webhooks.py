@@ -0,0 +1,46 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from webhooks.inbox import InboxWorker, backlog
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply acknowledged payment notifications from the webhook inbox, in order per "
+        "OutTradeNo and in parallel across orders. Runs until stopped unless --once is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Apply one batch of due notifications, then exit.")
+        parser.add_argument("--workers", type=int, default=None, help="Notifications applied concurrently.")
+        parser.add_argument("--batch-size", type=int, default=None, help="Notifications claimed per pass.")
+        parser.add_argument("--interval", type=float, default=None, help="Seconds to sleep when the inbox is empty.")
+        parser.add_argument("--stats", action="store_true", help="Print the backlog and exit.")
+
+    def handle(self, *args, **options):
+        if options["stats"]:
+            stats = backlog()
+            self.stdout.write(
+                f"{stats['depth']} pending, {stats['processing']} processing, {stats['failed']} failed; "
+                f"oldest unapplied {stats['oldest_age_seconds']}s old."
+            )
+            return
+
+        worker = InboxWorker(workers=options["workers"], batch_size=options["batch_size"])
+        if options["once"]:
+            summary = worker.run_once()
+            self.stdout.write(
+                f"Claimed {summary['claimed']}: {summary['done']} applied, {summary['retry']} to retry, {summary['failed']} failed."
+            )
+            return
+
+        def shutdown(signum, frame):
+            self.stdout.write("Stopping after the current batch...")
+            worker.stop()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        self.stdout.write("Webhook worker running. Press Ctrl+C to stop.")
+        worker.run_forever(poll_interval=options["interval"])
+        self.stdout.write("Webhook worker stopped.")
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from config.reconciler import OrderReconciler
+
+
+class Command(BaseCommand):
+    help = (
+        "Resolve pending orders whose webhook has not arrived by polling /orderquery with "
+        "exponential backoff, and release balance holds past their expiry. Runs until stopped "
+        "unless --once is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Process the orders due now, then exit.")
+        parser.add_argument("--concurrency", type=int, default=None, help="Concurrent /orderquery calls.")
+        parser.add_argument("--batch-size", type=int, default=None, help="Orders claimed per pass.")
+        parser.add_argument("--interval", type=float, default=None, help="Seconds to sleep when no orders are due.")
+
+    def handle(self, *args, **options):
+        reconciler = OrderReconciler(concurrency=options["concurrency"], batch_size=options["batch_size"])
+        if options["once"]:
+            summary = reconciler.run_once()
+            self.stdout.write(
+                f"Claimed {summary['claimed']}: {summary['settled']} settled, {summary['pending']} still pending, "
+                f"{summary['resolved_elsewhere']} resolved by webhook, {summary['errors']} errors, "
+                f"{summary['holds_expired']} balance holds expired."
+            )
+            return
+        self.stdout.write("Order reconciler running. Press Ctrl+C to stop.")
+        try:
+            reconciler.run_forever(poll_interval=options["interval"])
+        except KeyboardInterrupt:
+            self.stdout.write("Order reconciler stopped.")
@@ -0,0 +1,74 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from webhooks.replay import NotificationReplayer, dry_run_report, replay_selection
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-apply stored payment notifications that were never processed (e.g. after a bad deploy "
+        "or a database outage) on a pool of worker processes. Processed notifications are never "
+        "selected, and each one is claimed atomically before its money moves, so a replay can be "
+        "re-run or overlap the live webhook without applying anything twice."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pay-status", type=int, nargs="+", choices=[0, 1, 2], help="Only these PayStatus values.")
+        parser.add_argument("--since", help="Only notifications received on or after this date (YYYY-MM-DD).")
+        parser.add_argument("--until", help="Only notifications received on or before this date (YYYY-MM-DD).")
+        parser.add_argument("--errored", action="store_true", help="Only notifications with an error_message.")
+        parser.add_argument("--workers", type=int, default=4, help="Worker processes.")
+        parser.add_argument("--chunk-size", type=int, default=500, help="Notifications applied per batch.")
+        parser.add_argument("--report-every", type=float, default=5, help="Seconds between progress lines.")
+        parser.add_argument("--dry-run", action="store_true", help="Report what would be replayed, then exit.")
+
+    def handle(self, *args, **options):
+        notifications = replay_selection(
+            pay_statuses=options["pay_status"],
+            since=options["since"],
+            until=options["until"],
+            only_errored=options["errored"],
+        )
+
+        if options["dry_run"]:
+            report = dry_run_report(notifications)
+            self.stdout.write(
+                f"{report['total']} notification(s) would be replayed, {report['amount'] or 0} in total; "
+                f"by PayStatus: {report['by_pay_status']}."
+            )
+            self.stdout.write(
+                f"{report['missing_order']} have no order response and would fail; "
+                f"{report['already_final']} belong to orders already paid or failed."
+            )
+            return
+
+        total = notifications.count()
+        if not total:
+            self.stdout.write("Nothing to replay.")
+            return
+        self.stdout.write(f"Replaying {total} notification(s) on {options['workers']} worker process(es)...")
+
+        last_report = [0.0]
+
+        def progress(done, counts, elapsed):
+            if time.monotonic() - last_report[0] >= options["report_every"] or done >= total:
+                last_report[0] = time.monotonic()
+                self.stdout.write(
+                    f"  {done}/{total} in {elapsed:.1f}s ({done / elapsed if elapsed else 0:.0f}/s): "
+                    f"{counts['SUCCESS']} applied, {counts['FAILED']} failed, {counts['INVALID']} invalid."
+                )
+
+        replayer = NotificationReplayer(
+            workers=options["workers"], chunk_size=options["chunk_size"], on_progress=progress
+        )
+        counts = replayer.run(notifications)
+        elapsed = counts["elapsed"]
+        replayed = sum(counts[outcome] for outcome in ("SUCCESS", "FAILED", "INVALID"))
+        self.stdout.write(
+            f"Replayed {replayed} notification(s) in {elapsed:.1f}s ({replayed / elapsed if elapsed else 0:.0f}/s): "
+            f"{counts['SUCCESS']} applied, {counts['FAILED']} failed, {counts['INVALID']} invalid, "
+            f"{counts['skipped']} already processed elsewhere."
+        )
+        if counts["FAILED"] or counts["INVALID"]:
+            self.stderr.write("Failed notifications keep processed=False with error_message set; rerun with --errored.")
@@ -0,0 +1,33 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from config.job_queue import PaymentJobWorker
+
+
+class Command(BaseCommand):
+    help = (
+        "Run queued payment submissions on N concurrent consumers. SIGTERM or Ctrl+C "
+        "lets in-flight jobs finish before exiting. Runs until stopped unless --once is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Run every job due now, then exit.")
+        parser.add_argument("--workers", type=int, default=None, help="Concurrent consumers.")
+        parser.add_argument("--interval", type=float, default=None, help="Seconds a consumer sleeps when the queue is empty.")
+
+    def handle(self, *args, **options):
+        worker = PaymentJobWorker(workers=options["workers"])
+        if options["once"]:
+            self.stdout.write(f"Ran {worker.run_until_empty()} payment jobs.")
+            return
+
+        def shutdown(signum, frame):
+            self.stdout.write("Stopping after in-flight payment jobs finish...")
+            worker.stop()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        self.stdout.write(f"Payment job worker running with {worker.workers} consumers. Press Ctrl+C to stop.")
+        worker.run_forever(poll_interval=options["interval"])
+        self.stdout.write("Payment job worker stopped.")
@@ -0,0 +1,78 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from config import base as settings
+from config.simulator import Latency, SimulatorConfig, make_server
+
+
+def _latency(value):
+    try:
+        return Latency(value)
+    except (ValueError, IndexError):
+        raise CommandError(f"Invalid latency '{value}'. Use fixed:S, uniform:MIN,MAX or lognormal:MEDIAN,SIGMA.")
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local LipaPay-compatible aggregator (/bill, /unifiedorder, /orderquery, /balance, /statement) "
+        "with latency and fault injection. Point AGGREGATOR_BASE_URL at it; orders are settled with signed "
+        "webhooks to their NotifyUrl (or --webhook-url)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8089)
+        parser.add_argument("--latency", default="fixed:0", help="Response latency for every endpoint, e.g. lognormal:0.2,0.5.")
+        parser.add_argument("--endpoint-latency", action="append", default=[], metavar="ENDPOINT=SPEC",
+                            help="Per-endpoint latency override, e.g. orderquery=uniform:1,3. Repeatable.")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with HTTP 502.")
+        parser.add_argument("--timeout-rate", type=float, default=0.0, help="Share of requests that hang and are dropped.")
+        parser.add_argument("--hang-seconds", type=float, default=60.0)
+        parser.add_argument("--success-rate", type=float, default=0.95, help="Share of orders that settle as paid.")
+        parser.add_argument("--settle-latency", default="uniform:1,5", help="Delay between /unifiedorder and settlement.")
+        parser.add_argument("--processing-webhook", action="store_true", help="Send a PayStatus 0 webhook before the final one.")
+        parser.add_argument("--duplicate-rate", type=float, default=0.0, help="Share of final webhooks delivered twice.")
+        parser.add_argument("--out-of-order-rate", type=float, default=0.0,
+                            help="Share of orders whose PayStatus 0 webhook arrives after the final one.")
+        parser.add_argument("--webhook-url", default=None, help="Deliver every webhook here instead of the order's NotifyUrl.")
+        parser.add_argument("--balance", default="10000000", help="Opening merchant balance (UGX).")
+        parser.add_argument("--no-verify", action="store_true", help="Accept requests with a wrong MchID or Sign.")
+        parser.add_argument("--seed", type=int, default=None, help="Random seed for repeatable runs.")
+
+    def handle(self, *args, **options):
+        endpoint_latency = {}
+        for override in options["endpoint_latency"]:
+            endpoint, sep, spec = override.partition("=")
+            if not sep:
+                raise CommandError(f"Invalid --endpoint-latency '{override}', expected ENDPOINT=SPEC.")
+            endpoint_latency[endpoint] = _latency(spec)
+
+        config = SimulatorConfig(
+            merchant_id=settings.PAYMENT_MERCHANT_ID,
+            private_key=settings.PAYMENT_AGGREGATOR_API_KEY,
+            latency=_latency(options["latency"]),
+            endpoint_latency=endpoint_latency,
+            error_rate=options["error_rate"],
+            timeout_rate=options["timeout_rate"],
+            hang_seconds=options["hang_seconds"],
+            success_rate=options["success_rate"],
+            settle_latency=_latency(options["settle_latency"]),
+            processing_webhook=options["processing_webhook"],
+            duplicate_rate=options["duplicate_rate"],
+            out_of_order_rate=options["out_of_order_rate"],
+            webhook_url=options["webhook_url"],
+            balance=Decimal(options["balance"]),
+            verify_requests=not options["no_verify"],
+            seed=options["seed"],
+        )
+        server = make_server(config, options["host"], options["port"])
+        self.stdout.write(f"Aggregator simulator listening on http://{options['host']}:{server.server_port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.simulator.webhooks.stop()
+            server.server_close()
+            self.stdout.write(f"Simulator stopped. {server.simulator.stats}")
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from finance.ledger import balance_drift, take_snapshots
+
+
+class Command(BaseCommand):
+    help = (
+        "Fold new ledger postings into per-account balance snapshots, so point-in-time balances "
+        "are a snapshot plus a short delta. Runs once unless --interval is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=None, help="Seconds between snapshot rounds; run until stopped.")
+        parser.add_argument("--lag", type=float, default=None, help="Only fold in postings at least this many seconds old.")
+        parser.add_argument("--verify", action="store_true", help="Report balance columns that disagree with the ledger.")
+
+    def handle(self, *args, **options):
+        if options["verify"]:
+            drift = balance_drift()
+            for account, (column, ledger) in sorted(drift.items()):
+                self.stderr.write(f"{account}: balance column {column}, ledger {ledger}")
+            self.stdout.write(f"{len(drift)} account(s) disagree with the ledger.")
+            return
+
+        if options["interval"] is None:
+            self.stdout.write(f"Wrote {take_snapshots(lag=options['lag'])} snapshot(s).")
+            return
+        self.stdout.write("Ledger snapshots running. Press Ctrl+C to stop.")
+        try:
+            while True:
+                take_snapshots(lag=options["lag"])
+                time.sleep(options["interval"])
+        except KeyboardInterrupt:
+            self.stdout.write("Ledger snapshots stopped.")
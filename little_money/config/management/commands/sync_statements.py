@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from config.statement_sync import StatementSync
+
+
+def _parse_day(value):
+    try:
+        return datetime.strptime(value, "%Y%m%d").date()
+    except ValueError:
+        raise CommandError(f"Invalid date '{value}', expected yyyyMMdd.")
+
+
+class Command(BaseCommand):
+    help = (
+        "Sync the aggregator statement of account day by day. Days already closed are skipped, "
+        "so re-running an interrupted sync only fetches what is missing."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--start", help="First day (yyyyMMdd). Defaults to 30 days ago.")
+        parser.add_argument("--end", help="Last day (yyyyMMdd). Defaults to today.")
+        parser.add_argument("--workers", type=int, default=None, help="Concurrent /statement calls.")
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        start = _parse_day(options["start"]) if options["start"] else today - timedelta(days=30)
+        end = _parse_day(options["end"]) if options["end"] else today
+        if start > end:
+            raise CommandError("--start must not be after --end.")
+
+        summary = StatementSync(workers=options["workers"]).sync(start, end)
+
+        self.stdout.write(
+            f"Fetched {summary['fetched']} day(s) with {summary['items']} item(s), "
+            f"skipped {summary['skipped']} closed day(s)."
+        )
+        if summary["failed"]:
+            failed = ", ".join(day.strftime("%Y%m%d") for day in summary["failed"])
+            self.stderr.write(f"{len(summary['failed'])} day(s) failed and will be retried next run: {failed}")
+        else:
+            self.stdout.write(self.style.SUCCESS("Statement sync complete."))
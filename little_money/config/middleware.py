@@ -1,3 +1,4 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.shortcuts import redirect
 from django.urls import reverse
 from core.utils import is_admin, is_client, is_staff
@@ -6,10 +7,31 @@ from clients.models import Client
 from admins.models import AdminProfile
 
 class FirstLoginPasswordChangeMiddleware:
+    # Hybrid middleware: under ASGI a sync-only middleware would push every
+    # request (and every async view) back onto a thread.
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self.check_first_login(request)
+        if response is not None:
+            return response
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        response = await sync_to_async(self.check_first_login)(request)
+        if response is not None:
+            return response
+        return await self.get_response(request)
+
+    def check_first_login(self, request):
         if request.user.is_authenticated:
             user = request.user
 
@@ -44,4 +66,4 @@ class FirstLoginPasswordChangeMiddleware:
                     else:
                         return redirect('authenticate:logout')
 
-        return self.get_response(request)
+        return None
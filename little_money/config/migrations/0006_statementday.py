@@ -0,0 +1,30 @@
+# Generated by Django 5.2.3 on 2026-10-18 17:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('config', '0005_unifiedorderresponse_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatementDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True)),
+                ('status_code', models.IntegerField()),
+                ('succeeded', models.BooleanField()),
+                ('errors', models.TextField(blank=True, null=True)),
+                ('items', models.JSONField(default=list)),
+                ('item_count', models.IntegerField(default=0)),
+                ('closed', models.BooleanField(default=False)),
+                ('fetched_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['day'],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.3 on 2026-10-18 17:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('config', '0006_statementday'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='unifiedorderresponse',
+            name='next_reconcile_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='unifiedorderresponse',
+            name='reconcile_attempts',
+            field=models.IntegerField(default=0),
+        ),
+    ]
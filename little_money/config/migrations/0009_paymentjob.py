@@ -0,0 +1,43 @@
+# Generated by Django 5.2.3 on 2026-10-18 17:47
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0012_disbursementbatch_disbursementitem'),
+        ('config', '0008_idempotencyrecord'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idempotency_key', models.CharField(max_length=255, unique=True)),
+                ('channel', models.IntegerField()),
+                ('t_type', models.IntegerField()),
+                ('base_amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('trader_id', models.CharField(max_length=100)),
+                ('message', models.CharField(max_length=255)),
+                ('name', models.CharField(max_length=255)),
+                ('revalidate_trader', models.BooleanField(default=False)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('attempts', models.IntegerField(default=0)),
+                ('run_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_until', models.DateTimeField(blank=True, null=True)),
+                ('result_status', models.IntegerField(blank=True, null=True)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_jobs', to='clients.client')),
+                ('recent_transaction', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payment_jobs', to='clients.recenttransaction')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'run_at'], name='config_paym_status_e11075_idx')],
+            },
+        ),
+    ]
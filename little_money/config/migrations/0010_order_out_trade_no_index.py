@@ -0,0 +1,23 @@
+# Generated by Django 5.2.3 on 2026-10-18 18:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('config', '0009_paymentjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='unifiedorderrequest',
+            name='out_trade_no',
+            field=models.CharField(db_index=True, max_length=36),
+        ),
+        migrations.AlterField(
+            model_name='unifiedorderresponse',
+            name='out_trade_no',
+            field=models.CharField(db_index=True, max_length=36),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-18 18:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('config', '0010_order_out_trade_no_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='unifiedorderresponse',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('paid', 'Paid'), ('failed', 'Failed')], default='pending', max_length=36),
+        ),
+    ]
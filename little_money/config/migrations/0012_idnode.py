@@ -0,0 +1,24 @@
+# Generated by Django 5.2.3 on 2026-10-18 18:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('config', '0011_order_status_choices'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdNode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('node_id', models.PositiveSmallIntegerField(unique=True)),
+                ('hostname', models.CharField(max_length=255)),
+                ('pid', models.IntegerField()),
+                ('leased_until', models.DateTimeField(db_index=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.3 on 2026-10-18 18:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0013_balancehold'),
+        ('config', '0012_idnode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentjob',
+            name='hold',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payment_jobs', to='clients.balancehold'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-18 20:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('config', '0014_configversion'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='paymentjob',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed'), ('unknown', 'Unknown')], default='queued', max_length=20),
+        ),
+    ]
@@ -1,10 +1,11 @@
 from django.db import models
+from django.utils import timezone
 
 
 class UnifiedOrderRequest(models.Model):
     timestamp = models.BigIntegerField()
     channel = models.IntegerField(choices=((1, 'MTN'), (2, 'Airtel')))
-    out_trade_no = models.CharField(max_length=36)
+    out_trade_no = models.CharField(max_length=36, db_index=True)
     amount = models.IntegerField()
     transaction_type = models.IntegerField(choices=((1, 'Collection'), (2, 'Disbursement')))
     trader_id = models.CharField(max_length=20)
@@ -16,13 +17,21 @@ class UnifiedOrderRequest(models.Model):
 
 
 class UnifiedOrderResponse(models.Model):
+    # Moved only through config.order_status.transition, which enforces the allowed order.
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('paid', 'Paid'),
+        ('failed', 'Failed'),
+    ]
+
     status_code = models.IntegerField()
     succeeded = models.BooleanField()
     errors = models.TextField(null=True, blank=True)
     extras = models.TextField(null=True, blank=True)
     timestamp = models.BigIntegerField()
-    status =models.CharField(max_length=36, default="pending")
-    out_trade_no = models.CharField(max_length=36)
+    status =models.CharField(max_length=36, choices=STATUS_CHOICES, default="pending")
+    out_trade_no = models.CharField(max_length=36, db_index=True)
     transaction_id = models.CharField(max_length=100)
     amount = models.DecimalField(max_digits=12, decimal_places=2,default=0.00)  # Base amount before fees
     actual_payment_amount = models.DecimalField(max_digits=12, decimal_places=2)
@@ -31,6 +40,9 @@ class UnifiedOrderResponse(models.Model):
     payee_charge = models.DecimalField(max_digits=12, decimal_places=2)  # Your platform fee
     channel_charge = models.DecimalField(max_digits=12, decimal_places=2)
     client = models.ForeignKey('clients.Client', on_delete=models.SET_NULL, null=True, related_name='orders')
+    # Order-status reconciler bookkeeping (see config.reconciler).
+    reconcile_attempts = models.IntegerField(default=0)
+    next_reconcile_at = models.DateTimeField(null=True, blank=True, db_index=True)
 
     def __str__(self):
         return self.transaction_id
@@ -122,4 +134,106 @@ class StatementResponse(models.Model):
     extras = models.TextField(null=True, blank=True)
     timestamp = models.BigIntegerField()
 
-    statement_data = models.JSONField()  # Store the statement data as JSON
\ No newline at end of file
+    statement_data = models.JSONField()  # Store the statement data as JSON
+
+class StatementDay(models.Model):
+    """One aggregator statement day. Closed days are immutable and never fetched again."""
+    day = models.DateField(unique=True)
+    status_code = models.IntegerField()
+    succeeded = models.BooleanField()
+    errors = models.TextField(null=True, blank=True)
+    items = models.JSONField(default=list)
+    item_count = models.IntegerField(default=0)
+    closed = models.BooleanField(default=False)
+    fetched_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["day"]
+
+    def __str__(self):
+        return self.day.strftime("%Y%m%d")
+
+class IdempotencyRecord(models.Model):
+    """
+    The first response to a payment request, replayed for repeats of its key until
+    expires_at. While in_progress, expires_at is the lease of the request running it.
+    """
+    STATUS_CHOICES = [
+        ("in_progress", "In progress"),
+        ("completed", "Completed"),
+    ]
+    key = models.CharField(max_length=255, unique=True)
+    fingerprint = models.CharField(max_length=64)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="in_progress")
+    response_status = models.IntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.key} ({self.status})"
+
+class PaymentJob(models.Model):
+    """
+    A queued PaymentInitiator call, run by manage.py run_payment_jobs.
+    Claimed with SELECT ... FOR UPDATE SKIP LOCKED and leased until locked_until.
+    """
+    STATUS_CHOICES = [
+        ("queued", "Queued"),
+        ("running", "Running"),
+        ("succeeded", "Succeeded"),
+        ("failed", "Failed"),
+        ("unknown", "Unknown"),
+    ]
+    client = models.ForeignKey('clients.Client', on_delete=models.CASCADE, related_name='payment_jobs')
+    recent_transaction = models.ForeignKey('clients.RecentTransaction', on_delete=models.SET_NULL, null=True, blank=True, related_name='payment_jobs')
+    hold = models.ForeignKey('clients.BalanceHold', on_delete=models.SET_NULL, null=True, blank=True, related_name='payment_jobs')
+    idempotency_key = models.CharField(max_length=255, unique=True)
+    channel = models.IntegerField()
+    t_type = models.IntegerField()
+    base_amount = models.DecimalField(max_digits=12, decimal_places=2)
+    trader_id = models.CharField(max_length=100)
+    message = models.CharField(max_length=255)
+    name = models.CharField(max_length=255)
+    revalidate_trader = models.BooleanField(default=False)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="queued")
+    attempts = models.IntegerField(default=0)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    result_status = models.IntegerField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "run_at"])]
+
+    def __str__(self):
+        return f"Job {self.id} ({self.status})"
+
+class IdNode(models.Model):
+    """
+    A node number leased by one process for OutTradeNo generation (see config.ids).
+    The holder renews leased_until in the background; a number whose lease ran out
+    can be taken by another process.
+    """
+    node_id = models.PositiveSmallIntegerField(unique=True)
+    hostname = models.CharField(max_length=255)
+    pid = models.IntegerField()
+    leased_until = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Node {self.node_id} ({self.hostname}:{self.pid})"
+
+class ConfigVersion(models.Model):
+    """
+    One row counting saves of the fee and commission settings (see config.platform_config).
+    It is bumped in the transaction that saves them, so every worker sees the new
+    version exactly when it can read the new rows.
+    """
+    version = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Config version {self.version}"
@@ -0,0 +1,54 @@
+from django.db import connection
+
+from .models import UnifiedOrderResponse
+
+PENDING = "pending"
+PROCESSING = "processing"
+PAID = "paid"
+FAILED = "failed"
+
+# Status -> the statuses an order may move to it from. 'paid' and 'failed' are
+# final: nothing moves an order out of them, so a late or repeated webhook
+# cannot undo a settlement.
+TRANSITIONS = {
+    PROCESSING: (PENDING,),
+    PAID: (PENDING, PROCESSING),
+    FAILED: (PENDING, PROCESSING),
+}
+
+UNRESOLVED_STATUSES = (PENDING, PROCESSING)
+FINAL_STATUSES = (PAID, FAILED)
+
+# The order status each aggregator PayStatus leads to.
+STATUS_BY_PAY_STATUS = {0: PROCESSING, 1: PAID, 2: FAILED}
+
+
+def can_transition(from_status: str, to_status: str) -> bool:
+    return from_status in TRANSITIONS.get(to_status, ())
+
+
+def transition(to_status: str, **lookup) -> bool:
+    """
+    Move the order matching lookup to to_status with a single conditional
+    UPDATE ... WHERE status IN (allowed predecessors), without reading it first.
+    Returns whether it moved; False means it was already there or past it.
+    """
+    return bool(
+        UnifiedOrderResponse.objects.filter(status__in=TRANSITIONS[to_status], **lookup).update(status=to_status)
+    )
+
+
+def transition_many(to_status: str, order_ids) -> set:
+    """transition() for many orders in one statement. Returns the ids that moved."""
+    order_ids = list(order_ids)
+    if not order_ids:
+        return set()
+    opts = UnifiedOrderResponse._meta
+    quote = connection.ops.quote_name
+    sql = (
+        f"UPDATE {quote(opts.db_table)} SET {quote('status')} = %s "
+        f"WHERE {quote('id')} = ANY(%s) AND {quote('status')} = ANY(%s) RETURNING {quote('id')}"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [to_status, order_ids, list(TRANSITIONS[to_status])])
+        return {order_id for (order_id,) in cursor.fetchall()}
@@ -0,0 +1,85 @@
+import threading
+import time
+from dataclasses import dataclass
+from decimal import Decimal
+
+from django.db import connection
+from django.utils import timezone
+
+from admins.models import AdminCommissionHistory
+from finance.models import PlatformSettings
+from staff.models import StaffCommissionHistory
+from .models import ConfigVersion
+
+# The ConfigVersion row counting fee and commission saves. Every worker reads it
+# (one primary-key lookup) before using its snapshot, so a saved change is used by
+# the next payment in every process, whatever cache backend is configured.
+VERSION_ID = 1
+
+DEFAULT_STAFF_COMMISSION_PERCENT = Decimal("25.0")
+DEFAULT_ADMIN_COMMISSION_PERCENT = Decimal("10.0")
+
+
+@dataclass(frozen=True)
+class PlatformConfig:
+    """Fee and commission percentages in force, read once per version."""
+    platform_fee_percent: Decimal  # None when no PlatformSettings row exists: no fee is charged
+    staff_commission_percent: Decimal
+    admin_commission_percent: Decimal
+    version: int
+    loaded_at: float
+
+    def platform_fee(self, amount) -> Decimal:
+        if self.platform_fee_percent is None:
+            return Decimal("0")
+        return Decimal(str(amount)) * self.platform_fee_percent / Decimal("100")
+
+
+class PlatformConfigCache:
+    def __init__(self):
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def get(self) -> PlatformConfig:
+        # Read the version before the rows: a snapshot is never labelled newer than its data.
+        version = ConfigVersion.objects.filter(pk=VERSION_ID).values_list('version', flat=True).first() or 0
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.version != version:
+                snapshot = self._snapshot = self._load(version)
+        return snapshot
+
+    def invalidate(self):
+        """
+        Bump the version in the current transaction, so it commits (or rolls back)
+        together with the fee or commission row that was saved.
+        """
+        table = connection.ops.quote_name(ConfigVersion._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (id, version, updated_at) VALUES (%s, 1, %s) "
+                f"ON CONFLICT (id) DO UPDATE SET version = {table}.version + 1, updated_at = EXCLUDED.updated_at",
+                [VERSION_ID, timezone.now()],
+            )
+
+    def _load(self, version: int) -> PlatformConfig:
+        platform_settings = PlatformSettings.objects.first()
+        staff = StaffCommissionHistory.objects.order_by('-created_at').first()
+        admin = AdminCommissionHistory.objects.order_by('-created_at').first()
+        return PlatformConfig(
+            platform_fee_percent=Decimal(str(platform_settings.platform_fee_percent)) if platform_settings else None,
+            staff_commission_percent=Decimal(str(staff.percentage)) if staff else DEFAULT_STAFF_COMMISSION_PERCENT,
+            admin_commission_percent=Decimal(str(admin.percentage)) if admin else DEFAULT_ADMIN_COMMISSION_PERCENT,
+            version=version,
+            loaded_at=time.monotonic(),
+        )
+
+
+platform_config = PlatformConfigCache()
+
+
+def get_platform_config() -> PlatformConfig:
+    return platform_config.get()
@@ -0,0 +1,139 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+
+from . import base as settings
+from .aggregator import PrepaidBill
+from .async_aggregator import AsyncPrepaidBill
+
+
+class QuoteCache:
+    """
+    LRU cache with a TTL for successful /bill responses.
+
+    Unless `per_trader` is set, a quote is shared by every trader, so the
+    trader-specific FullName is dropped from cached responses and callers fall
+    back to the name they were given.
+    """
+
+    def __init__(self, ttl: float, max_entries: int, amount_bucket: int = 1, per_trader: bool = False):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.amount_bucket = max(1, amount_bucket)
+        self.per_trader = per_trader
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, trader_id: str, amount: int, channel: int, transaction_type: int) -> tuple:
+        bucket = int(amount) // self.amount_bucket
+        return (channel, transaction_type, bucket, trader_id if self.per_trader else None)
+
+    def get(self, trader_id: str, amount: int, channel: int, transaction_type: int):
+        key = self.key(trader_id, amount, channel, transaction_type)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            cached_amount, response = entry[1], entry[2]
+        return self._for_request(response, cached_amount, trader_id, amount)
+
+    def put(self, trader_id: str, amount: int, channel: int, transaction_type: int, response: dict):
+        if not self.is_cacheable(response):
+            return
+        response = copy.deepcopy(response)
+        if not self.per_trader:
+            response["Data"].pop("FullName", None)
+        key = self.key(trader_id, amount, channel, transaction_type)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, int(amount), response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypasses += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    @staticmethod
+    def is_cacheable(response: dict) -> bool:
+        return (
+            isinstance(response, dict)
+            and "error" not in response
+            and response.get("StatusCode") == 200
+            and isinstance(response.get("Data"), dict)
+        )
+
+    def _for_request(self, response: dict, cached_amount: int, trader_id: str, amount: int) -> dict:
+        response = copy.deepcopy(response)
+        data = response["Data"]
+        data["TraderID"] = trader_id
+        data["Amount"] = amount
+        if cached_amount != int(amount) and "ServiceCharge" in data and cached_amount:
+            # Another amount in the same bucket: scale the charge, which is exact for percentage fees.
+            charge = Decimal(str(data["ServiceCharge"])) * Decimal(int(amount)) / Decimal(cached_amount)
+            data["ServiceCharge"] = str(charge.quantize(Decimal("0.01")))
+        return response
+
+
+quote_cache = QuoteCache(
+    ttl=settings.QUOTE_CACHE_TTL,
+    max_entries=settings.QUOTE_CACHE_MAX_ENTRIES,
+    amount_bucket=settings.QUOTE_CACHE_AMOUNT_BUCKET,
+    per_trader=settings.QUOTE_CACHE_PER_TRADER,
+)
+
+
+def get_bill_quote(trader_id: str, amount: int, channel: int, transaction_type: int, bypass_cache: bool = False) -> dict:
+    """
+    PrepaidBill.get_bill behind the quote cache.
+    Pass bypass_cache=True when the aggregator must re-validate the trader (e.g. to confirm the registered name).
+    """
+    if bypass_cache:
+        quote_cache.record_bypass()
+    else:
+        cached = quote_cache.get(trader_id, amount, channel, transaction_type)
+        if cached is not None:
+            return cached
+    response = PrepaidBill().get_bill(trader_id=trader_id, amount=amount, channel=channel, transaction_type=transaction_type)
+    quote_cache.put(trader_id, amount, channel, transaction_type, response)
+    return response
+
+
+async def aget_bill_quote(trader_id: str, amount: int, channel: int, transaction_type: int, bypass_cache: bool = False) -> dict:
+    if bypass_cache:
+        quote_cache.record_bypass()
+    else:
+        cached = quote_cache.get(trader_id, amount, channel, transaction_type)
+        if cached is not None:
+            return cached
+    response = await AsyncPrepaidBill().get_bill(trader_id=trader_id, amount=amount, channel=channel, transaction_type=transaction_type)
+    quote_cache.put(trader_id, amount, channel, transaction_type, response)
+    return response
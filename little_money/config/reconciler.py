@@ -0,0 +1,162 @@
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from clients.holds import expire_holds
+from . import base as settings
+from .aggregator import PaymentResults
+from .audit import record_audit
+from .models import OrderQueryResponse, UnifiedOrderResponse
+from .order_status import PROCESSING, UNRESOLVED_STATUSES, transition
+
+logger = logging.getLogger(__name__)
+
+# The reconciler only polls UNRESOLVED_STATUSES orders. The webhook (or a settled
+# /orderquery) moves them to 'paid' or 'failed', after which they are never polled again.
+
+
+def _order_query_response_obj(query_response: dict, out_trade_no: str, base_amount_decimal: Decimal) -> OrderQueryResponse:
+    query_data = query_response.get("Data") if query_response and isinstance(query_response.get("Data"), dict) else None
+    return OrderQueryResponse(
+        status_code=query_response.get("StatusCode") if query_response else 0,
+        succeeded=query_response.get("Succeeded", False) if query_response else False,
+        errors=query_response.get("Errors") if query_response else "No query response",
+        extras=query_response.get("Extras") if query_response else {},
+        timestamp=query_response.get("Timestamp", int(time.time())) if query_response else int(time.time()),
+        pay_status=query_data.get("PayStatus") if query_data else None,
+        pay_time=query_data.get("PayTime") if query_data else None,
+        out_trade_no=query_data.get("OutTradeNo", out_trade_no) if query_data else out_trade_no,
+        transaction_id=query_data.get("TransactionId", "100000006") if query_data else "100000006",
+        amount=Decimal(str(query_data.get("Amount", base_amount_decimal))) if query_data else base_amount_decimal,
+        actual_payment_amount=Decimal(str(query_data.get("ActualPaymentAmount", base_amount_decimal))) if query_data else base_amount_decimal,
+        actual_collect_amount=Decimal(str(query_data.get("ActualCollectAmount", base_amount_decimal))) if query_data else base_amount_decimal,
+        payer_charge=Decimal(str(query_data.get("PayerCharge", '0.00'))) if query_data else Decimal('0.00'),
+        payee_charge=Decimal(str(query_data.get("PayeeCharge", '0.00'))) if query_data else Decimal('0.00'),
+        pay_message=query_data.get("PayMessage", "") if query_data else ""
+    )
+
+
+def _query_succeeded(query_response: dict) -> bool:
+    return bool(query_response and query_response.get("StatusCode") == 200 and query_response.get("Succeeded"))
+
+
+def first_reconcile_at():
+    """When a freshly submitted order is first queried if no webhook has resolved it."""
+    return timezone.now() + timedelta(seconds=settings.RECONCILER_INITIAL_DELAY)
+
+
+class OrderReconciler:
+    """
+    Polls /orderquery for unresolved orders with exponential backoff.
+
+    Due orders are claimed with SELECT ... FOR UPDATE SKIP LOCKED and leased by
+    pushing next_reconcile_at forward, so several reconciler processes can run
+    side by side without querying the same order twice.
+    """
+
+    def __init__(self, concurrency: int = None, batch_size: int = None):
+        self.concurrency = concurrency or settings.RECONCILER_CONCURRENCY
+        self.batch_size = batch_size or settings.RECONCILER_BATCH_SIZE
+        self.base_delay = settings.RECONCILER_BASE_DELAY
+        self.max_delay = settings.RECONCILER_MAX_DELAY
+        self.max_attempts = settings.RECONCILER_MAX_ATTEMPTS
+        # Long enough for one /orderquery including transport retries.
+        self.lease = timedelta(seconds=settings.AGGREGATOR_READ_TIMEOUTS["orderquery"] * (settings.AGGREGATOR_MAX_RETRIES + 1) * 2)
+
+    def unresolved(self):
+        return UnifiedOrderResponse.objects.filter(
+            status__in=UNRESOLVED_STATUSES,
+            reconcile_attempts__lt=self.max_attempts,
+        )
+
+    def claim_due(self) -> list:
+        now = timezone.now()
+        with transaction.atomic():
+            ids = list(
+                self.unresolved()
+                .filter(Q(next_reconcile_at__lte=now) | Q(next_reconcile_at__isnull=True))
+                .order_by(F("next_reconcile_at").asc(nulls_first=True))
+                .select_for_update(skip_locked=True)
+                .values_list("id", flat=True)[:self.batch_size]
+            )
+            UnifiedOrderResponse.objects.filter(id__in=ids).update(next_reconcile_at=now + self.lease)
+        return ids
+
+    def run_once(self) -> dict:
+        """
+        Release expired balance holds, then query every due order once. Returns how
+        many holds expired and how many orders were settled, still pending, skipped or errored.
+        """
+        holds_expired = expire_holds()
+        ids = self.claim_due()
+        summary = {"claimed": len(ids), "settled": 0, "pending": 0, "resolved_elsewhere": 0, "errors": 0, "holds_expired": holds_expired}
+        if not ids:
+            return summary
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="reconciler") as pool:
+            for outcome in pool.map(self._reconcile_safely, ids):
+                summary[outcome] += 1
+        return summary
+
+    def run_forever(self, poll_interval: float = None):
+        poll_interval = poll_interval or settings.RECONCILER_POLL_INTERVAL
+        while True:
+            summary = self.run_once()
+            if summary["claimed"]:
+                logger.info(f"Reconciler pass: {summary}")
+            if summary["claimed"] < self.batch_size:
+                time.sleep(poll_interval)
+
+    def _reconcile_safely(self, order_id: int) -> str:
+        close_old_connections()
+        try:
+            return self._reconcile(order_id)
+        except Exception:
+            logger.exception(f"Reconciling order {order_id} failed")
+            self._reschedule(order_id)
+            return "errors"
+        finally:
+            close_old_connections()
+
+    def _reconcile(self, order_id: int) -> str:
+        order = UnifiedOrderResponse.objects.filter(id=order_id, status__in=UNRESOLVED_STATUSES).first()
+        if order is None:
+            return "resolved_elsewhere"
+
+        query_response, _ = PaymentResults().get_result(order.out_trade_no)
+        record_audit(_order_query_response_obj(query_response, order.out_trade_no, order.amount or Decimal("0.00")))
+
+        data = query_response.get("Data") if _query_succeeded(query_response) else None
+        pay_status = data.get("PayStatus") if isinstance(data, dict) else None
+
+        if pay_status in (1, 2):
+            # Imported here: webhooks.views imports config.help, which imports this module.
+            from webhooks.views import settle_order
+            if settle_order(dict(data)):
+                logger.info(f"Reconciler settled order {order.out_trade_no} with PayStatus {pay_status}.")
+                return "settled"
+        elif pay_status == 0:
+            transition(PROCESSING, id=order_id)
+
+        self._reschedule(order_id)
+        return "pending"
+
+    def _reschedule(self, order_id: int):
+        order = UnifiedOrderResponse.objects.filter(id=order_id).only("reconcile_attempts").first()
+        if order is None:
+            return
+        attempts = order.reconcile_attempts + 1
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        delay = random.uniform(delay / 2, delay)  # jitter so orders submitted together spread out
+        updated = UnifiedOrderResponse.objects.filter(id=order_id, status__in=UNRESOLVED_STATUSES).update(
+            reconcile_attempts=attempts,
+            next_reconcile_at=timezone.now() + timedelta(seconds=delay),
+        )
+        if updated and attempts >= self.max_attempts:
+            logger.error(f"Giving up on order {order_id} after {attempts} status queries; it needs manual review.")
@@ -0,0 +1,237 @@
+import os
+import threading
+import time
+from collections import deque
+
+from . import base as settings
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class AggregatorUnavailable(Exception):
+    """
+    Raised before a request is sent when its endpoint's breaker is open or its
+    concurrency limit is reached. Nothing reached the aggregator, so it is always safe to retry later.
+    """
+
+    def __init__(self, endpoint: str, reason: str, retry_after: float):
+        self.endpoint = endpoint
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"Payment provider is temporarily unavailable ({reason}). Please try again shortly.")
+
+
+class CircuitBreaker:
+    """
+    Closed/open/half-open breaker over the last `window` calls.
+    A call counts as failed when it errors or takes longer than `slow_call_seconds`.
+    """
+
+    def __init__(self, failure_rate: float, window: int, min_calls: int,
+                 slow_call_seconds: float, open_seconds: float, half_open_calls: int = 1):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    return False
+                self.state = HALF_OPEN
+                self._probes = 0
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    return False
+                self._probes += 1
+            return True
+
+    def record(self, ok: bool, latency: float):
+        failed = not ok or latency > self.slow_call_seconds
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if failed:
+                    self._open()
+                else:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                return
+            self._outcomes.append(failed)
+            if self.state == CLOSED and len(self._outcomes) >= self.min_calls and self.current_failure_rate() >= self.failure_rate:
+                self._open()
+
+    def cancel_probe(self):
+        """Give back a half-open probe slot for a call that was never sent."""
+        with self._lock:
+            if self.state == HALF_OPEN and self._probes:
+                self._probes -= 1
+
+    def retry_after(self) -> float:
+        return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    def current_failure_rate(self) -> float:
+        return sum(self._outcomes) / len(self._outcomes) if self._outcomes else 0.0
+
+    def _open(self):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit. Each fast success adds 1/limit (about +1 per round trip);
+    a failure or a call slower than `latency_target` halves the limit, at most once per `latency_target`.
+    acquire() never waits: over the limit, the call is shed.
+    """
+
+    def __init__(self, initial: int, min_limit: int, max_limit: int, latency_target: float, backoff_ratio: float = 0.5):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff_ratio = backoff_ratio
+        self.in_flight = 0
+        self.shed = 0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, ok: bool, latency: float):
+        with self._lock:
+            self.in_flight -= 1
+            if ok and latency <= self.latency_target:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            else:
+                now = time.monotonic()
+                if now - self._last_decrease >= self.latency_target:
+                    self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                    self._last_decrease = now
+
+
+class EndpointGuard:
+    """Breaker plus limiter for one aggregator endpoint."""
+
+    def __init__(self, endpoint: str, breaker: CircuitBreaker, limiter: AdaptiveLimiter):
+        self.endpoint = endpoint
+        self.breaker = breaker
+        self.limiter = limiter
+
+    def acquire(self):
+        """Reserve a slot for one call or raise AggregatorUnavailable. Pair with release()."""
+        if not self.breaker.allow():
+            raise AggregatorUnavailable(self.endpoint, "circuit open", self.breaker.retry_after())
+        if not self.limiter.acquire():
+            self.breaker.cancel_probe()
+            raise AggregatorUnavailable(self.endpoint, "too many requests in flight", self.limiter.latency_target)
+        return time.monotonic()
+
+    def release(self, started: float, ok: bool):
+        latency = time.monotonic() - started
+        self.limiter.release(ok, latency)
+        self.breaker.record(ok, latency)
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.breaker.state,
+            "failure_rate": round(self.breaker.current_failure_rate(), 3),
+            "retry_after": round(self.breaker.retry_after(), 1) if self.breaker.state == OPEN else 0,
+            "limit": int(self.limiter.limit),
+            "in_flight": self.limiter.in_flight,
+            "shed": self.limiter.shed,
+        }
+
+
+class GuardRegistry:
+    def __init__(self, **options):
+        self.options = options
+        self._guards = {}
+        self._lock = threading.Lock()
+
+    def get(self, endpoint: str) -> EndpointGuard:
+        guard = self._guards.get(endpoint)
+        if guard is None:
+            with self._lock:
+                guard = self._guards.get(endpoint)
+                if guard is None:
+                    guard = self._guards[endpoint] = self._build(endpoint)
+        return guard
+
+    def snapshot(self) -> dict:
+        return {endpoint: guard.snapshot() for endpoint, guard in sorted(self._guards.items())}
+
+    def _build(self, endpoint: str) -> EndpointGuard:
+        o = self.options
+        read_timeout = o["read_timeouts"].get(endpoint, 10)
+        breaker = CircuitBreaker(
+            failure_rate=o["failure_rate"],
+            window=o["window"],
+            min_calls=o["min_calls"],
+            # A call that runs into its read timeout always counts as slow.
+            slow_call_seconds=min(o["slow_call_seconds"], read_timeout),
+            open_seconds=o["open_seconds"],
+        )
+        limiter = AdaptiveLimiter(
+            initial=o["initial_limit"],
+            min_limit=o["min_limit"],
+            max_limit=o["max_limit"],
+            latency_target=o["latency_target"],
+        )
+        return EndpointGuard(endpoint, breaker, limiter)
+
+
+def build_registry(**overrides) -> GuardRegistry:
+    """A registry configured from settings; keyword arguments override individual options."""
+    options = dict(
+        read_timeouts=settings.AGGREGATOR_READ_TIMEOUTS,
+        failure_rate=settings.AGGREGATOR_BREAKER_FAILURE_RATE,
+        window=settings.AGGREGATOR_BREAKER_WINDOW,
+        min_calls=settings.AGGREGATOR_BREAKER_MIN_CALLS,
+        slow_call_seconds=settings.AGGREGATOR_BREAKER_SLOW_CALL,
+        open_seconds=settings.AGGREGATOR_BREAKER_OPEN_SECONDS,
+        initial_limit=settings.AGGREGATOR_LIMIT_INITIAL,
+        min_limit=settings.AGGREGATOR_LIMIT_MIN,
+        max_limit=settings.AGGREGATOR_LIMIT_MAX,
+        latency_target=settings.AGGREGATOR_LIMIT_LATENCY_TARGET,
+    )
+    options.update(overrides)
+    return GuardRegistry(**options)
+
+
+_registry = None
+_registry_pid = None
+_registry_lock = threading.Lock()
+
+
+def get_guards() -> GuardRegistry:
+    """Process-wide guard registry, rebuilt after fork like the transport."""
+    global _registry, _registry_pid
+    pid = os.getpid()
+    if _registry is not None and _registry_pid == pid:
+        return _registry
+    with _registry_lock:
+        if _registry is None or _registry_pid != pid:
+            _registry = build_registry()
+            _registry_pid = pid
+    return _registry
+
+
+def unavailable_error(e: AggregatorUnavailable) -> dict:
+    """Error dict returned by the aggregator clients when a call was shed."""
+    return {"error": str(e), "unavailable": True, "retry_after": round(e.retry_after, 1)}
@@ -0,0 +1,14 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from admins.models import AdminCommissionHistory
+from finance.models import PlatformSettings
+from staff.models import StaffCommissionHistory
+from config.platform_config import platform_config
+
+
+@receiver([post_save, post_delete], sender=PlatformSettings)
+@receiver([post_save, post_delete], sender=StaffCommissionHistory)
+@receiver([post_save, post_delete], sender=AdminCommissionHistory)
+def invalidate_platform_config(sender, **kwargs):
+    platform_config.invalidate()
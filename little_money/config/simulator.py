@@ -0,0 +1,391 @@
+import heapq
+import itertools
+import json
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from django.utils import timezone
+
+from .aggregator import balance_signer, bill_signer, order_query_signer, statement_signer, unified_order_signer
+from .utils import Signer, format_number, notification_verifier
+
+logger = logging.getLogger(__name__)
+
+STATEMENT_MAX_DAYS = 3
+
+BILL_DATA_FIELDS = ["TraderID", "GivenName", "FamilyName", "FullName", "Amount", "ServiceCharge", "ServiceChargeRate"]
+ORDER_DATA_FIELDS = ["OutTradeNo", "TransactionId", "Amount", "ActualPaymentAmount", "ActualCollectAmount",
+                     "PayerCharge", "PayeeCharge", "ChannelCharge"]
+QUERY_DATA_FIELDS = ["PayStatus", "PayTime", "OutTradeNo", "TransactionId", "Amount", "ActualPaymentAmount",
+                     "ActualCollectAmount", "PayerCharge", "PayeeCharge"]
+BALANCE_DATA_FIELDS = ["Balance"]
+
+
+def _plain(data: dict) -> dict:
+    # JSON numbers, as the aggregator sends them.
+    return {k: float(v) if isinstance(v, Decimal) else v for k, v in data.items()}
+
+
+class Latency:
+    """
+    Seconds drawn from a distribution spec:
+    "fixed:0.2", "uniform:0.05,0.5" or "lognormal:0.2,0.6" (median, sigma).
+    """
+
+    def __init__(self, spec: str = "fixed:0"):
+        kind, _, args = spec.partition(":")
+        self.spec = spec
+        self.kind = kind
+        self.args = [float(a) for a in args.split(",") if a]
+        if kind not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"Unknown latency distribution '{kind}'")
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.args[0] if self.args else 0.0
+        if self.kind == "uniform":
+            return rng.uniform(self.args[0], self.args[1])
+        median, sigma = self.args
+        return rng.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+
+
+@dataclass
+class SimulatorConfig:
+    merchant_id: str
+    private_key: str
+    latency: Latency = field(default_factory=Latency)
+    endpoint_latency: dict = field(default_factory=dict)   # endpoint -> Latency
+    error_rate: float = 0.0          # share of requests answered with HTTP 502
+    timeout_rate: float = 0.0        # share of requests that hang, then drop the connection
+    hang_seconds: float = 60.0
+    success_rate: float = 0.95       # share of orders that settle with PayStatus 1
+    settle_latency: Latency = field(default_factory=lambda: Latency("uniform:1,5"))
+    processing_webhook: bool = False  # send a PayStatus 0 notification before the final one
+    duplicate_rate: float = 0.0      # share of final notifications sent twice
+    out_of_order_rate: float = 0.0   # share of orders whose PayStatus 0 notification arrives after the final one
+    webhook_retry_delays: tuple = (1, 30, 30, 30)   # LipaPay retries until it gets SUCCESS
+    webhook_url: str = None          # override every order's NotifyUrl
+    webhook_workers: int = 16
+    charge_rate: Decimal = Decimal("3")   # ServiceChargeRate, percent
+    balance: Decimal = Decimal("10000000")
+    verify_requests: bool = True
+    seed: int = None
+
+
+class AggregatorSimulator:
+    """
+    Local LipaPay-compatible aggregator: order book and endpoint logic.
+
+    Requests and responses follow the documented formats and MD5 signatures.
+    Orders settle after `settle_latency` and are announced with signed
+    notifications posted to their NotifyUrl. Thread-safe; HTTP handling lives
+    in SimulatorHandler.
+    """
+
+    request_signers = {
+        "bill": bill_signer,
+        "unifiedorder": unified_order_signer,
+        "orderquery": order_query_signer,
+        "balance": balance_signer,
+        "statement": statement_signer,
+    }
+
+    def __init__(self, config: SimulatorConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.balance = Decimal(config.balance)
+        self.orders = {}
+        self.stats = {"requests": 0, "errors_injected": 0, "timeouts_injected": 0,
+                      "webhooks_sent": 0, "webhooks_failed": 0}
+        self._lock = threading.Lock()
+        self._verifiers = {
+            endpoint: Signer(signer.field_order, config.private_key)
+            for endpoint, signer in self.request_signers.items()
+        }
+        self._data_signers = {
+            "bill": Signer(BILL_DATA_FIELDS, config.private_key, formatter=format_number),
+            "unifiedorder": Signer(ORDER_DATA_FIELDS, config.private_key, formatter=format_number),
+            "orderquery": Signer(QUERY_DATA_FIELDS, config.private_key, formatter=format_number, skip_none=True),
+            "balance": Signer(BALANCE_DATA_FIELDS, config.private_key, formatter=format_number),
+        }
+        self._notification_signer = notification_verifier(config.private_key)
+        self.webhooks = WebhookDispatcher(self)
+
+    # --- fault injection -------------------------------------------------
+
+    def latency_for(self, endpoint: str) -> float:
+        return self.config.endpoint_latency.get(endpoint, self.config.latency).sample(self.rng)
+
+    def fault_for(self) -> str:
+        roll = self.rng.random()
+        if roll < self.config.timeout_rate:
+            self._count("timeouts_injected")
+            return "timeout"
+        if roll < self.config.timeout_rate + self.config.error_rate:
+            self._count("errors_injected")
+            return "error"
+        return None
+
+    # --- endpoints -------------------------------------------------------
+
+    def handle(self, endpoint: str, payload: dict):
+        """Returns (http status, response body dict)."""
+        self._count("requests")
+        if endpoint not in self.request_signers:
+            return 404, self._result(404, errors=f"Unknown endpoint /{endpoint}")
+        if self.config.verify_requests:
+            if str(payload.get("MchID")) != str(self.config.merchant_id):
+                return 200, self._result(400, errors="Unknown MchID")
+            if payload.get("Sign") != self._verifiers[endpoint].sign(payload):
+                return 200, self._result(401, errors="Signature error")
+        return 200, getattr(self, f"_{endpoint}")(payload)
+
+    def _bill(self, payload):
+        amount = Decimal(int(payload["Amount"])) / 100
+        rate = self.config.charge_rate
+        trader_id = str(payload["TraderID"])
+        data = {
+            "TraderID": trader_id,
+            "GivenName": "Sim",
+            "FamilyName": trader_id[-4:],
+            "FullName": f"Sim {trader_id[-4:]}",
+            "Amount": int(payload["Amount"]),
+            "ServiceCharge": (amount * rate / 100).quantize(Decimal("0.01")),
+            "ServiceChargeRate": rate,
+        }
+        return self._result(200, data=self._signed("bill", data))
+
+    def _unifiedorder(self, payload):
+        out_trade_no = payload["OutTradeNo"]
+        amount = Decimal(int(payload["Amount"])) / 100
+        charge = (amount * self.config.charge_rate / 100).quantize(Decimal("0.01"))
+        collection = int(payload["TransactionType"]) == 1
+        order = {
+            "OutTradeNo": out_trade_no,
+            "TransactionId": str(uuid.uuid4()),
+            "Amount": amount,
+            "ActualPaymentAmount": amount + charge if collection else amount,
+            "ActualCollectAmount": amount if collection else amount - charge,
+            "PayerCharge": charge if collection else Decimal("0"),
+            "PayeeCharge": Decimal("0") if collection else charge,
+            "ChannelCharge": Decimal("0"),
+        }
+        with self._lock:
+            if out_trade_no in self.orders:
+                return self._result(403, errors="The merchant order number is duplicated.")
+            self.orders[out_trade_no] = dict(
+                order, PayStatus=0, PayTime=None, PayMessage="PROCESSING",
+                TransactionType=int(payload["TransactionType"]),
+                NotifyUrl=self.config.webhook_url or payload.get("NotifyUrl"),
+            )
+        self.webhooks.schedule_settlement(out_trade_no, self.config.settle_latency.sample(self.rng))
+        return self._result(200, data=self._signed("unifiedorder", order))
+
+    def _orderquery(self, payload):
+        with self._lock:
+            order = self.orders.get(payload.get("OutTradeNo"))
+            data = {k: order[k] for k in QUERY_DATA_FIELDS + ["PayMessage"]} if order else None
+        if data is None:
+            return self._result(404, errors="The order does not exist.")
+        return self._result(200, data=self._signed("orderquery", data))
+
+    def _balance(self, payload):
+        with self._lock:
+            balance = self.balance
+        return self._result(200, data=self._signed("balance", {"Balance": balance}))
+
+    def _statement(self, payload):
+        try:
+            start = datetime.strptime(payload.get("StartTime") or timezone.localdate().strftime("%Y%m%d"), "%Y%m%d").date()
+            end = datetime.strptime(payload.get("EndTime") or start.strftime("%Y%m%d"), "%Y%m%d").date()
+        except ValueError:
+            return self._result(400, errors="StartTime and EndTime must be yyyyMMdd")
+        if end < start or (end - start).days >= STATEMENT_MAX_DAYS:
+            return self._result(400, errors=f"The maximum query date range is {STATEMENT_MAX_DAYS} days")
+        first, last = f"{start:%Y-%m-%d} 00:00:00", f"{end:%Y-%m-%d} 23:59:59"
+        with self._lock:
+            items = [
+                _plain({k: order[k] for k in QUERY_DATA_FIELDS + ["PayMessage"]})
+                for order in self.orders.values()
+                if order["PayTime"] and first <= order["PayTime"] <= last
+            ]
+        return self._result(200, data={"Items": items})
+
+    # --- settlement ------------------------------------------------------
+
+    def settle(self, out_trade_no: str) -> dict:
+        """Decide the final status of an order, move the merchant balance and return its notification."""
+        succeeded = self.rng.random() < self.config.success_rate
+        with self._lock:
+            order = self.orders[out_trade_no]
+            collection = order["TransactionType"] == 1
+            if succeeded and not collection and self.balance < order["ActualPaymentAmount"]:
+                succeeded = False
+                order["PayMessage"] = "Insufficient merchant balance"
+            if succeeded:
+                self.balance += order["ActualCollectAmount"] if collection else -order["ActualPaymentAmount"]
+                order["PayMessage"] = "SUCCESS"
+            elif order["PayMessage"] == "PROCESSING":
+                order["PayMessage"] = "FAIL"
+            order["PayStatus"] = 1 if succeeded else 2
+            order["PayTime"] = timezone.localtime().strftime("%Y-%m-%d %H:%M:%S")
+            return self.notification(order)
+
+    def notification(self, order: dict, pay_status: int = None) -> dict:
+        body = {k: order[k] for k in QUERY_DATA_FIELDS + ["PayMessage"]}
+        if pay_status is not None:
+            body["PayStatus"] = pay_status
+        body = _plain(body)
+        body["Sign"] = self._notification_signer.sign(body)
+        return body
+
+    # --- helpers ---------------------------------------------------------
+
+    def _signed(self, endpoint: str, data: dict) -> dict:
+        data = _plain(data)
+        data["Sign"] = self._data_signers[endpoint].sign(data)
+        return data
+
+    def _result(self, status_code: int, data=None, errors=None) -> dict:
+        return {
+            "StatusCode": status_code,
+            "Data": data,
+            "Succeeded": status_code == 200,
+            "Errors": errors,
+            "Extras": None,
+            "Timestamp": int(time.time()),
+        }
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+
+class WebhookDispatcher:
+    """Delivers notifications at scheduled times on a worker pool, retrying until the merchant answers SUCCESS."""
+
+    def __init__(self, simulator: AggregatorSimulator):
+        self.simulator = simulator
+        self.config = simulator.config
+        self._queue = []
+        self._seq = itertools.count()
+        self._cv = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=self.config.webhook_workers, thread_name_prefix="sim-webhook")
+        self._local = threading.local()
+        self._stopped = False
+        threading.Thread(target=self._run, name="sim-webhook-scheduler", daemon=True).start()
+
+    def schedule_settlement(self, out_trade_no: str, delay: float):
+        self._schedule(delay, self._settle, out_trade_no)
+
+    def stop(self):
+        with self._cv:
+            self._stopped = True
+            self._cv.notify()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _schedule(self, delay: float, func, *args):
+        with self._cv:
+            heapq.heappush(self._queue, (time.monotonic() + delay, next(self._seq), func, args))
+            self._cv.notify()
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while not self._stopped and (not self._queue or self._queue[0][0] > time.monotonic()):
+                    self._cv.wait(self._queue[0][0] - time.monotonic() if self._queue else None)
+                if self._stopped:
+                    return
+                _, _, func, args = heapq.heappop(self._queue)
+            self._pool.submit(func, *args)
+
+    def _settle(self, out_trade_no: str):
+        sim = self.simulator
+        order = sim.orders[out_trade_no]
+        url = order["NotifyUrl"]
+        processing = sim.notification(order, pay_status=0)
+        final = sim.settle(out_trade_no)
+        if not url:
+            return
+        out_of_order = sim.rng.random() < self.config.out_of_order_rate
+        if self.config.processing_webhook and not out_of_order:
+            self._deliver(url, processing, attempt=0, retry=False)
+        self._deliver(url, final, attempt=0)
+        if out_of_order:
+            self._schedule(sim.rng.uniform(0.1, 1.0), self._deliver, url, processing, 0, False)
+        if sim.rng.random() < self.config.duplicate_rate:
+            self._schedule(sim.rng.uniform(0.1, 2.0), self._deliver, url, final, 0, False)
+
+    def _deliver(self, url: str, body: dict, attempt: int, retry: bool = True):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        try:
+            resp = session.post(url, json=body, timeout=10)
+            delivered = resp.text.strip() == "SUCCESS"
+        except requests.RequestException as e:
+            logger.warning(f"Simulator webhook for {body['OutTradeNo']} failed: {e}")
+            delivered = False
+        self.simulator._count("webhooks_sent" if delivered else "webhooks_failed")
+        if not delivered and retry and attempt < len(self.config.webhook_retry_delays):
+            self._schedule(self.config.webhook_retry_delays[attempt], self._deliver, url, body, attempt + 1)
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    simulator = None   # set by make_server
+
+    def do_POST(self):
+        sim = self.simulator
+        endpoint = self.path.rstrip("/").rsplit("/", 1)[-1]
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except json.JSONDecodeError:
+            return self._send(400, sim._result(400, errors="Invalid JSON"))
+
+        time.sleep(sim.latency_for(endpoint))
+        fault = sim.fault_for()
+        if fault == "timeout":
+            time.sleep(sim.config.hang_seconds)
+            self.close_connection = True
+            return
+        if fault == "error":
+            return self._send(502, sim._result(502, errors="The channel system is abnormal."))
+
+        status, body = sim.handle(endpoint, payload)
+        self._send(status, body)
+
+    def _send(self, status: int, body: dict):
+        raw = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SimulatorServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def make_server(config: SimulatorConfig, host: str = "127.0.0.1", port: int = 0):
+    """Build a simulator server; call serve_forever() (or run it in a thread) and read server_port."""
+    simulator = AggregatorSimulator(config)
+    handler = type("BoundSimulatorHandler", (SimulatorHandler,), {"simulator": simulator})
+    server = SimulatorServer((host, port), handler)
+    server.simulator = simulator
+    return server
@@ -0,0 +1,103 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from . import base as settings
+from .aggregator import GetStatementOfAccount
+from .models import StatementDay
+
+logger = logging.getLogger(__name__)
+
+
+def _days(start: date, end: date):
+    day = start
+    while day <= end:
+        yield day
+        day += timedelta(days=1)
+
+
+class StatementSync:
+    """
+    Syncs the aggregator statement one day per /statement call on a bounded worker pool.
+
+    Each day is saved as soon as it arrives. Days before today are closed and
+    skipped on later runs, so an interrupted sync resumes with the days it had
+    not finished. Today stays open and is fetched again every run.
+    """
+
+    def __init__(self, workers: int = None):
+        self.workers = workers or settings.STATEMENT_SYNC_WORKERS
+
+    def pending_days(self, start: date, end: date) -> list:
+        closed = set(
+            StatementDay.objects.filter(day__range=(start, end), closed=True).values_list("day", flat=True)
+        )
+        return [day for day in _days(start, end) if day not in closed]
+
+    def sync(self, start: date, end: date) -> dict:
+        """
+        Fetch every day in [start, end] that is not already closed.
+        Returns counts of fetched, skipped and failed days plus the failed dates.
+        """
+        end = min(end, timezone.localdate())
+        pending = self.pending_days(start, end)
+        summary = {
+            "fetched": 0,
+            "skipped": (end - start).days + 1 - len(pending) if end >= start else 0,
+            "failed": [],
+            "items": 0,
+        }
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="statement-sync") as pool:
+            futures = {pool.submit(self._sync_day, day): day for day in pending}
+            for future in as_completed(futures):
+                day = futures[future]
+                try:
+                    statement_day = future.result()
+                except Exception:
+                    logger.exception(f"Statement sync for {day} raised")
+                    summary["failed"].append(day)
+                    continue
+                if statement_day.succeeded:
+                    summary["fetched"] += 1
+                    summary["items"] += statement_day.item_count
+                else:
+                    logger.warning(f"Statement for {day} failed: {statement_day.errors}")
+                    summary["failed"].append(day)
+
+        summary["failed"].sort()
+        return summary
+
+    def _sync_day(self, day: date) -> StatementDay:
+        close_old_connections()
+        try:
+            stamp = day.strftime("%Y%m%d")
+            response = GetStatementOfAccount().fetch(start_date=stamp, end_date=stamp)
+            return self._save_day(day, response)
+        finally:
+            close_old_connections()
+
+    def _save_day(self, day: date, response: dict) -> StatementDay:
+        if "error" in response:
+            # Transport failure: nothing worth storing, the day is retried next run.
+            return StatementDay(day=day, status_code=0, succeeded=False, errors=response["error"])
+
+        data = response.get("Data") if isinstance(response.get("Data"), dict) else {}
+        items = data.get("Items") or []
+        succeeded = response.get("StatusCode") == 200 and bool(response.get("Succeeded"))
+        errors = response.get("Errors")
+        statement_day, _ = StatementDay.objects.update_or_create(
+            day=day,
+            defaults={
+                "status_code": response.get("StatusCode", 0),
+                "succeeded": succeeded,
+                "errors": str(errors) if errors else None,
+                "items": items,
+                "item_count": len(items),
+                "closed": succeeded and day < timezone.localdate(),
+            },
+        )
+        return statement_day
@@ -1,3 +1,1069 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.core.cache import cache
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models.signals import post_save
+from django.http import JsonResponse
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+
+from clients.holds import attach_hold, place_hold, release_unused
+from clients.models import BalanceHold, Client, Finances, RecentTransaction
+from core.models import CustomUser, TransactionIDCounter
+from finance.models import PlatformSettings, SystemEarnings
+from staff.models import Balance, ClientAssignment, Staff
+from . import base as settings
+from .aggregator import order_query_signer, unified_order_signer
+from .async_aggregator import AsyncAggregatorTransport, get_async_transport
+from .audit import AuditSink
+from .balance_cache import INVALIDATED_AT_KEY, BalanceCache
+from .help import _process_transaction, process_transaction
+from .idempotency import REPLAYED_HEADER, retryable, run_idempotent
+from .ids import EPOCH_MS, MAX_SEQUENCE, BlockAllocator, NodeLease, OutTradeNoGenerator
+from .job_queue import PaymentJobWorker, enqueue_payment
+from .management.commands.bench_signatures import ORDER_FIELDS, _legacy_generate, _legacy_verify
+from .models import BalanceRequest, ConfigVersion, IdempotencyRecord, IdNode, PaymentJob, StatementDay, UnifiedOrderRequest, UnifiedOrderResponse
+from .platform_config import PlatformConfigCache
+from .quote_cache import QuoteCache
+from .reconciler import OrderReconciler
+from .resilience import CLOSED, HALF_OPEN, OPEN, AggregatorUnavailable, build_registry
+from .simulator import AggregatorSimulator, Latency, SimulatorConfig
+from .statement_sync import StatementSync
+from .transport import AggregatorTransport
+from .utils import Signer, notification_verifier, verify_signature
+
+
+class _LatencyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.calls += 1
+        time.sleep(self.server.latency)
+        body = json.dumps({"StatusCode": 200, "Succeeded": True, "Data": {"Balance": 1}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AggregatorResilienceTests(SimpleTestCase):
+    """Breaker and limiter behaviour against a local aggregator stub with injected latency."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _LatencyHandler)
+        self.server.daemon_threads = True
+        self.server.latency = 0
+        self.server.calls = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def transport(self, **overrides):
+        options = dict(
+            read_timeouts={"balance": 0.2},
+            failure_rate=0.5,
+            window=4,
+            min_calls=4,
+            slow_call_seconds=0.1,
+            open_seconds=0.3,
+            initial_limit=2,
+            min_limit=1,
+            max_limit=4,
+            latency_target=0.1,
+        )
+        options.update(overrides)
+        transport = AggregatorTransport(
+            base_url=f"http://127.0.0.1:{self.server.server_port}",
+            pool_maxsize=4,
+            connect_timeout=1,
+            read_timeouts=options["read_timeouts"],
+            max_retries=0,
+            retry_backoff=0,
+            guards=build_registry(**options),
+        )
+        self.addCleanup(transport.close)
+        return transport
+
+    def test_slow_calls_open_the_breaker_and_fail_fast(self):
+        transport = self.transport(initial_limit=4)
+        self.server.latency = 0.15
+        for _ in range(4):
+            transport.post("balance", {})
+        guard = transport.guards.get("balance")
+        self.assertEqual(guard.breaker.state, OPEN)
+
+        calls = self.server.calls
+        started = time.monotonic()
+        with self.assertRaises(AggregatorUnavailable) as ctx:
+            transport.post("balance", {})
+        self.assertLess(time.monotonic() - started, 0.05)
+        self.assertEqual(self.server.calls, calls)
+        self.assertGreater(ctx.exception.retry_after, 0)
+
+    def test_timeouts_count_as_failures(self):
+        transport = self.transport(initial_limit=4)
+        self.server.latency = 0.3
+        for _ in range(4):
+            with self.assertRaises(requests.Timeout):
+                transport.post("balance", {})
+        self.assertEqual(transport.guards.get("balance").breaker.state, OPEN)
+
+    def test_half_open_probe_closes_breaker_after_recovery(self):
+        transport = self.transport(initial_limit=4)
+        self.server.latency = 0.15
+        for _ in range(4):
+            transport.post("balance", {})
+        guard = transport.guards.get("balance")
+
+        self.server.latency = 0
+        time.sleep(0.35)
+        self.assertTrue(guard.breaker.allow())
+        self.assertEqual(guard.breaker.state, HALF_OPEN)
+        self.assertFalse(guard.breaker.allow())  # a single probe at a time
+        guard.breaker.cancel_probe()
+
+        transport.post("balance", {})
+        self.assertEqual(guard.breaker.state, CLOSED)
+
+    def test_limiter_sheds_calls_over_the_limit(self):
+        transport = self.transport(slow_call_seconds=1, read_timeouts={"balance": 1})
+        self.server.latency = 0.2
+
+        def call(_):
+            try:
+                transport.post("balance", {})
+                return "ok"
+            except AggregatorUnavailable:
+                return "shed"
+
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            results = list(pool.map(call, range(6)))
+        self.assertEqual(results.count("ok"), 2)
+        self.assertEqual(results.count("shed"), 4)
+        self.assertEqual(self.server.calls, 2)
+
+        snapshot = transport.guards.snapshot()["balance"]
+        self.assertEqual(snapshot["shed"], 4)
+        self.assertEqual(snapshot["in_flight"], 0)
+
+    def test_limit_grows_when_fast_and_halves_when_slow(self):
+        transport = self.transport(initial_limit=2, slow_call_seconds=1, read_timeouts={"balance": 1})
+        limiter = transport.guards.get("balance").limiter
+        for _ in range(8):
+            transport.post("balance", {})
+        self.assertEqual(limiter.limit, 4)
+
+        self.server.latency = 0.15
+        transport.post("balance", {})
+        self.assertEqual(limiter.limit, 2)
+
+
+FROZEN_MS = 1709850628000  # 2024-03-07 22:30:28 UTC, already 2024-03-08 in Nairobi
+
+
+def _generate_on_node(args):
+    node_id, n = args
+    generator = OutTradeNoGenerator(node_id=node_id, clock=lambda: FROZEN_MS)
+    return [generator.next() for _ in range(n)]
+
+
+class OutTradeNoGeneratorTests(SimpleTestCase):
+    def test_processes_on_distinct_nodes_never_collide(self):
+        # Every process is stuck on the same millisecond, the worst case for the old counter.
+        with multiprocessing.get_context("fork").Pool(4) as pool:
+            batches = pool.map(_generate_on_node, [(node_id, 10000) for node_id in range(4)])
+        ids = [unique_id for batch in batches for unique_id in batch]
+        self.assertEqual(len(set(ids)), 40000)
+        for batch in batches:
+            self.assertEqual(batch, sorted(batch))
+
+    def test_format_keeps_the_dated_prefix(self):
+        out_trade_no = OutTradeNoGenerator(node_id=5, clock=lambda: FROZEN_MS).next()
+        self.assertTrue(out_trade_no.startswith("UGMP-20240308-"))
+        self.assertLessEqual(len(out_trade_no), 36)
+        unique_id = int(out_trade_no.rsplit("-", 1)[1])
+        self.assertEqual((unique_id >> 22) + EPOCH_MS, FROZEN_MS)
+        self.assertEqual((unique_id >> 12) & 1023, 5)
+
+    def test_sequence_overflow_borrows_the_next_millisecond(self):
+        generator = OutTradeNoGenerator(node_id=1, clock=lambda: FROZEN_MS)
+        ids = [generator.next_id() for _ in range(MAX_SEQUENCE + 2)]
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual((ids[-1] >> 22) + EPOCH_MS, FROZEN_MS + 1)
+
+    def test_clock_stepping_back_never_reuses_an_id(self):
+        ticks = iter([FROZEN_MS, FROZEN_MS + 5, FROZEN_MS - 1000, FROZEN_MS - 999, FROZEN_MS + 6])
+        generator = OutTradeNoGenerator(node_id=1, clock=lambda: next(ticks))
+        ids = [generator.next_id() for _ in range(5)]
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_rejects_node_out_of_range(self):
+        with self.assertRaises(ValueError):
+            OutTradeNoGenerator(node_id=1024)
+
+
+class NodeLeaseTests(TransactionTestCase):
+    def lease(self):
+        lease = NodeLease(lease_seconds=60)
+        self.addCleanup(lease.release)
+        return lease
+
+    def test_concurrent_leases_get_distinct_nodes(self):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            nodes = list(pool.map(lambda _: self.lease().acquire(), range(8)))
+        self.assertEqual(sorted(nodes), list(range(8)))
+
+    def test_expired_lease_is_reused(self):
+        first = self.lease()
+        node_id = first.acquire()
+        IdNode.objects.filter(node_id=node_id).update(leased_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.lease().acquire(), node_id)
+        self.assertEqual(IdNode.objects.count(), 1)
+
+
+class BlockAllocatorTests(TransactionTestCase):
+    def test_workers_never_share_an_id(self):
+        workers = [BlockAllocator("test", block_size=10) for _ in range(4)]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            batches = list(pool.map(lambda i: [workers[i % 4].next() for _ in range(100)], range(8)))
+        ids = [value for batch in batches for value in batch]
+        self.assertEqual(len(set(ids)), 800)
+        self.assertEqual(TransactionIDCounter.objects.get(name="test").next_value, 801)
+
+    def test_take_spans_blocks(self):
+        allocator = BlockAllocator("test", block_size=10, seed=lambda: 100)
+        self.assertEqual(allocator.next(), 100)
+        self.assertEqual(allocator.take(25), list(range(101, 126)))
+        self.assertEqual(allocator.next(), 126)
+
+    def test_rolled_back_ids_are_not_handed_out_again(self):
+        first = BlockAllocator("test", block_size=10)
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            rolled_back = first.next()
+            raise RuntimeError
+        self.assertGreaterEqual(BlockAllocator("test", block_size=10).next(), rolled_back + 10)
+
+
+class UnifiedOrderOutcomeTests(TestCase):
+    """What _process_transaction records for each kind of /unifiedorder answer."""
+
+    def setUp(self):
+        user = CustomUser.objects.create(username="orders", role="client")
+        self.client_obj = Client.objects.create(user=user, name="Orders")
+        Finances.objects.create(client=self.client_obj, balance=Decimal("1000.00"))
+        SystemEarnings.load()
+        quote = mock.patch("config.help.get_bill_quote", return_value={"StatusCode": 200, "Data": {"FullName": "Payee"}})
+        quote.start()
+        self.addCleanup(quote.stop)
+
+    def submit(self, body=None, error=None, hold_id=None, idempotency_key=None):
+        response = mock.Mock(status_code=200, text="")
+        response.json.return_value = body
+        transport = mock.Mock()
+        transport.post.side_effect = error or (lambda *args: response)
+        with mock.patch("config.aggregator.get_transport", return_value=transport):
+            if idempotency_key:
+                return process_transaction(1, 2, self.client_obj.id, Decimal("100"), "256700000000", "test", "Payee",
+                                           idempotency_key=idempotency_key, hold_id=hold_id)
+            return _process_transaction(1, 2, self.client_obj.id, Decimal("100"), "256700000000", "test", "Payee", hold_id=hold_id)
+
+    def test_rejected_orders_fail_with_their_own_out_trade_no_and_release_the_hold(self):
+        hold = place_hold(self.client_obj.id, Decimal("100"))
+        for hold_id in (hold.id, None):
+            result = self.submit({"StatusCode": 400, "Succeeded": False, "Errors": "Invalid trader"}, hold_id=hold_id)
+            self.assertEqual(result.status_code, 400)
+
+        orders = UnifiedOrderResponse.objects.all()
+        self.assertEqual(len({order.out_trade_no for order in orders}), 2)
+        self.assertEqual({(order.status, order.next_reconcile_at) for order in orders}, {("failed", None)})
+        self.assertIsNone(BalanceHold.objects.get(id=hold.id).out_trade_no)
+        self.assertTrue(release_unused(hold.id))
+        totals = SystemEarnings.load()
+        self.assertEqual((totals.total_transactions, totals.total_successful_transactions), (2, 0))
+
+    def test_transport_failure_is_left_to_the_reconciler_with_the_hold(self):
+        hold = place_hold(self.client_obj.id, Decimal("100"))
+        result = self.submit(error=requests.ConnectionError("reset"), hold_id=hold.id)
+
+        self.assertEqual(result.status_code, 202)
+        order = UnifiedOrderResponse.objects.get()
+        self.assertEqual(order.status, "pending")
+        self.assertIsNotNone(order.next_reconcile_at)
+        self.assertEqual(BalanceHold.objects.get(id=hold.id).out_trade_no, order.out_trade_no)
+
+    def test_accepted_order_is_pending_and_counted(self):
+        result = self.submit({"StatusCode": 200, "Succeeded": True, "Data": {"TransactionId": "T1"}})
+
+        self.assertEqual(result.status_code, 200)
+        order = UnifiedOrderResponse.objects.get()
+        self.assertEqual((order.status, order.transaction_id), ("pending", "T1"))
+        self.assertTrue(order.out_trade_no.startswith("UGMP-"))
+        self.assertEqual(SystemEarnings.load().total_successful_transactions, 1)
+
+    def test_failure_after_submission_is_pending_and_never_resubmitted(self):
+        accepted = {"StatusCode": 200, "Succeeded": True, "Data": {"TransactionId": "T1"}}
+        with mock.patch("config.help._record_system_earnings", side_effect=DatabaseError("connection lost")):
+            first = self.submit(accepted, idempotency_key="key-1")
+        again = self.submit(accepted, idempotency_key="key-1")
+
+        self.assertEqual((first.status_code, again.status_code), (202, 202))
+        self.assertEqual(again[REPLAYED_HEADER], "true")
+        self.assertEqual(UnifiedOrderResponse.objects.get().status, "pending")
+
+    def test_failure_before_submission_is_retried(self):
+        with mock.patch("config.help.get_bill_quote", return_value={"error": "timeout"}):
+            self.assertEqual(self.submit(idempotency_key="key-1").status_code, 500)
+        accepted = {"StatusCode": 200, "Succeeded": True, "Data": {"TransactionId": "T1"}}
+        self.assertEqual(self.submit(accepted, idempotency_key="key-1").status_code, 200)
+        self.assertEqual(UnifiedOrderResponse.objects.count(), 1)
+
+
+class PlatformConfigVersionTests(TestCase):
+    def test_saved_fee_is_seen_by_every_worker(self):
+        PlatformSettings.objects.create(platform_fee_percent=Decimal("2.00"))
+        workers = [PlatformConfigCache(), PlatformConfigCache()]
+        self.assertEqual({w.get().platform_fee_percent for w in workers}, {Decimal("2.00")})
+
+        with transaction.atomic():
+            PlatformSettings.objects.update_or_create(pk=PlatformSettings.objects.get().pk, defaults={"platform_fee_percent": Decimal("3.00")})
+        self.assertEqual(ConfigVersion.objects.get().version, 2)
+        self.assertEqual({w.get().platform_fee_percent for w in workers}, {Decimal("3.00")})
+
+    def test_snapshot_is_reused_until_the_version_changes(self):
+        PlatformSettings.objects.create(platform_fee_percent=Decimal("2.00"))
+        worker = PlatformConfigCache()
+        first = worker.get()
+        with self.assertNumQueries(1):
+            self.assertIs(worker.get(), first)
+
+    def test_rolled_back_save_keeps_the_version(self):
+        PlatformSettings.objects.create(platform_fee_percent=Decimal("2.00"))
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            PlatformSettings.objects.update(platform_fee_percent=Decimal("9.00"))
+            PlatformSettings.objects.get().save()
+            raise RuntimeError
+        self.assertEqual(ConfigVersion.objects.get().version, 1)
+        self.assertEqual(PlatformConfigCache().get().platform_fee_percent, Decimal("2.00"))
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        self.calls = 0
+
+    def respond(self, status=200):
+        def call():
+            self.calls += 1
+            return JsonResponse({"status": "ok", "call": self.calls}, status=status)
+        return call
+
+    def test_repeat_replays_the_first_response(self):
+        first = run_idempotent("1:key", "hash", self.respond(), ttl=60)
+        again = run_idempotent("1:key", "hash", self.respond(), ttl=60)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(json.loads(again.content), json.loads(first.content))
+        self.assertEqual(again[REPLAYED_HEADER], "true")
+
+    def test_key_reused_for_another_request_is_rejected(self):
+        run_idempotent("1:key", "hash", self.respond(), ttl=60)
+        self.assertEqual(run_idempotent("1:key", "other", self.respond(), ttl=60).status_code, 422)
+        self.assertEqual(self.calls, 1)
+
+    def test_retryable_responses_are_not_kept(self):
+        shed = lambda: retryable(self.respond(503)())
+        self.assertEqual(run_idempotent("1:key", "hash", shed, ttl=60).status_code, 503)
+        self.assertEqual(run_idempotent("1:key", "hash", self.respond(), ttl=60).status_code, 200)
+        self.assertEqual(self.calls, 2)
+
+    def test_unmarked_server_errors_are_replayed(self):
+        self.assertEqual(run_idempotent("1:key", "hash", self.respond(500), ttl=60).status_code, 500)
+        again = run_idempotent("1:key", "hash", self.respond(), ttl=60)
+        self.assertEqual((again.status_code, again[REPLAYED_HEADER]), (500, "true"))
+        self.assertEqual(self.calls, 1)
+
+    def test_duplicate_of_a_running_request_gets_409(self):
+        IdempotencyRecord.objects.create(key="1:key", fingerprint="hash", expires_at=timezone.now() + timedelta(seconds=60))
+        with mock.patch.object(settings, "IDEMPOTENCY_WAIT_TIMEOUT", 0):
+            self.assertEqual(run_idempotent("1:key", "hash", self.respond(), ttl=60).status_code, 409)
+        self.assertEqual(self.calls, 0)
+
+    def test_stale_in_progress_record_is_taken_over(self):
+        IdempotencyRecord.objects.create(key="1:key", fingerprint="hash", expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(run_idempotent("1:key", "hash", self.respond(), ttl=60).status_code, 200)
+        record = IdempotencyRecord.objects.get(key="1:key")
+        self.assertEqual(record.status, "completed")
+        self.assertGreater(record.expires_at, timezone.now() + timedelta(seconds=50))
+
+    def test_in_progress_record_is_leased(self):
+        with mock.patch.object(settings, "IDEMPOTENCY_LEASE", 5):
+            def call():
+                record = IdempotencyRecord.objects.get(key="1:key")
+                self.assertLessEqual(record.expires_at, timezone.now() + timedelta(seconds=5))
+                return self.respond()()
+            run_idempotent("1:key", "hash", call, ttl=3600)
+        self.assertEqual(self.calls, 1)
+
+    def test_taken_over_request_does_not_overwrite_its_successor(self):
+        def slow_call():
+            # The lease runs out and a retry takes the key over before this finishes.
+            IdempotencyRecord.objects.filter(key="1:key").update(expires_at=timezone.now() - timedelta(seconds=1))
+            run_idempotent("1:key", "hash", self.respond(), ttl=60)
+            return JsonResponse({"status": "ok", "call": "slow"})
+
+        run_idempotent("1:key", "hash", slow_call, ttl=60)
+        self.assertEqual(IdempotencyRecord.objects.get(key="1:key").response_body, {"status": "ok", "call": 1})
+
+    def test_claim_retries_when_the_conflicting_record_vanished(self):
+        create = IdempotencyRecord.objects.create
+        attempts = []
+
+        def flaky_create(**kwargs):
+            attempts.append(kwargs["key"])
+            if len(attempts) == 1:
+                raise IntegrityError  # the holder finished with a 5xx and deleted its row
+            return create(**kwargs)
+
+        with mock.patch.object(IdempotencyRecord.objects, "create", side_effect=flaky_create):
+            self.assertEqual(run_idempotent("1:key", "hash", self.respond(), ttl=60).status_code, 200)
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(self.calls, 1)
+
+
+class _StubAggregatorHandler(BaseHTTPRequestHandler):
+    """Answers with the queued status codes (200 once they run out) and records each client address."""
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.calls += 1
+        self.server.peers.add(self.client_address)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        body = json.dumps({"StatusCode": status, "Succeeded": status == 200, "Data": {"Balance": 1}}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AggregatorTransportTests(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _StubAggregatorHandler)
+        self.server.daemon_threads = True
+        self.server.calls = 0
+        self.server.peers = set()
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.transport = AggregatorTransport(
+            base_url=f"http://127.0.0.1:{self.server.server_port}", pool_maxsize=4, connect_timeout=1,
+            read_timeouts={}, max_retries=2, retry_backoff=0,
+        )
+        self.addCleanup(self.transport.close)
+
+    def test_calls_reuse_one_keep_alive_connection(self):
+        for _ in range(5):
+            self.assertEqual(self.transport.post("balance", {}).status_code, 200)
+        self.assertEqual(self.server.calls, 5)
+        self.assertEqual(len(self.server.peers), 1)
+
+    def test_read_only_endpoints_are_retried_on_gateway_errors(self):
+        self.server.statuses = [503, 502]
+        self.assertEqual(self.transport.post("balance", {}).status_code, 200)
+        self.assertEqual(self.server.calls, 3)
+
+    def test_unifiedorder_is_never_retried(self):
+        self.server.statuses = [503]
+        self.assertEqual(self.transport.post("unifiedorder", {}).status_code, 503)
+        self.assertEqual(self.server.calls, 1)
+
+    def test_retries_give_up_with_the_last_response(self):
+        self.server.statuses = [503, 503, 503, 503]
+        self.assertEqual(self.transport.post("orderquery", {}).status_code, 503)
+        self.assertEqual(self.server.calls, 3)
+
+
+class AsyncAggregatorTransportTests(SimpleTestCase):
+    """The asyncio transport retries and guards calls the way the sync one does."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _StubAggregatorHandler)
+        self.server.daemon_threads = True
+        self.server.calls = 0
+        self.server.peers = set()
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def post(self, endpoint, **options):
+        async def call():
+            transport = AsyncAggregatorTransport(
+                base_url=f"http://127.0.0.1:{self.server.server_port}", max_connections=4, connect_timeout=1,
+                read_timeouts={}, max_retries=2, retry_backoff=0, **options,
+            )
+            try:
+                return await transport.post(endpoint, {})
+            finally:
+                await transport.aclose()
+        return asyncio.run(call())
+
+    def test_one_client_per_event_loop(self):
+        async def transports():
+            first = get_async_transport()
+            second = get_async_transport()
+            await first.aclose()
+            return first, second
+
+        first, again = asyncio.run(transports())
+        other, _ = asyncio.run(transports())
+        self.assertIs(first, again)
+        self.assertIsNot(first, other)
+        self.assertIsNot(first.client, other.client)
+
+    def test_read_only_endpoints_are_retried_on_gateway_errors(self):
+        self.server.statuses = [503, 502]
+        self.assertEqual(self.post("balance").status_code, 200)
+        self.assertEqual(self.server.calls, 3)
+
+    def test_unifiedorder_is_never_retried(self):
+        self.server.statuses = [503]
+        self.assertEqual(self.post("unifiedorder").status_code, 503)
+        self.assertEqual(self.server.calls, 1)
+
+    def test_server_errors_open_the_breaker(self):
+        guards = build_registry(failure_rate=0.5, window=2, min_calls=2, open_seconds=60)
+        self.server.statuses = [500, 500]
+        for _ in range(2):
+            self.assertEqual(self.post("unifiedorder", guards=guards).status_code, 500)
+        self.assertEqual(guards.get("unifiedorder").breaker.state, OPEN)
+        with self.assertRaises(AggregatorUnavailable):
+            self.post("unifiedorder", guards=guards)
+        self.assertEqual(self.server.calls, 2)
+
+    def test_limiter_sheds_calls_over_the_limit(self):
+        guards = build_registry(initial_limit=1, min_limit=1, max_limit=1)
+        guard = guards.get("balance")
+        started = guard.acquire()  # another call in flight holds the only slot
+        with self.assertRaises(AggregatorUnavailable):
+            self.post("balance", guards=guards)
+        guard.release(started, ok=True)
+        self.assertEqual(self.server.calls, 0)
+        self.assertEqual(self.post("balance", guards=guards).status_code, 200)
+        self.assertEqual(guards.snapshot()["balance"]["in_flight"], 0)
+
+
+class SignatureTests(SimpleTestCase):
+    """The compiled Signer and Verifier produce exactly what the per-call code they replaced did."""
+
+    KEY = "db761034110c45058490c6772a99b4ab"
+
+    def notification(self, **overrides):
+        data = {
+            "PayStatus": 1, "PayTime": "2024-03-08 10:00:00", "OutTradeNo": "20240308100000000001",
+            "TransactionId": "TX1", "Amount": Decimal("1000.50"), "ActualPaymentAmount": 1000.5,
+            "ActualCollectAmount": 1000, "PayerCharge": None, "PayeeCharge": "0",
+        }
+        data.update(overrides)
+        data["Sign"] = notification_verifier(self.KEY).sign(data)
+        return data
+
+    def legacy_verify(self, data):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return _legacy_verify(data, self.KEY, mock.Mock())
+
+    def test_signer_matches_the_old_generate_signature(self):
+        params = {
+            "Version": "v1.0", "MchID": 100001, "TimeStamp": 1694757261, "Channel": 1,
+            "OutTradeNo": "20240101120000000001", "Amount": 100000, "TransactionType": 2, "TraderID": "0770000000",
+        }
+        self.assertEqual(Signer(ORDER_FIELDS, self.KEY).sign(params), _legacy_generate(params, ORDER_FIELDS, self.KEY))
+
+    def test_verifier_agrees_with_the_old_verify_signature(self):
+        good = self.notification()
+        forged = {**good, "Amount": Decimal("1000000")}
+        unsigned = {key: value for key, value in good.items() if key != "Sign"}
+        for data in (good, forged, unsigned, self.notification(PayStatus=2, PayeeCharge=None)):
+            self.assertEqual(verify_signature(data, self.KEY), self.legacy_verify(data))
+        self.assertTrue(verify_signature(good, self.KEY))
+
+    def test_verify_many_rejects_the_forged_items_of_a_mixed_batch(self):
+        good = self.notification()
+        forged = {**self.notification(OutTradeNo="20240308100000000002"), "ActualCollectAmount": 1000000}
+        resigned_with_another_key = {**good, "Sign": notification_verifier("other-key").sign(good)}
+        unsigned = {key: value for key, value in good.items() if key != "Sign"}
+        payloads = [good, forged, self.notification(OutTradeNo="20240308100000000003"), resigned_with_another_key, unsigned]
+        self.assertEqual(notification_verifier(self.KEY).verify_many(payloads), [True, False, True, False, False])
+
+
+@mock.patch.object(AuditSink, "_ensure_thread")  # flushed by hand, on the test's connection
+class AuditSinkTests(TestCase):
+    def setUp(self):
+        spool = tempfile.TemporaryDirectory()
+        self.addCleanup(spool.cleanup)
+        self.spool_dir = spool.name
+
+    def sink(self):
+        return AuditSink(self.spool_dir, batch_size=100, flush_interval=3600)
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.spool_dir) if name.endswith(".jsonl"))
+
+    def test_rows_are_spooled_then_written_in_one_insert(self, _):
+        sink = self.sink()
+        with self.assertNumQueries(0):
+            for timestamp in range(5):
+                sink.add(BalanceRequest(timestamp=timestamp))
+        self.assertEqual(len(self.segments()), 1)
+
+        with self.assertNumQueries(3):  # savepoint, INSERT, release
+            self.assertEqual(sink.flush(), 5)
+        self.assertEqual(sorted(BalanceRequest.objects.values_list("timestamp", flat=True)), [0, 1, 2, 3, 4])
+        self.assertEqual(self.segments(), [])
+
+    def test_segment_of_a_dead_process_is_replayed_once(self, _):
+        crashed = self.sink()
+        for timestamp in range(3):
+            crashed.add(BalanceRequest(timestamp=timestamp))
+        crashed._segment.close()  # the process died before flushing; its lock goes with it
+
+        self.assertEqual(self.sink().replay(), 3)
+        self.assertEqual(BalanceRequest.objects.count(), 3)
+        self.assertEqual(self.segments(), [])
+        self.assertEqual(self.sink().replay(), 0)
+
+    def test_segment_of_a_live_sink_is_left_alone(self, _):
+        live = self.sink()
+        live.add(BalanceRequest(timestamp=1))
+        self.assertEqual(self.sink().replay(), 0)
+        self.assertEqual(live.replay(), 0)
+        self.assertEqual(live.flush(), 1)
+        self.assertEqual(BalanceRequest.objects.count(), 1)
+
+    def test_unreadable_lines_are_skipped(self, _):
+        crashed = self.sink()
+        crashed.add(BalanceRequest(timestamp=1))
+        crashed._segment.write("{not json\n")
+        crashed._segment.close()
+        self.assertEqual(self.sink().replay(), 1)
+        self.assertEqual(self.segments(), [])
+
+    def test_segment_is_deleted_before_its_lock_is_released(self, _):
+        sink = self.sink()
+        sink.add(BalanceRequest(timestamp=1))
+        segment = sink._segment
+
+        def unlink(path):
+            self.assertFalse(segment.closed)
+            os.remove(path)
+        with mock.patch("config.audit.os.unlink", side_effect=unlink):
+            self.assertEqual(sink.flush(), 1)
+        self.assertTrue(segment.closed)
+        self.assertEqual(self.segments(), [])
+
+    def test_segment_flushed_while_being_opened_is_not_replayed(self, _):
+        crashed = self.sink()
+        crashed.add(BalanceRequest(timestamp=1))
+        crashed._segment.close()
+
+        def open_then_lose_the_race(path, *args, **kwargs):
+            handle = open(path, *args, **kwargs)
+            os.remove(path)  # its owner flushed and deleted it before replay() took the lock
+            return handle
+        with mock.patch("config.audit.open", side_effect=open_then_lose_the_race, create=True):
+            self.assertEqual(self.sink().replay(), 0)
+        self.assertFalse(BalanceRequest.objects.exists())
+
+
+def _bill(charge="10.00", name="Jane Doe"):
+    return {"StatusCode": 200, "Succeeded": True, "Data": {"ServiceCharge": charge, "FullName": name, "Amount": 1000}}
+
+
+class QuoteCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        clock = mock.patch("config.quote_cache.time")
+        clock.start().monotonic.side_effect = lambda: self.now
+        self.addCleanup(clock.stop)
+
+    def test_entries_expire_after_the_ttl(self):
+        cache = QuoteCache(ttl=60, max_entries=10)
+        cache.put("256700000001", 1000, 1, 2, _bill())
+        self.now += 59
+        self.assertIsNotNone(cache.get("256700000001", 1000, 1, 2))
+        self.now += 2
+        self.assertIsNone(cache.get("256700000001", 1000, 1, 2))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = QuoteCache(ttl=60, max_entries=2)
+        cache.put("t", 100, 1, 2, _bill())
+        cache.put("t", 200, 1, 2, _bill())
+        cache.get("t", 100, 1, 2)
+        cache.put("t", 300, 1, 2, _bill())
+        self.assertIsNotNone(cache.get("t", 100, 1, 2))
+        self.assertIsNone(cache.get("t", 200, 1, 2))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_shared_quote_drops_the_trader_name_and_keeps_errors_out(self):
+        cache = QuoteCache(ttl=60, max_entries=10)
+        cache.put("256700000001", 1000, 1, 2, _bill())
+        cache.put("256700000001", 2000, 1, 2, {"StatusCode": 400, "Data": None})
+        quote = cache.get("256700000002", 1000, 1, 2)
+        self.assertEqual(quote["Data"]["TraderID"], "256700000002")
+        self.assertNotIn("FullName", quote["Data"])
+        self.assertIsNone(cache.get("256700000001", 2000, 1, 2))
+
+    def test_amounts_in_one_bucket_scale_the_charge(self):
+        cache = QuoteCache(ttl=60, max_entries=10, amount_bucket=1000)
+        cache.put("t", 1000, 1, 2, _bill(charge="10.00"))
+        quote = cache.get("t", 1500, 1, 2)
+        self.assertEqual(quote["Data"]["ServiceCharge"], "15.00")
+        self.assertEqual(quote["Data"]["Amount"], 1500)
+
+
+class BalanceCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.delete(INVALIDATED_AT_KEY)
+        self.responses = []
+        get_balance = mock.patch("config.balance_cache.GetBalance")
+        get_balance.start().return_value.get_balance.side_effect = lambda: self.responses.pop(0)
+        self.addCleanup(get_balance.stop)
+        self.balances = BalanceCache(max_age=60)
+
+    def get(self):
+        """get(), then wait for the background refresh it may have started."""
+        snapshot = self.balances.get()
+        deadline = time.monotonic() + 5
+        while self.balances._refreshing and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return snapshot
+
+    def test_only_the_first_call_waits_for_the_aggregator(self):
+        self.responses = [{"Data": {"Balance": 100}}]
+        self.assertEqual(self.get().balance, Decimal("100"))
+        self.assertEqual(self.get().balance, Decimal("100"))
+        self.assertEqual(self.responses, [])
+
+    def test_stale_balance_is_served_while_it_refreshes(self):
+        self.responses = [{"Data": {"Balance": 100}}, {"Data": {"Balance": 250}}]
+        self.get().fetched_at -= 61
+        self.assertEqual(self.get().balance, Decimal("100"))
+        self.assertEqual(self.get().balance, Decimal("250"))
+
+    def test_invalidate_triggers_a_refresh(self):
+        self.responses = [{"Data": {"Balance": 100}}, {"Data": {"Balance": 40}}]
+        self.get()
+        self.balances.invalidate()
+        self.get()
+        self.assertEqual(self.get().balance, Decimal("40"))
+
+    def test_failed_refresh_keeps_the_last_good_balance(self):
+        self.responses = [{"Data": {"Balance": 100}}, {"error": "timeout"}]
+        self.get().fetched_at -= 61
+        self.get()
+        snapshot = self.get()
+        self.assertEqual(snapshot.balance, Decimal("100"))
+        self.assertIsNone(snapshot.error)
+        self.assertEqual(self.responses, [])
+
+
+class StatementSyncTests(TransactionTestCase):
+    def setUp(self):
+        self.today = timezone.localdate()
+        self.failing = set()
+        self.fetched = []
+        statement = mock.patch("config.statement_sync.GetStatementOfAccount")
+        statement.start().return_value.fetch.side_effect = self.fetch
+        self.addCleanup(statement.stop)
+
+    def fetch(self, start_date, end_date):
+        self.assertEqual(start_date, end_date)
+        self.fetched.append(start_date)
+        if start_date in self.failing:
+            return {"error": "timeout"}
+        return {"StatusCode": 200, "Succeeded": True, "Data": {"Items": [{"Day": start_date}]}}
+
+    def stamp(self, day):
+        return day.strftime("%Y%m%d")
+
+    def test_closed_days_are_skipped_and_today_is_fetched_again(self):
+        start = self.today - timedelta(days=4)
+        summary = StatementSync(workers=3).sync(start, self.today + timedelta(days=3))
+        self.assertEqual((summary["fetched"], summary["skipped"], summary["failed"], summary["items"]), (5, 0, [], 5))
+        self.assertEqual(StatementDay.objects.filter(closed=True).count(), 4)
+        self.assertFalse(StatementDay.objects.get(day=self.today).closed)
+
+        self.fetched.clear()
+        summary = StatementSync(workers=3).sync(start, self.today)
+        self.assertEqual(self.fetched, [self.stamp(self.today)])
+        self.assertEqual(summary["skipped"], 4)
+
+    def test_failed_day_is_reported_and_retried_next_run(self):
+        start = self.today - timedelta(days=3)
+        failed_day = self.today - timedelta(days=2)
+        self.failing = {self.stamp(failed_day)}
+        summary = StatementSync(workers=2).sync(start, self.today - timedelta(days=1))
+        self.assertEqual(summary["failed"], [failed_day])
+        self.assertEqual(summary["fetched"], 2)
+        self.assertFalse(StatementDay.objects.filter(day=failed_day).exists())
+
+        self.failing.clear()
+        self.fetched.clear()
+        summary = StatementSync(workers=2).sync(start, self.today - timedelta(days=1))
+        self.assertEqual(self.fetched, [self.stamp(failed_day)])
+        self.assertEqual(summary["failed"], [])
+
+
+class ReconcilerTests(TestCase):
+    """Orders without a webhook are settled from /orderquery, once, through the webhook path."""
+
+    def setUp(self):
+        PlatformSettings.objects.create(platform_fee_percent=Decimal("2.00"))
+        user = CustomUser.objects.create(username="client", role="client")
+        self.client_obj = Client.objects.create(user=user, name="Client")
+        Finances.objects.create(client=self.client_obj, balance=Decimal("500.00"))
+        staff = Staff.objects.create(user=CustomUser.objects.create(username="staff", role="staff"), name="Staff")
+        ClientAssignment.objects.create(staff=staff, client=self.client_obj)
+        Balance.objects.create(staff=staff, balance=Decimal("0.00"))
+        SystemEarnings.load()
+
+        UnifiedOrderRequest.objects.create(
+            timestamp=0, channel=1, out_trade_no="ORDER1", amount=1000, transaction_type=1,
+            trader_id="256700000000", trader_full_name="Payer", description="test",
+        )
+        self.order = UnifiedOrderResponse.objects.create(
+            status_code=200, succeeded=True, timestamp=0, out_trade_no="ORDER1", transaction_id="ORDER1",
+            amount=1000, actual_payment_amount=1000, actual_collect_amount=1000,
+            payer_charge=0, payee_charge=0, channel_charge=0, client=self.client_obj,
+        )
+        self.results = mock.patch("config.reconciler.PaymentResults").start().return_value.get_result
+        mock.patch("config.reconciler.record_audit").start()
+        self.addCleanup(mock.patch.stopall)
+        self.reconciler = OrderReconciler(concurrency=1, batch_size=10)
+
+    def order_data(self, pay_status):
+        return {
+            'PayStatus': pay_status, 'PayTime': "2026-01-01 12:00:00", 'OutTradeNo': "ORDER1",
+            'TransactionId': "TORDER1", 'Amount': "1000", 'ActualPaymentAmount': "1000",
+            'ActualCollectAmount': "1000", 'PayerCharge': "0", 'PayeeCharge': "0",
+        }
+
+    def query_returns(self, pay_status):
+        self.results.return_value = ({"StatusCode": 200, "Succeeded": True, "Data": self.order_data(pay_status)}, None)
+
+    def balance(self):
+        return Finances.objects.get(client=self.client_obj).balance
+
+    def test_due_orders_are_claimed_once(self):
+        self.assertEqual(self.reconciler.claim_due(), [self.order.id])
+        self.assertEqual(self.reconciler.claim_due(), [])
+
+    def test_paid_query_settles_the_order_once(self):
+        from webhooks.views import settle_order
+
+        self.query_returns(1)
+        self.assertEqual(self.reconciler._reconcile(self.order.id), "settled")
+        self.assertEqual(UnifiedOrderResponse.objects.get(id=self.order.id).status, "paid")
+        self.assertEqual(self.balance(), Decimal("1500.00"))
+
+        # The webhook that arrives afterwards is a duplicate.
+        self.assertTrue(settle_order(self.order_data(1)))
+        self.assertEqual(self.balance(), Decimal("1500.00"))
+        self.assertEqual(self.reconciler._reconcile(self.order.id), "resolved_elsewhere")
+
+    def test_unsettled_order_is_polled_again_later(self):
+        self.query_returns(0)
+        self.assertEqual(self.reconciler._reconcile(self.order.id), "pending")
+        order = UnifiedOrderResponse.objects.get(id=self.order.id)
+        self.assertEqual((order.status, order.reconcile_attempts), ("processing", 1))
+        self.assertGreater(order.next_reconcile_at, timezone.now())
+        self.assertEqual(self.reconciler.claim_due(), [])
+
+    def test_gives_up_after_max_attempts(self):
+        self.results.return_value = ({"error": "timeout"}, None)
+        UnifiedOrderResponse.objects.filter(id=self.order.id).update(reconcile_attempts=self.reconciler.max_attempts - 1)
+        self.assertEqual(self.reconciler._reconcile(self.order.id), "pending")
+        self.assertFalse(self.reconciler.unresolved().exists())
+        self.assertEqual(self.balance(), Decimal("500.00"))
+
+
+class AggregatorSimulatorTests(SimpleTestCase):
+    """The simulator accepts what the aggregator clients sign and signs what the webhook verifies."""
+
+    def setUp(self):
+        self.sim = AggregatorSimulator(SimulatorConfig(
+            merchant_id=settings.PAYMENT_MERCHANT_ID,
+            private_key=settings.PAYMENT_AGGREGATOR_API_KEY,
+            settle_latency=Latency("fixed:3600"),  # settled by hand
+            balance=Decimal("100"),
+            seed=1,
+        ))
+        self.addCleanup(self.sim.webhooks.stop)
+
+    def order(self, out_trade_no, amount, t_type=1, sign=True):
+        payload = {
+            "Version": "1.0", "MchID": settings.PAYMENT_MERCHANT_ID, "TimeStamp": 0, "Channel": 1,
+            "OutTradeNo": out_trade_no, "Amount": amount * 100, "TransactionType": t_type,
+            "TraderID": "256700000001", "TraderFullName": "Payee", "Description": "test", "NotifyUrl": "",
+        }
+        payload["Sign"] = unified_order_signer.sign(payload) if sign else "forged"
+        return self.sim.handle("unifiedorder", payload)[1]
+
+    def query(self, out_trade_no):
+        payload = {"Version": "1.0", "MchID": settings.PAYMENT_MERCHANT_ID, "TimeStamp": 0, "OutTradeNo": out_trade_no}
+        payload["Sign"] = order_query_signer.sign(payload)
+        return self.sim.handle("orderquery", payload)[1]
+
+    def test_unsigned_and_duplicate_orders_are_refused(self):
+        self.assertEqual(self.order("SIM1", 10, sign=False)["StatusCode"], 401)
+        self.assertEqual(self.order("SIM1", 10)["StatusCode"], 200)
+        self.assertEqual(self.order("SIM1", 10)["StatusCode"], 403)
+
+    def test_settled_order_is_queryable_and_its_notification_verifies(self):
+        self.order("SIM1", 10)
+        self.assertEqual(self.query("SIM1")["Data"]["PayStatus"], 0)
+        self.sim.config.success_rate = 1
+        notification = self.sim.settle("SIM1")
+        self.assertEqual(notification["PayStatus"], 1)
+        self.assertEqual(self.query("SIM1")["Data"]["PayStatus"], 1)
+        self.assertTrue(notification_verifier(settings.PAYMENT_AGGREGATOR_API_KEY).verify(notification))
+        self.assertEqual(self.query("MISSING")["StatusCode"], 404)
+
+    def test_disbursement_beyond_the_merchant_balance_fails(self):
+        self.sim.config.success_rate = 1
+        self.order("SIM1", 150, t_type=2)
+        notification = self.sim.settle("SIM1")
+        self.assertEqual((notification["PayStatus"], notification["PayMessage"]), (2, "Insufficient merchant balance"))
+        self.assertEqual(self.sim.balance, Decimal("100"))
+
+
+class PaymentJobQueueTests(TestCase):
+    def setUp(self):
+        user = CustomUser.objects.create(username="client", role="client")
+        self.client_obj = Client.objects.create(user=user, name="Client")
+        Finances.objects.create(client=self.client_obj, balance=Decimal("1000"))
+        self.transaction = RecentTransaction.objects.create(
+            client=self.client_obj, date=timezone.localdate(), amount=Decimal("100"), recipient="Payee",
+            transaction_id=1,  # numbered here, so the process-wide id block stays untouched
+        )
+        self.saved_statuses = []
+        post_save.connect(self.record_save, sender=RecentTransaction, dispatch_uid="payment-job-tests")
+        self.addCleanup(post_save.disconnect, sender=RecentTransaction, dispatch_uid="payment-job-tests")
+        self.responses = []
+        initiator = mock.patch("config.job_queue.PaymentInitiator")
+        self.initiate_transaction = initiator.start().return_value.initiate_transaction
+        self.initiate_transaction.side_effect = self.initiate
+        self.addCleanup(initiator.stop)
+        self.worker = PaymentJobWorker(workers=1)
+
+    def record_save(self, sender, instance, **kwargs):
+        self.saved_statuses.append(instance.status)
+
+    def initiate(self):
+        response = self.responses.pop(0)
+        return response() if callable(response) else response
+
+    def enqueue(self, key="key-1", hold=None):
+        initiator = SimpleNamespace(
+            client_id=self.client_obj.id, channel=1, t_type=2, base_amount=Decimal("100.50"),
+            trader_id="256700000001", message="test", name="Payee", revalidate_trader=False,
+            hold_id=hold.id if hold else None,
+        )
+        job, created = enqueue_payment(initiator, idempotency_key=key)
+        PaymentJob.objects.filter(id=job.id).update(recent_transaction=self.transaction)
+        return job, created
+
+    def run_next(self):
+        job = self.worker.claim()
+        self.worker._run_safely(job)
+        return PaymentJob.objects.get(id=job.id)
+
+    def test_repeated_key_returns_the_queued_job(self):
+        job, created = self.enqueue()
+        again, created_again = self.enqueue()
+        self.assertEqual((created, created_again, again.id), (True, False, job.id))
+        self.assertEqual(job.base_amount, Decimal("100.50"))
+
+    def test_claimed_job_is_leased(self):
+        job, _ = self.enqueue()
+        self.assertEqual(self.worker.claim().id, job.id)
+        self.assertIsNone(self.worker.claim())
+        self.assertEqual(self.worker.mark_stale(), 0)
+
+    def test_job_whose_worker_died_mid_call_is_marked_unknown_not_run_again(self):
+        job, _ = self.enqueue()
+
+        def crash():
+            raise SystemExit  # the process is killed while the order may be in flight
+        self.responses = [crash]
+        with self.assertRaises(SystemExit):
+            self.run_next()
+        self.assertEqual(PaymentJob.objects.get(id=job.id).status, "running")
+
+        PaymentJob.objects.filter(id=job.id).update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.worker.mark_stale(), 1)
+        self.assertIsNone(self.worker.claim())
+        job = PaymentJob.objects.get(id=job.id)
+        self.assertEqual((job.status, job.attempts, job.locked_until), ("unknown", 1, None))
+        self.assertEqual(self.initiate_transaction.call_count, 1)
+
+    def test_submitted_job_succeeds_and_keeps_its_hold(self):
+        hold = place_hold(self.client_obj.id, Decimal("100.50"))
+        self.enqueue(hold=hold)
+
+        def submit():
+            attach_hold(hold.id, "ORDER1")  # as _save_order does for the order that went out
+            return JsonResponse({"status": "success"})
+        self.responses = [submit]
+        self.assertEqual(self.run_next().status, "succeeded")
+        self.assertEqual(BalanceHold.objects.get(id=hold.id).status, "held")  # settled by the order's webhook
+        # Recorded like a disbursement submitted from the form, through save() so post_save runs.
+        self.assertEqual(RecentTransaction.objects.get(id=self.transaction.id).status, "Processing")
+        self.assertEqual(self.saved_statuses, ["Processing"])
+
+    def test_server_errors_are_retried_with_backoff_then_fail(self):
+        hold = place_hold(self.client_obj.id, Decimal("100.50"))
+        self.enqueue(hold=hold)
+        self.responses = [JsonResponse({"status": "error"}, status=503)] * self.worker.max_attempts
+        job = self.run_next()
+        self.assertEqual((job.status, job.result_status), ("queued", 503))
+        self.assertGreater(job.run_at, timezone.now())
+
+        for _ in range(self.worker.max_attempts - 1):
+            PaymentJob.objects.filter(id=job.id).update(run_at=timezone.now())
+            job = self.run_next()
+        self.assertEqual((job.status, job.attempts), ("failed", self.worker.max_attempts))
+        self.assertEqual(RecentTransaction.objects.get(id=self.transaction.id).status, "Failed")
+        self.assertEqual(self.saved_statuses, ["Failed"])
+        self.assertEqual(BalanceHold.objects.get(id=hold.id).status, "released")
+
+    def test_rejected_job_fails_at_once(self):
+        self.enqueue()
+        self.responses = [JsonResponse({"status": "error", "message": "Invalid trader"}, status=400)]
+        job = self.run_next()
+        self.assertEqual((job.status, job.attempts, job.result["message"]), ("failed", 1, "Invalid trader"))
@@ -4,13 +4,14 @@ from django.shortcuts import get_object_or_404
 from django.http import JsonResponse
 from clients.models import Client
 from .Platform import PlatformEarnings
-from .help import process_transaction
+from .help import aprocess_transaction, process_transaction
+from .idempotency import REPLAYED_HEADER
 import logging
 
 logger = logging.getLogger(__name__)
 
 class PaymentInitiator:
-    def __init__(self, channel: int, t_type: int, client_id: int, base_amount: int, trader_id: str, message: str, name: str):
+    def __init__(self, channel: int, t_type: int, client_id: int, base_amount: int, trader_id: str, message: str, name: str, revalidate_trader: bool = False, idempotency_key: str = None, hold_id: int = None):
         self.channel = channel
         self.t_type = t_type
         self.client_id = client_id
@@ -18,6 +19,12 @@ class PaymentInitiator:
         self.trader_id = trader_id
         self.message = message
         self.name = name
+        self.revalidate_trader = revalidate_trader
+        self.idempotency_key = idempotency_key
+        # BalanceHold reserving the total for a disbursement; tied to the order once it is submitted.
+        self.hold_id = hold_id
+        # True when the result was replayed from an earlier request with the same idempotency key.
+        self.replayed = False
         self.fee = None
         self.total_amount = None
         self.client = None
@@ -52,13 +59,51 @@ class PaymentInitiator:
                 base_amount=self.total_amount,
                 trader_id=self.trader_id,
                 message=self.message,
-                name=self.name
+                name=self.name,
+                revalidate_trader=self.revalidate_trader,
+                idempotency_key=self.idempotency_key,
+                hold_id=self.hold_id
             )
-            result_data = json.loads(response.content)
-            if result_data.get('status') == 'success':
-                return JsonResponse({"status": "success", "message": "Transaction initiated successfully."}, status=200)
-            else:
-                return JsonResponse({"status": "error", "message": result_data.get('message')}, status=400)
+            return self._initiation_result(response)
         except Exception as e:
             logger.exception("Unexpected error during transaction initiation")
             return JsonResponse({"status": "error", "message": str(e)}, status=500)
+
+    async def ainitiate_transaction(self):
+        """Async counterpart of initiate_transaction for ASGI views."""
+        logger.info(f"Initiating async transaction for client_id: {self.client_id}, total_amount: {self.total_amount}")
+        if self.total_amount <= 0:
+            return JsonResponse({"status": "error", "message": "Total amount must be greater than zero."}, status=400)
+
+        try:
+            response = await aprocess_transaction(
+                channel=self.channel,
+                t_type=self.t_type,
+                client_id=self.client_id,
+                base_amount=self.total_amount,
+                trader_id=self.trader_id,
+                message=self.message,
+                name=self.name,
+                revalidate_trader=self.revalidate_trader,
+                idempotency_key=self.idempotency_key,
+                hold_id=self.hold_id
+            )
+            return self._initiation_result(response)
+        except Exception as e:
+            logger.exception("Unexpected error during transaction initiation")
+            return JsonResponse({"status": "error", "message": str(e)}, status=500)
+
+    def _initiation_result(self, response):
+        self.replayed = response.get(REPLAYED_HEADER) == "true"
+        if response.status_code == 503:
+            # Shed by the aggregator circuit breaker or concurrency limit: pass the 503 and Retry-After through.
+            return response
+        result_data = json.loads(response.content)
+        if result_data.get('status') == 'success':
+            return JsonResponse({"status": "success", "message": "Transaction initiated successfully."}, status=200)
+        if result_data.get('status') == 'pending':
+            return JsonResponse(result_data, status=202)
+        else:
+            # 5xx (aggregator or transport failure before the order was placed) stays retryable for the job queue.
+            status = response.status_code if response.status_code >= 500 else 400
+            return JsonResponse({"status": "error", "message": result_data.get('message')}, status=status)
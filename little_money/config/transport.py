@@ -0,0 +1,112 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import base as settings
+from .resilience import get_guards
+
+logger = logging.getLogger(__name__)
+
+# Read-only endpoints that are safe to send twice. /unifiedorder moves money,
+# so it is never retried at the transport level.
+IDEMPOTENT_ENDPOINTS = frozenset({"bill", "orderquery", "balance", "statement"})
+RETRY_STATUS_CODES = frozenset({502, 503, 504})
+
+
+class AggregatorTransport:
+    """
+    Keep-alive HTTP transport shared by every aggregator client in the process.
+    Holds one requests.Session so TCP/TLS connections are reused between calls.
+    """
+
+    def __init__(self, base_url: str, pool_maxsize: int, connect_timeout: float,
+                 read_timeouts: dict, max_retries: int, retry_backoff: float, guards=None):
+        self.base_url = base_url.rstrip("/")
+        self.connect_timeout = connect_timeout
+        self.read_timeouts = dict(read_timeouts)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.guards = guards or get_guards()
+
+        self.session = requests.Session()
+        self.session.headers.update({'Content-Type': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=False, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def timeout_for(self, endpoint: str) -> tuple:
+        return (self.connect_timeout, self.read_timeouts.get(endpoint, 10))
+
+    def _backoff(self, attempt: int) -> float:
+        # "Full jitter": a random delay up to the exponential cap, so retrying
+        # threads do not hit the aggregator in lock-step.
+        return random.uniform(0, self.retry_backoff * (2 ** attempt))
+
+    def post(self, endpoint: str, payload: dict) -> requests.Response:
+        """
+        POST `payload` to `{base_url}/{endpoint}`.
+        Idempotent endpoints are retried on connection errors, timeouts and 502/503/504.
+        Raises resilience.AggregatorUnavailable, without sending, when the endpoint's
+        breaker is open or its concurrency limit is reached, and
+        requests.RequestException when all attempts fail.
+        """
+        url = f"{self.base_url}/{endpoint}"
+        attempts = self.max_retries + 1 if endpoint in IDEMPOTENT_ENDPOINTS else 1
+        timeout = self.timeout_for(endpoint)
+        guard = self.guards.get(endpoint)
+
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            started = guard.acquire()
+            try:
+                resp = self.session.post(url, json=payload, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                guard.release(started, ok=False)
+                if last_attempt:
+                    raise
+                logger.warning(f"Aggregator /{endpoint} attempt {attempt + 1} failed: {e}. Retrying.")
+            except Exception:
+                guard.release(started, ok=False)
+                raise
+            else:
+                guard.release(started, ok=resp.status_code < 500)
+                if resp.status_code not in RETRY_STATUS_CODES or last_attempt:
+                    return resp
+                logger.warning(f"Aggregator /{endpoint} attempt {attempt + 1} returned {resp.status_code}. Retrying.")
+            time.sleep(self._backoff(attempt))
+
+    def close(self):
+        self.session.close()
+
+
+_transport = None
+_transport_pid = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> AggregatorTransport:
+    """
+    Return the process-wide transport, building it on first use.
+    The pid check rebuilds the pool in forked gunicorn workers so sockets are never shared across processes.
+    """
+    global _transport, _transport_pid
+    pid = os.getpid()
+    if _transport is not None and _transport_pid == pid:
+        return _transport
+    with _transport_lock:
+        if _transport is None or _transport_pid != pid:
+            _transport = AggregatorTransport(
+                base_url=settings.PAYMENT_AGGREGATOR_BASE_URL,
+                pool_maxsize=settings.AGGREGATOR_POOL_MAXSIZE,
+                connect_timeout=settings.AGGREGATOR_CONNECT_TIMEOUT,
+                read_timeouts=settings.AGGREGATOR_READ_TIMEOUTS,
+                max_retries=settings.AGGREGATOR_MAX_RETRIES,
+                retry_backoff=settings.AGGREGATOR_RETRY_BACKOFF,
+            )
+            _transport_pid = pid
+    return _transport
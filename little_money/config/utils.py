@@ -1,58 +1,88 @@
 import hashlib
+import hmac
 import secrets
 import string
 import logging
 import time
 from typing import Dict, Any
 from jsonschema import validate, ValidationError
-from datetime import datetime
-import pytz
 from decimal import Decimal
+from functools import lru_cache
+
+from . import base as settings
 
 logger = logging.getLogger(__name__)
-# Global counter
-sequence_counter = 0
+
+class Signer:
+    """
+    MD5 signer compiled once for a fixed field order and key.
+    Fields missing from params are skipped; values are rendered with `formatter`.
+    """
+
+    def __init__(self, field_order, private_key: str, formatter=str, skip_none: bool = False):
+        self.field_order = tuple(field_order)
+        self.formatter = formatter
+        self.skip_none = skip_none
+        self._fields = tuple((field, f"{field}=") for field in self.field_order)
+        self._suffix = f"privateKey={private_key}"
+
+    def string_to_sign(self, params: Dict[str, Any]) -> str:
+        fmt = self.formatter
+        if self.skip_none:
+            parts = [prefix + fmt(params[field]) for field, prefix in self._fields if params.get(field) is not None]
+        else:
+            parts = [prefix + fmt(params[field]) for field, prefix in self._fields if field in params]
+        parts.append(self._suffix)
+        return '&'.join(parts)
+
+    def sign(self, params: Dict[str, Any]) -> str:
+        return hashlib.md5(self.string_to_sign(params).encode('utf-8')).hexdigest()
+
+
+class Verifier(Signer):
+    """Checks the `Sign` of incoming payloads in constant time."""
+
+    def verify(self, data: Dict[str, Any]) -> bool:
+        received = data.get("Sign")
+        if not isinstance(received, str):
+            return False
+        calculated = self.sign(data)
+        if settings.SIGNATURE_DEBUG:
+            logger.debug(f"String to sign: {self.string_to_sign(data)} calculated: {calculated} received: {received}")
+        return hmac.compare_digest(calculated.encode(), received.encode('utf-8'))
+
+    def verify_many(self, payloads) -> list:
+        """Verify an iterable of payloads in one pass. Returns one bool per payload, in order."""
+        verify = self.verify
+        return [verify(data) for data in payloads]
+
+
+NOTIFICATION_FIELDS = (
+    'PayStatus', 'PayTime', 'OutTradeNo', 'TransactionId',
+    'Amount', 'ActualPaymentAmount', 'ActualCollectAmount',
+    'PayerCharge', 'PayeeCharge'
+)
+
 
 def generate_signature(params, field_order, private_key) -> str:
     """
     Generates an MD5 signature string from strictly ordered stringified fields plus the private key.
+    Prefer a module-level Signer for a fixed field order; this builds one per call.
     """
-    to_sign = '&'.join(f"{k}={str(params[k])}" for k in field_order if k in params)
-    to_sign += f"&privateKey={private_key}"
-    return hashlib.md5(to_sign.encode('utf-8')).hexdigest()
+    return Signer(field_order, private_key).sign(params)
 
 def format_number(value):
     if isinstance(value, (int, float, Decimal)):
         return f"{float(value):.6f}"
     return str(value)
 
-def verify_signature(data: Dict[str, Any], private_key: str) -> bool:
-    field_order = [
-        'PayStatus', 'PayTime', 'OutTradeNo', 'TransactionId',
-        'Amount', 'ActualPaymentAmount', 'ActualCollectAmount',
-        'PayerCharge', 'PayeeCharge'
-    ]
-
-    sign_parts = []
-    for field in field_order:
-        value = data.get(field)
-        if value is not None:
-            sign_parts.append(f"{field}={format_number(value)}")
-            print(f"{field}: {format_number(data.get(field))}")
-
-    sign_parts.append(f"privateKey={private_key}")
-    to_sign = '&'.join(sign_parts)
-    calculated_md5 = hashlib.md5(to_sign.encode('utf-8')).hexdigest()
-
-    logger.info("==== Signature Debug ====")
-    logger.info(f"String to sign: {to_sign}")
-    logger.info(f"Calculated MD5: {calculated_md5}")
-    logger.info(f"Received Sign : {data.get('Sign')}")
-    logger.info("=========================")
-
+@lru_cache(maxsize=8)
+def notification_verifier(private_key: str) -> Verifier:
+    """Verifier for aggregator payment notifications, built once per key."""
+    return Verifier(NOTIFICATION_FIELDS, private_key, formatter=format_number, skip_none=True)
 
-
-    return calculated_md5 == data.get("Sign")
+def verify_signature(data: Dict[str, Any], private_key: str) -> bool:
+    return notification_verifier(private_key).verify(data)
 
 
 
@@ -115,21 +145,3 @@ def generate_transaction_id(length=12):
 
 def generate_timestamp():
     return int(time.time())
-
-def generate_unique_id():
-    global sequence_counter
-    # Timezone: East African Time (EAT)
-    eat = pytz.timezone('Africa/Nairobi')
-    now_eat = datetime.now(eat)
-
-    # Format date
-    current_date = now_eat.strftime('%Y%m%d')
-    timestamp_ms = int(now_eat.timestamp() * 1000)
-
-    # Pad sequence
-    auto_number = f"{timestamp_ms}{sequence_counter:05d}"
-    sequence_counter = (sequence_counter + 1) % 100000  # Wrap at 99999
-
-    # Final unique ID
-    unique_id = f"UGMP-{current_date}-{auto_number}"
-    return unique_id
\ No newline at end of file
@@ -0,0 +1,59 @@
+from django.db import migrations, models
+
+LETTERS = 26
+NUMBERS = 1000000
+
+
+def to_next_value(apps, schema_editor):
+    # The single letter/letter/number row becomes the 'mp_transaction' sequence.
+    TransactionIDCounter = apps.get_model('core', 'TransactionIDCounter')
+    for counter in TransactionIDCounter.objects.order_by('id'):
+        counter.next_value = (counter.first_letter_index * LETTERS + counter.second_letter_index) * NUMBERS + counter.number
+        counter.name = 'mp_transaction' if counter.id == 1 else f'legacy_{counter.id}'
+        counter.save(update_fields=['name', 'next_value'])
+
+
+def to_letters(apps, schema_editor):
+    TransactionIDCounter = apps.get_model('core', 'TransactionIDCounter')
+    for counter in TransactionIDCounter.objects.filter(name='mp_transaction'):
+        pair, counter.number = divmod(counter.next_value, NUMBERS)
+        counter.first_letter_index, counter.second_letter_index = divmod(pair % (LETTERS * LETTERS), LETTERS)
+        counter.save(update_fields=['first_letter_index', 'second_letter_index', 'number'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_transactionidcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transactionidcounter',
+            name='name',
+            field=models.CharField(max_length=50, null=True),
+        ),
+        migrations.AddField(
+            model_name='transactionidcounter',
+            name='next_value',
+            field=models.BigIntegerField(default=1),
+        ),
+        migrations.RunPython(to_next_value, to_letters),
+        migrations.AlterField(
+            model_name='transactionidcounter',
+            name='name',
+            field=models.CharField(max_length=50, unique=True),
+        ),
+        migrations.RemoveField(
+            model_name='transactionidcounter',
+            name='first_letter_index',
+        ),
+        migrations.RemoveField(
+            model_name='transactionidcounter',
+            name='second_letter_index',
+        ),
+        migrations.RemoveField(
+            model_name='transactionidcounter',
+            name='number',
+        ),
+    ]
@@ -15,11 +15,16 @@ class CustomUser(AbstractUser):
     profile_image = models.ImageField(upload_to='avatars/', blank=True, null=True)
 
 class TransactionIDCounter(models.Model):
-    first_letter_index = models.PositiveSmallIntegerField(default=0)
-    second_letter_index = models.PositiveSmallIntegerField(default=0)
-    number = models.PositiveSmallIntegerField(default=0)
+    """
+    The next free value of a named id sequence. Writers reserve blocks of values
+    from it with one UPDATE and hand them out in memory (see config.ids.BlockAllocator).
+    """
+    name = models.CharField(max_length=50, unique=True)
+    next_value = models.BigIntegerField(default=1)
 
     class Meta:
-        # Make sure there is only one row
         verbose_name = "Transaction ID Counter"
-        verbose_name_plural = "Transaction ID Counters"
\ No newline at end of file
+        verbose_name_plural = "Transaction ID Counters"
+
+    def __str__(self):
+        return f"{self.name}: {self.next_value}"
@@ -1,7 +1,6 @@
 from django.utils.translation import gettext as _
 import io
 import string
-from django.db import transaction
 import datetime
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
@@ -12,7 +11,7 @@ from openpyxl.styles import Font, PatternFill
 from openpyxl.utils import get_column_letter
 from io import BytesIO
 
-from core.models import TransactionIDCounter
+from config.ids import BlockAllocator
 
 def is_admin(user):
     return hasattr(user, 'role') and user.role == 'admin'
@@ -195,35 +194,13 @@ def generate_statement_xlsx(transactions, lang='en'):
     output.seek(0)
     return output
 from datetime import datetime
+# MP codes run AA-000000 ... ZZ-999999 and then wrap, one number per value of the sequence.
+mp_transaction_ids = BlockAllocator('mp_transaction', seed=lambda: 0)
+
 def generate_transaction_id():
     alphabet = string.ascii_uppercase
     year = datetime.now().year
 
-    with transaction.atomic():
-        # Lock the counter row to prevent race conditions
-        counter, created = TransactionIDCounter.objects.select_for_update().get_or_create(id=1)
-
-        first_letter = alphabet[counter.first_letter_index]
-        second_letter = alphabet[counter.second_letter_index]
-        number_str = f"{counter.number:06d}"
-
-        txn_id = f"MP{year}-{first_letter}{second_letter}-{number_str}"
-
-        # Increment the counter
-        counter.number += 1
-        if counter.number > 999999:
-            counter.number = 0
-            counter.second_letter_index += 1
-
-            if counter.second_letter_index >= len(alphabet):
-                counter.second_letter_index = 0
-                counter.first_letter_index += 1
-
-                if counter.first_letter_index >= len(alphabet):
-                    # Optional: Reset or raise error if all combinations exhausted
-                    counter.first_letter_index = 0
-
-        counter.save()
-
-    return txn_id
-
+    pair, number = divmod(mp_transaction_ids.next(), 1000000)
+    first_index, second_index = divmod(pair % (len(alphabet) ** 2), len(alphabet))
+    return f"MP{year}-{alphabet[first_index]}{alphabet[second_index]}-{number:06d}"
@@ -1,29 +1,29 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from django_apscheduler.jobstores import DjangoJobStore
 from datetime import datetime
+from django.db import transaction
 from .models import SystemEarnings, MonthlyEarnings
 
+MONTHLY_COUNTERS = ("total_volume", "total_transactions", "total_successful_transactions",
+                    "total_failed_transactions", "total_earnings")
+
+@transaction.atomic
 def snapshot_monthly_earnings():
     now = datetime.now()
-    system = SystemEarnings.load()
+    # Hold every shard so no increment lands between the snapshot and the reset.
+    shards = list(SystemEarnings.objects.select_for_update().values("id", *MONTHLY_COUNTERS))
 
     MonthlyEarnings.objects.create(
         year=now.year,
         month=now.month,
-        total_volume=system.total_volume,
-        total_transactions=system.total_transactions,
-        total_successful_transactions=system.total_successful_transactions,
-        total_failed_transactions=system.total_failed_transactions,
-        total_earnings=system.total_earnings,
+        **{field: sum(shard[field] for shard in shards) for field in MONTHLY_COUNTERS},
     )
 
-    # Reset system earnings for next month
-    system.total_volume = 0
-    system.total_transactions = 0
-    system.total_successful_transactions = 0
-    system.total_failed_transactions = 0
-    system.total_earnings = 0
-    system.save()
+    # Reset system earnings for next month. Only the shards summed above: one first
+    # created after the lock was taken holds next month's earnings.
+    SystemEarnings.objects.filter(id__in=[shard["id"] for shard in shards]).update(
+        **{field: 0 for field in MONTHLY_COUNTERS}
+    )
 
 def start():
     scheduler = BackgroundScheduler()
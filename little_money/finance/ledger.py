@@ -0,0 +1,220 @@
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from decimal import ROUND_DOWN, ROUND_HALF_UP, Decimal
+
+from django.db import connection, transaction
+from django.db.models import F, Max, Sum
+from django.utils import timezone
+
+from admins.models import AdminProfile
+from clients.models import Finances
+from config import base as settings
+from core.models import CustomUser
+from staff.models import Balance
+from .models import LedgerPosting, LedgerSnapshot
+
+logger = logging.getLogger(__name__)
+
+CENT = Decimal("0.01")
+SNAPSHOT_LOCK = 7_240_001  # pg advisory lock key, so only one take_snapshots() runs at a time
+
+# Accounts that are nobody's balance.
+AGGREGATOR = "aggregator"  # money held for us at the payment aggregator: the other side of every settlement
+PLATFORM = "platform"      # the platform's share of fees, plus rounding and admin shares nobody can claim
+PAYOUTS = "payouts"        # staff commission paid out
+OPENING = "opening"        # the other side of the balances that existed before the ledger
+
+
+def client_account(client_id) -> str:
+    return f"client:{client_id}"
+
+
+def staff_account(staff_id) -> str:
+    return f"staff:{staff_id}"
+
+
+def admin_account(profile_id) -> str:
+    return f"admin:{profile_id}"
+
+
+class InsufficientFunds(ValueError):
+    """A posting would take a staff balance below zero, or a client balance below what it has on hold."""
+
+
+class Journal:
+    """
+    Postings collected in memory and appended with one bulk_create.
+
+    Each entry is balanced as it is added: amounts are rounded to cents and the
+    counter account takes whatever makes the entry sum to zero. write() also moves
+    the balance columns (Finances, staff Balance, AdminProfile) in the same
+    transaction. The postings are the history that balance_at() and statements are
+    built from; the columns stay the current balance because a debit has to be
+    checked and applied atomically against it, and place_hold(), apply_batch()
+    and payout approval all guard on those rows. Deriving the current balance from
+    snapshot plus postings instead would need the same per-account lock and an
+    aggregate on every debit. balance_drift() reports any account where the two
+    disagree.
+    """
+
+    def __init__(self):
+        self.postings = []
+
+    def add(self, reference: str, amounts, counter_account: str = AGGREGATOR):
+        """amounts: (account, amount) pairs; repeated accounts are summed."""
+        rounded = defaultdict(Decimal)
+        for account, amount in amounts:
+            rounded[account] += Decimal(amount).quantize(CENT, ROUND_HALF_UP)
+        rounded[counter_account] -= sum(rounded.values())
+        self.postings.extend(
+            LedgerPosting(account=account, amount=amount, reference=reference)
+            for account, amount in rounded.items() if amount
+        )
+
+    def deltas(self) -> dict:
+        totals = defaultdict(Decimal)
+        for posting in self.postings:
+            totals[posting.account] += posting.amount
+        return totals
+
+    def write(self):
+        """Append the postings and apply them to the balance columns. Raises InsufficientFunds."""
+        if not self.postings:
+            return
+        _apply_to_balances(self.deltas())
+        LedgerPosting.objects.bulk_create(self.postings)
+        self.postings = []
+
+
+def admin_profiles() -> list:
+    """The AdminProfile id of every admin user, None for admins without a profile."""
+    return list(CustomUser.objects.filter(role='admin').values_list('adminprofile__id', flat=True))
+
+
+def admin_commission_shares(total: Decimal, profiles: list) -> list:
+    """
+    (account, amount) pairs splitting total equally between every admin user.
+    Admins without a profile forfeit their share to the platform, as do the cents
+    that do not divide evenly.
+    """
+    if not profiles:
+        return [(PLATFORM, total)]
+    share = (Decimal(total) / len(profiles)).quantize(CENT, ROUND_DOWN)
+    shares = [(admin_account(profile_id), share) for profile_id in profiles if profile_id is not None]
+    return shares + [(PLATFORM, Decimal(total) - share * len(shares))]
+
+
+def _apply_to_balances(deltas: dict):
+    # Clients, then staff, then admins, each in id order, so concurrent writers lock rows in the same order.
+    by_kind = defaultdict(dict)
+    for account, delta in deltas.items():
+        kind, _, key = account.partition(":")
+        if key and delta:
+            by_kind[kind][int(key)] = delta
+    for client_id in sorted(by_kind["client"]):
+        # A client debit may not spend what is held for disbursements still in flight.
+        _move(Finances, "client_id", client_id, by_kind["client"][client_id], reserved=F('held'), rows=Finances.for_client(client_id))
+    for staff_id in sorted(by_kind["staff"]):
+        _move(Balance, "staff_id", staff_id, by_kind["staff"][staff_id])
+    admins_by_delta = defaultdict(list)
+    for profile_id in sorted(by_kind["admin"]):
+        admins_by_delta[by_kind["admin"][profile_id]].append(profile_id)
+    for delta, profile_ids in admins_by_delta.items():
+        AdminProfile.objects.filter(id__in=profile_ids).update(balance=F('balance') + delta)
+
+
+def _move(model, key_field: str, key: int, delta: Decimal, reserved=0, rows=None):
+    if rows is None:
+        rows = model.objects.filter(**{key_field: key})
+    if delta < 0:
+        # Conditional, so two concurrent debits cannot both spend the same balance.
+        if not rows.filter(balance__gte=reserved - delta).update(balance=F('balance') + delta):
+            raise InsufficientFunds(f"{model.__name__} for {key_field}={key} is below {-delta}.")
+    elif not rows.update(balance=F('balance') + delta):
+        model.objects.create(balance=delta, **{key_field: key})
+
+
+def balance_at(account: str, at=None) -> Decimal:
+    """
+    The account's balance over the postings created up to `at` (default now): its
+    latest snapshot at or before `at` plus the postings since, two index range
+    lookups however long the account's history is.
+    """
+    at = at or timezone.now()
+    snapshot = (
+        LedgerSnapshot.objects.filter(account=account, as_of__lte=at)
+        .order_by('-as_of').values_list('as_of', 'balance').first()
+    )
+    postings = LedgerPosting.objects.filter(account=account, created_at__lte=at)
+    opening = Decimal("0")
+    if snapshot:
+        postings = postings.filter(created_at__gt=snapshot[0])
+        opening = snapshot[1]
+    return opening + (postings.aggregate(total=Sum('amount'))['total'] or Decimal("0"))
+
+
+def balances_at(at=None) -> dict:
+    """balance_at() for every account, from the last snapshot round before `at` plus the postings since."""
+    at = at or timezone.now()
+    snapshots = LedgerSnapshot.objects.filter(as_of__lte=at)
+    balances = defaultdict(Decimal, snapshots.order_by('account', '-as_of').distinct('account').values_list('account', 'balance'))
+    last_round = snapshots.aggregate(last=Max('as_of'))['last']
+    postings = LedgerPosting.objects.filter(created_at__lte=at)
+    if last_round:
+        postings = postings.filter(created_at__gt=last_round)
+    for account, total in postings.order_by().values_list('account').annotate(total=Sum('amount')):
+        balances[account] += total
+    return balances
+
+
+def take_snapshots(lag: float = None) -> int:
+    """
+    Fold the postings made since the previous round, up to `lag` seconds ago, into
+    a new snapshot for each account they touch. The lag leaves time for slower
+    transactions whose postings carry an earlier created_at to commit. Returns the
+    number of snapshots written.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.LEDGER_SNAPSHOT_LAG if lag is None else lag)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [SNAPSHOT_LOCK])
+        previous_round = LedgerSnapshot.objects.aggregate(last=Max('as_of'))['last']
+        if previous_round and previous_round >= cutoff:
+            return 0
+        window = LedgerPosting.objects.filter(created_at__lte=cutoff)
+        if previous_round:
+            window = window.filter(created_at__gt=previous_round)
+        deltas = dict(window.order_by().values_list('account').annotate(total=Sum('amount')))
+        if not deltas:
+            return 0
+        previous = dict(
+            LedgerSnapshot.objects.filter(account__in=deltas)
+            .order_by('account', '-as_of').distinct('account').values_list('account', 'balance')
+        )
+        LedgerSnapshot.objects.bulk_create([
+            LedgerSnapshot(account=account, as_of=cutoff, balance=previous.get(account, Decimal("0")) + delta)
+            for account, delta in deltas.items()
+        ])
+    logger.info(f"Ledger snapshot as of {cutoff}: {len(deltas)} account(s).")
+    return len(deltas)
+
+
+def balance_drift() -> dict:
+    """
+    Accounts whose balance column disagrees with the ledger, as
+    account -> (column, ledger). Empty when the two agree.
+    """
+    ledger = balances_at()
+    columns = defaultdict(Decimal)
+    for client_id, balance in Finances.objects.order_by().values_list('client_id').annotate(total=Sum('balance')):
+        columns[client_account(client_id)] += balance
+    for staff_id, balance in Balance.objects.filter(staff__isnull=False).values_list('staff_id', 'balance'):
+        columns[staff_account(staff_id)] += balance
+    for profile_id, balance in AdminProfile.objects.values_list('id', 'balance'):
+        columns[admin_account(profile_id)] += balance
+    return {
+        account: (columns[account], ledger.get(account, Decimal("0")))
+        for account in columns.keys() | {account for account in ledger if ":" in account}
+        if columns[account] != ledger.get(account, Decimal("0"))
+    }
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.3 on 2026-10-18 18:20
+
+import django.db.models.functions.datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0005_systemearnings_balance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerPosting',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('account', models.CharField(max_length=50)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=20)),
+                ('reference', models.CharField(db_index=True, max_length=100)),
+                ('created_at', models.DateTimeField(db_default=django.db.models.functions.datetime.Now())),
+            ],
+            options={
+                'indexes': [models.Index(fields=['account', 'created_at'], name='finance_led_account_996685_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='LedgerSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account', models.CharField(max_length=50)),
+                ('as_of', models.DateTimeField()),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=20)),
+            ],
+            options={
+                'unique_together': {('account', 'as_of')},
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+from collections import defaultdict
+
+from django.db import migrations
+
+
+def post_opening_balances(apps, schema_editor):
+    # Balances that existed before the ledger become one opening entry, so the
+    # ledger and the balance columns agree from the start.
+    LedgerPosting = apps.get_model('finance', 'LedgerPosting')
+    Finances = apps.get_model('clients', 'Finances')
+    Balance = apps.get_model('staff', 'Balance')
+    AdminProfile = apps.get_model('admins', 'AdminProfile')
+
+    balances = defaultdict(int)
+    for client_id, balance in Finances.objects.values_list('client_id', 'balance'):
+        balances[f"client:{client_id}"] += balance
+    for staff_id, balance in Balance.objects.filter(staff__isnull=False).values_list('staff_id', 'balance'):
+        balances[f"staff:{staff_id}"] += balance
+    for profile_id, balance in AdminProfile.objects.values_list('id', 'balance'):
+        balances[f"admin:{profile_id}"] += balance
+
+    postings = [
+        LedgerPosting(account=account, amount=balance, reference="opening")
+        for account, balance in balances.items() if balance
+    ]
+    if postings:
+        postings.append(LedgerPosting(account="opening", amount=-sum(p.amount for p in postings), reference="opening"))
+        LedgerPosting.objects.bulk_create(postings)
+
+
+def remove_opening_balances(apps, schema_editor):
+    apps.get_model('finance', 'LedgerPosting').objects.filter(reference="opening").delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0006_ledger'),
+        ('clients', '0012_disbursementbatch_disbursementitem'),
+        ('staff', '0016_alter_transaction_status'),
+        ('admins', '0005_adminprofile_name'),
+    ]
+
+    operations = [
+        migrations.RunPython(post_opening_balances, remove_opening_balances),
+    ]
@@ -1,8 +1,24 @@
-from django.db import models
+import random
+from django.core.cache import cache
+from django.db import connection, models
+from django.db.models import Max, Sum
+from django.db.models.functions import Now
+from django.utils import timezone
 from decimal import Decimal
+from config import base as settings
 from staff.models import Staff
 
+SYSTEM_EARNINGS_TOTAL_KEY = "finance:system_earnings:total"
+
 class SystemEarnings(models.Model):
+    """
+    Platform-wide counters, striped over SYSTEM_EARNINGS_SHARDS rows so concurrent
+    payments increment different rows instead of queueing on one. A single shard
+    means nothing on its own: add() to a random one, load() the sum of all of them.
+    """
+    COUNTERS = ("balance", "total_volume", "total_transactions", "total_successful_transactions",
+                "total_failed_transactions", "total_earnings")
+
     balance = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal("0.00"))
     total_volume = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal("0.00"))
     total_transactions = models.PositiveIntegerField(default=0)
@@ -15,20 +31,58 @@ class SystemEarnings(models.Model):
         return f"Total Earnings: {self.total_earnings}"
     
     def save(self, *args, **kwargs):
-        self.pk = 1  # Always enforce single row
+        if self.pk is None:
+            # A total from load(); saving it as a row would count everything twice.
+            raise ValueError("SystemEarnings totals are read-only; use SystemEarnings.add().")
         super().save(*args, **kwargs)
 
     @classmethod
-    def load(cls):
-        return cls.objects.get_or_create(pk=1)[0]
+    def add(cls, **deltas):
+        """
+        counter = counter + delta for each keyword, on one randomly picked shard,
+        with a single INSERT ... ON CONFLICT DO UPDATE that also creates the shard.
+        """
+        shard = random.randint(1, settings.SYSTEM_EARNINGS_SHARDS)
+        table = connection.ops.quote_name(cls._meta.db_table)
+        quote = connection.ops.quote_name
+        columns = ("id", "last_updated") + cls.COUNTERS
+        increments = ", ".join(f"{quote(field)} = {table}.{quote(field)} + EXCLUDED.{quote(field)}" for field in deltas)
+        sql = (
+            f"INSERT INTO {table} ({', '.join(quote(column) for column in columns)}) "
+            f"VALUES ({', '.join(['%s'] * len(columns))}) ON CONFLICT ({quote('id')}) "
+            f"DO UPDATE SET {quote('last_updated')} = EXCLUDED.{quote('last_updated')}"
+            + (f", {increments}" if increments else "")
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [shard, timezone.now()] + [deltas.get(field, 0) for field in cls.COUNTERS])
+
+    @classmethod
+    def load(cls, cached=False):
+        """
+        The counters summed across shards, as an unsaved SystemEarnings. With
+        cached=True the sum may be up to SYSTEM_EARNINGS_CACHE_SECONDS old, which
+        is fine for dashboards.
+        """
+        totals = cache.get(SYSTEM_EARNINGS_TOTAL_KEY) if cached else None
+        if totals is None:
+            totals = cls.objects.aggregate(
+                **{f"sum_{field}": Sum(field) for field in cls.COUNTERS}, latest=Max('last_updated')
+            )
+            totals = {
+                **{field: totals[f"sum_{field}"] for field in cls.COUNTERS if totals[f"sum_{field}"] is not None},
+                "last_updated": totals["latest"],
+            }
+            cache.set(SYSTEM_EARNINGS_TOTAL_KEY, totals, settings.SYSTEM_EARNINGS_CACHE_SECONDS)
+        return cls(**totals)
 
     class Meta:
         verbose_name_plural = "System Earnings"
         ordering = ['-last_updated']
     @property
     def net_platform_earnings(self):
+        total_earnings = self.total_earnings if self.pk is None else SystemEarnings.load().total_earnings
         staff_commission = StaffCommissionAggregate.load().total_commission
-        return self.total_earnings - staff_commission
+        return total_earnings - staff_commission
 
 class PlatformSettings(models.Model):
     platform_fee_percent = models.DecimalField(max_digits=5, decimal_places=2, default=1.00)
@@ -96,3 +150,41 @@ class StaffCommissionAggregate(models.Model):
 
     class Meta:
         verbose_name_plural = "Staff Commission Totals"
+
+
+class LedgerPosting(models.Model):
+    """
+    One line of the money journal: amount into (positive) or out of (negative) an
+    account such as "client:12" or "platform" (see finance.ledger). The postings
+    of one reference always sum to zero. Rows are only ever inserted; created_at
+    is the inserting transaction's start time, set by the database.
+    """
+    id = models.BigAutoField(primary_key=True)
+    account = models.CharField(max_length=50)
+    amount = models.DecimalField(max_digits=20, decimal_places=2)
+    reference = models.CharField(max_length=100, db_index=True)
+    created_at = models.DateTimeField(db_default=Now())
+
+    class Meta:
+        indexes = [models.Index(fields=['account', 'created_at'])]
+
+    def __str__(self):
+        return f"{self.account} {self.amount:+} ({self.reference})"
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Ledger postings are immutable; post a correcting entry instead.")
+        super().save(*args, **kwargs)
+
+
+class LedgerSnapshot(models.Model):
+    """An account's balance over every posting created up to and including as_of."""
+    account = models.CharField(max_length=50)
+    as_of = models.DateTimeField()
+    balance = models.DecimalField(max_digits=20, decimal_places=2)
+
+    class Meta:
+        unique_together = ('account', 'as_of')
+
+    def __str__(self):
+        return f"{self.account}: {self.balance} as of {self.as_of}"
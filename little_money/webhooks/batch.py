@@ -0,0 +1,214 @@
+import logging
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+
+from clients.holds import settle_holds
+from clients.models import BalanceHold, Finances
+from config.balance_cache import balance_cache
+from config.finalized_orders import finalized_orders
+from config.platform_config import get_platform_config
+from finance.ledger import PLATFORM, Journal, admin_commission_shares, admin_profiles, client_account, staff_account
+from finance.models import SystemEarnings
+from .models import PaymentNotification
+from config.order_status import FINAL_STATUSES, STATUS_BY_PAY_STATUS, can_transition, transition_many
+from .views import (
+    _notification_fields,
+    _notification_kwargs,
+    _orders_with_context,
+    _split_fee,
+)
+
+logger = logging.getLogger(__name__)
+
+class NotificationClaimConflict(Exception):
+    """Another delivery settled or moved one of the batch's orders between the lookup and the write."""
+
+
+def apply_batch(payloads: dict) -> dict:
+    """
+    Apply many notifications (inbox id -> webhook body) in one transaction.
+    Returns inbox id -> "SUCCESS", "FAILED" or "INVALID", where SUCCESS and FAILED
+    mean the same as the response of a single _apply_notification call.
+
+    Each notification gets its own ledger entry, but the postings go in with one
+    insert and are summed in memory first, so each client's Finances, each staff
+    Balance, the admin profiles and SystemEarnings are written once per batch
+    however many notifications touch them. Expects at most one notification per
+    OutTradeNo, which is what InboxWorker.claim hands out.
+    """
+    results = {}
+    parsed = {}
+    for inbox_id in sorted(payloads):
+        notification, error_response = _notification_kwargs(payloads[inbox_id])
+        if error_response:
+            results[inbox_id] = "INVALID"
+        elif notification['data']['OutTradeNo'] in finalized_orders:
+            results[inbox_id] = "SUCCESS"
+        else:
+            parsed[inbox_id] = notification
+
+    out_trade_nos = [notification['data']['OutTradeNo'] for notification in parsed.values()]
+    orders = {order.out_trade_no: order for order in _orders_with_context().filter(out_trade_no__in=out_trade_nos)}
+
+    pending = {}
+    for inbox_id, notification in parsed.items():
+        out_trade_no = notification['data']['OutTradeNo']
+        order = orders.get(out_trade_no)
+        if order is None:
+            # The webhook can arrive before the order response is saved: retry later.
+            logger.error(f"UnifiedOrderResponse not found for OutTradeNo: {out_trade_no}.")
+            results[inbox_id] = "FAILED"
+        elif order.notification_settled:
+            if order.status in FINAL_STATUSES:
+                finalized_orders.put(out_trade_no, order.status)
+            results[inbox_id] = "SUCCESS"
+        else:
+            pending[inbox_id] = (notification, order)
+
+    if pending:
+        settled = _apply_pending(pending, results)
+        if settled:
+            # Money moved (or a hold was released) at the aggregator.
+            balance_cache.invalidate()
+    return results
+
+
+def _apply_pending(pending: dict, results: dict) -> bool:
+    """Write the notifications and their summed effects. Returns whether any order settled."""
+    platform_config = get_platform_config()
+    client_deltas = defaultdict(Decimal)
+    journal = Journal()
+    profiles = admin_profiles()
+    system = {'transactions': 0, 'successful': 0, 'earnings': Decimal("0"), 'volume': Decimal("0")}
+    order_ids_by_status = defaultdict(list)
+    notifications = {}
+    final = {}
+    settled = False
+
+    with transaction.atomic():
+        # Lock every client balance the batch moves, in id order, so batches running
+        # in parallel cannot deadlock. Disbursements are checked against the available
+        # balance as it stands after the notifications before them in the batch, the
+        # same as applying them one by one.
+        moved_clients = sorted({
+            order.client_id for notification, order in pending.values()
+            if order.request_amount is not None and int(notification['data']['PayStatus']) == 1
+        })
+        balances = {}
+        for client_id, balance, held in (
+            Finances.objects.select_for_update().filter(client_id__in=moved_clients)
+            .order_by('client_id', 'id').values_list('client_id', 'balance', 'held')
+        ):
+            balances.setdefault(client_id, balance - held)
+        disbursements = [
+            notification['data']['OutTradeNo'] for notification, order in pending.values()
+            if order.request_t_type == 2
+        ]
+        hold_amounts = dict(
+            BalanceHold.objects.filter(out_trade_no__in=disbursements, status='held').values_list('out_trade_no', 'amount')
+        ) if disbursements else {}
+        holds_paid = {}
+        released = defaultdict(Decimal)  # what closing the batch's holds gives back to each client's available balance
+
+        for inbox_id, (notification, order) in pending.items():
+            data = notification['data']
+            out_trade_no = data['OutTradeNo']
+            pay_status = int(data['PayStatus'])
+            status = STATUS_BY_PAY_STATUS.get(pay_status)
+
+            if order.request_amount is None or status is None or not can_transition(order.status, status):
+                # Recorded, but it moves neither the order nor any money (as in _apply_notification).
+                if order.request_amount is None:
+                    logger.error(f"UnifiedOrderRequest not found for OutTradeNo: {out_trade_no}. Cannot update order status or financial records.")
+                notifications[out_trade_no] = _notification_fields(**notification)
+                results[inbox_id] = "SUCCESS"
+                continue
+
+            if pay_status == 1:
+                client_id = order.client_id
+                base_amount = Decimal(order.request_amount)
+                if order.request_t_type == 1:  # Collection
+                    client_change = base_amount
+                elif order.request_t_type == 2:  # Disbursement
+                    # Capturing the order's hold gives back what it kept from the available balance,
+                    # and a held disbursement costs the amount reserved for it (as in _apply_notification).
+                    hold_amount = hold_amounts.get(out_trade_no, Decimal("0"))
+                    debit = hold_amounts.get(out_trade_no, base_amount)
+                    available = balances.get(client_id, Decimal("0")) + client_deltas[client_id] + released[client_id]
+                    if available + hold_amount < debit:
+                        logger.error(f"Insufficient funds for disbursement {out_trade_no} for client {client_id}.")
+                        results[inbox_id] = "FAILED"
+                        continue
+                    client_change = -debit
+                    released[client_id] += hold_amount
+                    holds_paid[out_trade_no] = True
+                else:
+                    logger.error(f"Unsupported transaction type (t_type) for {out_trade_no}: {order.request_t_type}")
+                    results[inbox_id] = "FAILED"
+                    continue
+
+                staff_commission, admin_commission_total, platform_profit = _split_fee(
+                    platform_config, base_amount, bool(order.staff_id)
+                )
+                client_deltas[client_id] += client_change
+                amounts = [
+                    (client_account(client_id), client_change),
+                    (PLATFORM, platform_profit),
+                    *admin_commission_shares(admin_commission_total, profiles),
+                ]
+                if order.staff_id:
+                    amounts.append((staff_account(order.staff_id), staff_commission))
+                journal.add(f"notification:{out_trade_no}", amounts)
+                system['transactions'] += 1
+                system['successful'] += 1
+                system['earnings'] += platform_profit
+                system['volume'] += base_amount
+                settled = True
+            elif pay_status == 2:
+                if order.request_t_type == 2:
+                    released[order.client_id] += hold_amounts.get(out_trade_no, Decimal("0"))
+                    holds_paid[out_trade_no] = False
+                system['transactions'] += 1
+                settled = True
+
+            notifications[out_trade_no] = _notification_fields(**notification)
+            order_ids_by_status[status].append(order.id)
+            if status in FINAL_STATUSES:
+                final[out_trade_no] = status
+            results[inbox_id] = "SUCCESS"
+
+        # Any difference from what was read means another delivery got in between:
+        # roll the batch back and let InboxWorker apply its rows one at a time.
+        claimed = PaymentNotification.claim_many(notifications)
+        if len(claimed) != len(notifications):
+            raise NotificationClaimConflict(f"Already settled: {sorted(set(notifications) - claimed)}")
+        for status, order_ids in order_ids_by_status.items():
+            moved = transition_many(status, order_ids)
+            if len(moved) != len(order_ids):
+                raise NotificationClaimConflict(f"Not moved to {status}: {sorted(set(order_ids) - moved)}")
+
+        # One write per distinct row, in a fixed order so concurrent batches cannot deadlock.
+        settle_holds(holds_paid)
+        postings = len(journal.postings)
+        journal.write()
+        if system['transactions']:
+            SystemEarnings.add(
+                total_transactions=system['transactions'],
+                total_earnings=system['earnings'],
+                total_volume=system['volume'],
+                total_successful_transactions=system['successful'],
+            )
+        transaction.on_commit(lambda: _remember_final(final))
+
+    logger.info(
+        f"Applied {len(pending)} notifications as one batch: {len(client_deltas)} clients, "
+        f"{postings} ledger postings, {sum(1 for inbox_id in pending if results[inbox_id] == 'FAILED')} failed."
+    )
+    return settled
+
+
+def _remember_final(final: dict):
+    for out_trade_no, status in final.items():
+        finalized_orders.put(out_trade_no, status)
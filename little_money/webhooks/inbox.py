@@ -0,0 +1,203 @@
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import close_old_connections, transaction
+from django.db.models import Count, Exists, F, Min, OuterRef, Q
+from django.utils import timezone
+
+import config.base as settings
+from config.finalized_orders import finalized_orders
+from .batch import apply_batch
+from .models import WebhookInbox, WebhookWorker
+from .views import _apply_notification, _notification_kwargs
+
+logger = logging.getLogger(__name__)
+
+UNFINISHED_STATUSES = ('pending', 'processing')
+
+# Workers that have not reported for this long are left out of backlog().
+WORKER_REPORT_MAX_AGE = timedelta(minutes=5)
+
+
+def backlog() -> dict:
+    """
+    Queue depth, rows being applied, dead rows, the age of the oldest unapplied
+    notification and the settled-order cache counters last reported by each worker.
+    """
+    stats = WebhookInbox.objects.filter(status__in=UNFINISHED_STATUSES + ('failed',)).aggregate(
+        depth=Count('id', filter=Q(status='pending')),
+        processing=Count('id', filter=Q(status='processing')),
+        failed=Count('id', filter=Q(status='failed')),
+        oldest=Min('received_at', filter=Q(status__in=UNFINISHED_STATUSES)),
+    )
+    oldest = stats.pop('oldest')
+    stats['oldest_age_seconds'] = round((timezone.now() - oldest).total_seconds(), 1) if oldest else 0
+    stats['workers'] = {
+        worker['name']: worker['finalized_order_cache']
+        for worker in WebhookWorker.objects.filter(reported_at__gte=timezone.now() - WORKER_REPORT_MAX_AGE)
+        .order_by('name')
+        .values('name', 'finalized_order_cache')
+    }
+    return stats
+
+
+class InboxWorker:
+    """
+    Applies stored webhooks on a bounded pool.
+
+    A row is only claimable when no earlier row for the same OutTradeNo is still
+    pending or processing, so notifications for one order are applied in the
+    order they arrived while different orders run in parallel. Claims use
+    SELECT ... FOR UPDATE SKIP LOCKED with a lease, so several process_webhooks
+    processes can share the inbox.
+
+    With coalesce, each claimed batch is applied by apply_batch in one
+    transaction instead of row by row, so hot balances are written once per
+    batch. A batch that fails as a whole falls back to row-by-row.
+    """
+
+    def __init__(self, workers: int = None, batch_size: int = None, coalesce: bool = None):
+        self.workers = workers or settings.WEBHOOK_WORKERS
+        self.batch_size = batch_size or settings.WEBHOOK_BATCH_SIZE
+        self.coalesce = settings.WEBHOOK_COALESCE if coalesce is None else coalesce
+        self.max_attempts = settings.WEBHOOK_MAX_ATTEMPTS
+        self.base_delay = settings.WEBHOOK_RETRY_BASE_DELAY
+        self.max_delay = settings.WEBHOOK_RETRY_MAX_DELAY
+        self.lease = timedelta(seconds=settings.WEBHOOK_LEASE)
+        self.name = f"{socket.gethostname()}:{os.getpid()}"[:255]
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def claim(self) -> list:
+        now = timezone.now()
+        earlier = WebhookInbox.objects.filter(
+            out_trade_no=OuterRef('out_trade_no'),
+            id__lt=OuterRef('id'),
+            status__in=UNFINISHED_STATUSES,
+        )
+        with transaction.atomic():
+            ids = list(
+                WebhookInbox.objects.filter(
+                    Q(status='pending', next_attempt_at__lte=now) | Q(status='processing', locked_until__lte=now)
+                )
+                .filter(~Exists(earlier))
+                .order_by('id')
+                .select_for_update(skip_locked=True)
+                .values_list('id', flat=True)[:self.batch_size]
+            )
+            WebhookInbox.objects.filter(id__in=ids).update(
+                status='processing',
+                attempts=F('attempts') + 1,
+                locked_until=now + self.lease,
+            )
+        return ids
+
+    def run_once(self) -> dict:
+        ids = self.claim()
+        summary = {"claimed": len(ids), "done": 0, "retry": 0, "failed": 0}
+        if not ids:
+            return summary
+        if self.coalesce:
+            outcomes = self._apply_coalesced(ids)
+            if outcomes is not None:
+                for outcome in outcomes:
+                    summary[outcome] += 1
+                return summary
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="webhook") as pool:
+            for outcome in pool.map(self._process_safely, ids):
+                summary[outcome] += 1
+        return summary
+
+    def run_forever(self, poll_interval: float = None, report_every: float = 30):
+        poll_interval = poll_interval or settings.WEBHOOK_POLL_INTERVAL
+        last_report = 0.0
+        while not self._stopping.is_set():
+            summary = self.run_once()
+            if time.monotonic() - last_report >= report_every:
+                self.report()
+                stats = backlog()
+                if stats['depth'] or stats['processing']:
+                    logger.info(f"Webhook backlog: {stats}")
+                last_report = time.monotonic()
+            if summary["claimed"] < self.batch_size:
+                self._stopping.wait(poll_interval)
+
+    def report(self):
+        """Store this process's settled-order cache counters for backlog()."""
+        WebhookWorker.objects.update_or_create(
+            name=self.name,
+            defaults={'finalized_order_cache': finalized_orders.stats(), 'reported_at': timezone.now()},
+        )
+
+    def _apply_coalesced(self, ids: list):
+        """Apply the claimed rows as one batch. Returns their outcomes, or None to fall back to row-by-row."""
+        rows = WebhookInbox.objects.in_bulk(ids)
+        try:
+            results = apply_batch({row.id: row.payload for row in rows.values()})
+        except Exception:
+            logger.exception(f"Coalesced webhook batch of {len(rows)} failed; applying its rows one at a time")
+            return None
+
+        outcomes = []
+        done = [inbox_id for inbox_id, result in results.items() if result == "SUCCESS"]
+        WebhookInbox.objects.filter(id__in=done).update(
+            status='done', result="SUCCESS", locked_until=None, processed_at=timezone.now()
+        )
+        outcomes += ["done"] * len(done)
+        for inbox_id, result in results.items():
+            if result == "INVALID":
+                self._finish(rows[inbox_id], 'failed', result)
+                outcomes.append("failed")
+            elif result != "SUCCESS":
+                outcomes.append(self._retry_or_fail(rows[inbox_id], result))
+        return outcomes
+
+    def _process_safely(self, inbox_id: int) -> str:
+        close_old_connections()
+        try:
+            return self._process(inbox_id)
+        except Exception:
+            logger.exception(f"Applying webhook inbox row {inbox_id} raised")
+            return self._retry_or_fail(WebhookInbox.objects.get(id=inbox_id), "ERROR")
+        finally:
+            close_old_connections()
+
+    def _process(self, inbox_id: int) -> str:
+        row = WebhookInbox.objects.get(id=inbox_id)
+        notification, error_response = _notification_kwargs(row.payload)
+        if error_response:
+            self._finish(row, 'failed', "INVALID")
+            return "failed"
+
+        result = _apply_notification(**notification).content.decode()
+        if result == "SUCCESS":
+            self._finish(row, 'done', result)
+            return "done"
+        return self._retry_or_fail(row, result)
+
+    def _retry_or_fail(self, row: WebhookInbox, result: str) -> str:
+        if row.attempts >= self.max_attempts:
+            logger.error(f"Giving up on webhook for {row.out_trade_no} (inbox {row.id}) after {row.attempts} attempts; it needs manual review.")
+            self._finish(row, 'failed', result)
+            return "failed"
+        delay = min(self.max_delay, self.base_delay * (2 ** (row.attempts - 1)))
+        WebhookInbox.objects.filter(id=row.id).update(
+            status='pending',
+            next_attempt_at=timezone.now() + timedelta(seconds=random.uniform(delay / 2, delay)),
+            locked_until=None,
+            result=result,
+        )
+        return "retry"
+
+    def _finish(self, row: WebhookInbox, status: str, result: str):
+        WebhookInbox.objects.filter(id=row.id).update(
+            status=status, result=result, locked_until=None, processed_at=timezone.now()
+        )
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.3 on 2026-10-18 20:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhooks', '0002_webhookinbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookWorker',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('finalized_order_cache', models.JSONField(default=dict)),
+                ('reported_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -1,4 +1,10 @@
-from django.db import models
+from django.db import connection, models
+from django.utils import timezone
+
+# PayStatus values that settle an order. A notification with any other PayStatus
+# (0, still processing) is superseded by the next one for the same order.
+SETTLED_PAY_STATUSES = (1, 2)
+
 
 class PaymentNotification(models.Model):
     PAY_STATUS_CHOICES = [
@@ -25,3 +31,102 @@ class PaymentNotification(models.Model):
 
     def __str__(self):
         return f"Order {self.out_trade_no} - Status {self.pay_status}"
+
+    @classmethod
+    def claim(cls, out_trade_no: str, **fields) -> bool:
+        """
+        Insert the notification for out_trade_no, or take over an existing one that
+        was never processed or only reported the order as still processing.
+        Returns False when a notification already settled the order.
+        """
+        return out_trade_no in cls.claim_many({out_trade_no: fields})
+
+    @classmethod
+    def claim_many(cls, notifications: dict) -> set:
+        """
+        claim() for many orders (OutTradeNo -> field values) in a single
+        INSERT ... ON CONFLICT statement. Returns the order numbers claimed; the
+        rest were already settled by a notification. Concurrent deliveries of one
+        order queue on the unique index, so exactly one of them claims it.
+        """
+        if not notifications:
+            return set()
+        opts = cls._meta
+        quote = connection.ops.quote_name
+        received_at = timezone.now()
+        rows = [{'out_trade_no': out_trade_no, 'received_at': received_at, **fields} for out_trade_no, fields in notifications.items()]
+        names = list(rows[0])
+        columns = [opts.get_field(name).column for name in names]
+        params = [opts.get_field(name).get_db_prep_save(row[name], connection) for row in rows for name in names]
+        table = quote(opts.db_table)
+        placeholders = ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(rows))
+        updates = ", ".join(
+            f"{quote(column)} = EXCLUDED.{quote(column)}"
+            for column in columns if column not in ('out_trade_no', 'received_at')
+        )
+        sql = (
+            f"INSERT INTO {table} ({', '.join(quote(c) for c in columns)}) VALUES {placeholders} "
+            f"ON CONFLICT ({quote('out_trade_no')}) DO UPDATE SET {updates} "
+            f"WHERE NOT ({table}.{quote('processed')} AND {table}.{quote('pay_status')} = ANY(%s)) "
+            f"RETURNING {quote('out_trade_no')}"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + [list(SETTLED_PAY_STATUSES)])
+            return {out_trade_no for (out_trade_no,) in cursor.fetchall()}
+
+    def signed_payload(self) -> dict:
+        """Rebuild the signed fields of the original webhook body, for re-verifying its Sign."""
+        return {
+            'PayStatus': self.pay_status,
+            'PayTime': timezone.localtime(self.pay_time).strftime("%Y-%m-%d %H:%M:%S") if self.pay_time else None,
+            'OutTradeNo': self.out_trade_no,
+            'TransactionId': self.transaction_id,
+            'Amount': self.amount,
+            'ActualPaymentAmount': self.actual_payment_amount,
+            'ActualCollectAmount': self.actual_collect_amount,
+            'PayerCharge': self.payer_charge,
+            'PayeeCharge': self.payee_charge,
+            'Sign': self.sign,
+        }
+
+
+class WebhookInbox(models.Model):
+    """
+    A webhook body accepted by payment_notification and not yet applied.
+    manage.py process_webhooks applies rows in id order per OutTradeNo.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    out_trade_no = models.CharField(max_length=255, db_index=True)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    result = models.CharField(max_length=20, null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+    def __str__(self):
+        return f"Inbox {self.id} - {self.out_trade_no} ({self.status})"
+
+
+class WebhookWorker(models.Model):
+    """
+    The last counters reported by a process_webhooks process, one row per host:pid,
+    so the admin backlog view can show what the workers (not the web process) see.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    finalized_order_cache = models.JSONField(default=dict)
+    reported_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Webhook worker {self.name}"
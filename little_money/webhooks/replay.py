@@ -0,0 +1,144 @@
+import logging
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import django
+from django.db import connections
+from django.db.models import Count, Exists, OuterRef, Q, Sum
+
+from config.models import UnifiedOrderResponse
+from config.order_status import FINAL_STATUSES
+from .batch import apply_batch
+from .models import PaymentNotification
+from .views import _apply_notification, _notification_kwargs
+
+logger = logging.getLogger(__name__)
+
+OUTCOMES = ("SUCCESS", "FAILED", "INVALID")
+
+
+def replay_selection(pay_statuses=None, since=None, until=None, only_errored=False):
+    """
+    Notifications that can be replayed. Processed rows are never selected, so a
+    replay cannot apply a notification's money twice.
+    """
+    notifications = PaymentNotification.objects.filter(processed=False)
+    if pay_statuses:
+        notifications = notifications.filter(pay_status__in=pay_statuses)
+    if since:
+        notifications = notifications.filter(received_at__date__gte=since)
+    if until:
+        notifications = notifications.filter(received_at__date__lte=until)
+    if only_errored:
+        notifications = notifications.exclude(error_message__isnull=True).exclude(error_message="")
+    return notifications
+
+
+def dry_run_report(notifications) -> dict:
+    """What a replay of notifications would touch, without applying anything."""
+    orders = UnifiedOrderResponse.objects.filter(out_trade_no=OuterRef('out_trade_no'))
+    summary = notifications.aggregate(
+        total=Count('id'),
+        amount=Sum('amount'),
+        missing_order=Count('id', filter=~Q(Exists(orders))),
+        already_final=Count('id', filter=Q(Exists(orders.filter(status__in=FINAL_STATUSES)))),
+    )
+    summary['by_pay_status'] = {
+        row['pay_status']: row['n']
+        for row in notifications.order_by().values('pay_status').annotate(n=Count('id'))
+    }
+    return summary
+
+
+def replay_chunk(ids: list) -> dict:
+    """
+    Re-apply the given notifications as one coalesced batch, or one by one if the
+    batch fails. Rows that still fail keep processed=False and get error_message set.
+    Returns counts per outcome.
+    """
+    payloads = {}
+    for notification in PaymentNotification.objects.filter(id__in=ids, processed=False):
+        payload = notification.signed_payload()
+        payload['PayMessage'] = notification.pay_message
+        payloads[notification.id] = payload
+
+    try:
+        results = apply_batch(payloads)
+    except Exception:
+        logger.exception(f"Coalesced replay of {len(payloads)} notifications failed; replaying them one at a time")
+        # Usually a concurrent replay or webhook got to some of them first.
+        still_unprocessed = set(PaymentNotification.objects.filter(id__in=payloads, processed=False).values_list('id', flat=True))
+        payloads = {notification_id: payload for notification_id, payload in payloads.items() if notification_id in still_unprocessed}
+        results = {}
+        for notification_id, payload in payloads.items():
+            notification, error_response = _notification_kwargs(payload)
+            if error_response:
+                results[notification_id] = "INVALID"
+            else:
+                results[notification_id] = _apply_notification(**notification).content.decode()
+
+    counts = dict.fromkeys(OUTCOMES, 0)
+    counts["skipped"] = len(ids) - len(payloads)  # processed elsewhere since they were selected
+    failed = {}
+    for notification_id, result in results.items():
+        counts[result] = counts.get(result, 0) + 1
+        if result != "SUCCESS":
+            failed.setdefault(result, []).append(notification_id)
+    for result, failed_ids in failed.items():
+        PaymentNotification.objects.filter(id__in=failed_ids, processed=False).update(error_message=f"Replay {result}")
+    return counts
+
+
+class NotificationReplayer:
+    """
+    Streams the ids of a selection with a server-side cursor and replays them in
+    chunks on a pool of worker processes, keeping at most two chunks per worker
+    in flight. `on_progress(done, counts, elapsed)` is called as chunks finish.
+    """
+
+    def __init__(self, workers: int, chunk_size: int, on_progress=None):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.on_progress = on_progress
+
+    def run(self, notifications) -> dict:
+        counts = dict.fromkeys(OUTCOMES + ("skipped",), 0)
+        started = time.monotonic()
+        done = 0
+        # Spawned, not forked, so workers open their own connections instead of
+        # sharing the one streaming the selection.
+        connections.close_all()
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=django.setup) as pool:
+            in_flight = set()
+            for chunk in self._chunks(notifications):
+                if len(in_flight) >= self.workers * 2:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    done += self._collect(finished, counts, started, done)
+                in_flight.add(pool.submit(replay_chunk, chunk))
+            while in_flight:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                done += self._collect(finished, counts, started, done)
+        counts["elapsed"] = time.monotonic() - started
+        return counts
+
+    def _chunks(self, notifications):
+        chunk = []
+        for notification_id in notifications.order_by('id').values_list('id', flat=True).iterator(chunk_size=self.chunk_size):
+            chunk.append(notification_id)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _collect(self, finished, counts, started, done) -> int:
+        replayed = 0
+        for future in finished:
+            for outcome, n in future.result().items():
+                counts[outcome] = counts.get(outcome, 0) + n
+                replayed += n
+        if self.on_progress:
+            self.on_progress(done + replayed, counts, time.monotonic() - started)
+        return replayed
@@ -0,0 +1,596 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q, Sum
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from admins.models import AdminProfile
+from clients.holds import attach_hold, expire_holds, place_hold, release_unused
+from clients.models import BalanceHold, Client, Finances
+from config.finalized_orders import finalized_orders
+from config.models import UnifiedOrderRequest, UnifiedOrderResponse
+from config.order_status import FAILED, PAID, PROCESSING, transition, transition_many
+from config import base as settings
+from config.platform_config import get_platform_config
+from config.utils import notification_verifier
+from core.models import CustomUser
+from finance.job import snapshot_monthly_earnings
+from finance.ledger import (
+    OPENING, PAYOUTS, PLATFORM, InsufficientFunds, Journal, balance_at, balance_drift, balances_at, client_account,
+    staff_account, take_snapshots,
+)
+from finance.models import SYSTEM_EARNINGS_TOTAL_KEY, LedgerPosting, LedgerSnapshot, MonthlyEarnings, PlatformSettings, SystemEarnings
+from staff.models import Balance, ClientAssignment, Staff
+
+from .batch import apply_batch
+from .inbox import WORKER_REPORT_MAX_AGE, InboxWorker, backlog
+from .models import PaymentNotification, WebhookInbox, WebhookWorker
+from .replay import replay_chunk
+from .views import _apply_notification, _notification_fields, _notification_kwargs
+
+
+class NotificationTestCase(TestCase):
+    """A client with a balance, an assigned staff member and platform settings."""
+
+    def setUp(self):
+        cache.clear()
+        finalized_orders.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            PlatformSettings.objects.create(platform_fee_percent=Decimal("2.00"))
+        get_platform_config()  # warm the per-process snapshot
+
+        user = CustomUser.objects.create(username="client", role="client")
+        self.client_obj = Client.objects.create(user=user, name="Client")
+        Finances.objects.create(client=self.client_obj, balance=Decimal("500.00"))
+        staff_user = CustomUser.objects.create(username="staff", role="staff")
+        self.staff = Staff.objects.create(user=staff_user, name="Staff")
+        ClientAssignment.objects.create(staff=self.staff, client=self.client_obj)
+        Balance.objects.create(staff=self.staff, balance=Decimal("0.00"))
+        SystemEarnings.load()
+
+    def add_admins(self, count):
+        start = AdminProfile.objects.count()
+        for i in range(start, start + count):
+            user = CustomUser.objects.create(username=f"admin{i}", role="admin")
+            AdminProfile.objects.create(user=user, name=user.username)
+
+    def create_order(self, out_trade_no, t_type, amount):
+        UnifiedOrderRequest.objects.create(
+            timestamp=0, channel=1, out_trade_no=out_trade_no, amount=amount, transaction_type=t_type,
+            trader_id="256700000000", trader_full_name="Payee", description="test",
+        )
+        UnifiedOrderResponse.objects.create(
+            status_code=200, succeeded=True, timestamp=0, out_trade_no=out_trade_no, transaction_id=out_trade_no,
+            amount=amount, actual_payment_amount=amount, actual_collect_amount=amount,
+            payer_charge=0, payee_charge=0, channel_charge=0, client=self.client_obj,
+        )
+
+    def payload(self, out_trade_no, pay_status=1):
+        return {
+            'PayStatus': pay_status, 'PayTime': "2026-01-01 12:00:00", 'OutTradeNo': out_trade_no,
+            'TransactionId': f"T{out_trade_no}", 'Amount': "1000", 'ActualPaymentAmount': "1000",
+            'ActualCollectAmount': "1000", 'PayerCharge': "0", 'PayeeCharge': "0", 'Sign': "",
+        }
+
+    def notify(self, out_trade_no, pay_status=1):
+        notification, error = _notification_kwargs(self.payload(out_trade_no, pay_status))
+        self.assertIsNone(error)
+        return _apply_notification(**notification).content
+
+
+class WebhookSignatureTests(NotificationTestCase):
+    """Only correctly signed notifications are stored, acknowledged and applied."""
+
+    def post(self, payload, url="payment_notification"):
+        return self.client.post(reverse(f"webhooks:{url}"), data=json.dumps(payload), content_type="application/json")
+
+    def signed(self, out_trade_no):
+        payload = self.payload(out_trade_no)
+        payload["Sign"] = notification_verifier(settings.PAYMENT_AGGREGATOR_API_KEY).sign(payload)
+        return payload
+
+    def test_unsigned_or_forged_payloads_are_refused_before_the_inbox(self):
+        forged = self.signed("ORDER1")
+        forged["Amount"] = "1000000"
+        for deferred in (True, False):
+            with mock.patch.object(settings, "WEBHOOK_DEFERRED", deferred):
+                self.assertEqual(self.post(self.payload("ORDER1")).content, b"FAILED")
+                self.assertEqual(self.post(forged).content, b"FAILED")
+                self.assertEqual(self.post(forged, url="apayment_notification").content, b"FAILED")
+        self.assertFalse(WebhookInbox.objects.exists())
+        self.assertFalse(PaymentNotification.objects.exists())
+
+    def test_signed_payload_is_stored(self):
+        with mock.patch.object(settings, "WEBHOOK_DEFERRED", True):
+            self.assertEqual(self.post(self.signed("ORDER1")).content, b"SUCCESS")
+        self.assertEqual(WebhookInbox.objects.get().out_trade_no, "ORDER1")
+
+    def test_async_view_applies_a_signed_notification(self):
+        self.create_order("ORDER1", t_type=1, amount=1000)
+        with mock.patch.object(settings, "WEBHOOK_DEFERRED", False):
+            self.assertEqual(self.post(self.signed("ORDER1"), url="apayment_notification").content, b"SUCCESS")
+        self.assertEqual(UnifiedOrderResponse.objects.get(out_trade_no="ORDER1").status, "paid")
+        self.assertEqual(Finances.objects.get(client=self.client_obj).balance, Decimal("1500.00"))
+        self.assertFalse(WebhookInbox.objects.exists())
+
+    def test_redelivery_of_a_settled_order_is_acknowledged_without_queries(self):
+        self.create_order("ORDER1", t_type=1, amount=1000)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.notify("ORDER1")
+        payload = self.signed("ORDER1")
+        with mock.patch.object(settings, "WEBHOOK_DEFERRED", True):
+            for url in ("payment_notification", "apayment_notification"):
+                with self.assertNumQueries(0):
+                    self.assertEqual(self.post(payload, url=url).content, b"SUCCESS")
+        self.assertFalse(WebhookInbox.objects.exists())
+
+    def test_order_settled_by_another_process_is_found_in_the_shared_cache(self):
+        self.create_order("ORDER1", t_type=1, amount=1000)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.notify("ORDER1")
+        finalized_orders.clear()  # as if a process_webhooks worker had settled it
+        with mock.patch.object(settings, "WEBHOOK_DEFERRED", True), self.assertNumQueries(0):
+            self.assertEqual(self.post(self.signed("ORDER1")).content, b"SUCCESS")
+        self.assertEqual(finalized_orders.stats()["shared_hits"], 1)
+        self.assertFalse(WebhookInbox.objects.exists())
+
+
+class PaymentNotificationQueryBudgetTests(NotificationTestCase):
+    """A settled notification costs the same fixed number of statements however many admins share the commission."""
+
+    # Order lookup, savepoint, notification insert, order status, config version,
+    # admin lookup, client/staff/admin/system updates, ledger insert, release.
+    QUERY_BUDGET = 12
+
+    def test_budget_does_not_grow_with_admins(self):
+        self.add_admins(2)
+        self.create_order("ORDER1", t_type=1, amount=1000)
+        with self.assertNumQueries(self.QUERY_BUDGET):
+            self.assertEqual(self.notify("ORDER1"), b"SUCCESS")
+
+        self.add_admins(10)
+        self.create_order("ORDER2", t_type=1, amount=1000)
+        with self.assertNumQueries(self.QUERY_BUDGET):
+            self.assertEqual(self.notify("ORDER2"), b"SUCCESS")
+
+    def test_collection_credits_every_party(self):
+        self.add_admins(2)
+        self.create_order("ORDER1", t_type=1, amount=1000)
+        self.assertEqual(self.notify("ORDER1"), b"SUCCESS")
+
+        # Fee 2% of 1000 = 20: staff 25% = 5, admins 10% of the remaining 15 = 1.50 split two ways.
+        self.assertEqual(Finances.objects.get(client=self.client_obj).balance, Decimal("1500.00"))
+        self.assertEqual(Balance.objects.get(staff=self.staff).balance, Decimal("5.00"))
+        self.assertEqual(
+            sorted(AdminProfile.objects.values_list("balance", flat=True)), [Decimal("0.75"), Decimal("0.75")]
+        )
+        system = SystemEarnings.load()
+        self.assertEqual(system.total_earnings, Decimal("13.50"))
+        self.assertEqual(system.total_successful_transactions, 1)
+        self.assertEqual(UnifiedOrderResponse.objects.get(out_trade_no="ORDER1").status, "paid")
+
+    def test_duplicate_is_acknowledged_with_one_query(self):
+        self.create_order("ORDER1", t_type=1, amount=1000)
+        self.notify("ORDER1")
+        with self.assertNumQueries(1):
+            self.assertEqual(self.notify("ORDER1"), b"SUCCESS")
+        self.assertEqual(Finances.objects.get(client=self.client_obj).balance, Decimal("1500.00"))
+
+    def test_settled_duplicate_skips_the_database(self):
+        self.create_order("ORDER1", t_type=1, amount=1000)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.notify("ORDER1")
+        hits = finalized_orders.stats()["hits"]
+        with self.assertNumQueries(0):
+            self.assertEqual(self.notify("ORDER1"), b"SUCCESS")
+        self.assertEqual(finalized_orders.stats()["hits"], hits + 1)
+
+    def test_claim_detects_processed_notification(self):
+        self.create_order("ORDER1", t_type=1, amount=1000)
+        self.notify("ORDER1")
+        notification, _ = _notification_kwargs({**self.payload("ORDER1"), 'Amount': "1"})
+        with self.assertNumQueries(1):
+            self.assertFalse(PaymentNotification.claim("ORDER1", **_notification_fields(**notification)))
+        self.assertEqual(PaymentNotification.objects.get(out_trade_no="ORDER1").amount, Decimal("1000.00"))
+
+    def test_insufficient_funds_rolls_everything_back(self):
+        self.add_admins(1)
+        self.create_order("ORDER1", t_type=2, amount=1000)
+        self.assertEqual(self.notify("ORDER1"), b"FAILED")
+
+        self.assertFalse(PaymentNotification.objects.filter(out_trade_no="ORDER1").exists())
+        self.assertEqual(Finances.objects.get(client=self.client_obj).balance, Decimal("500.00"))
+        self.assertEqual(Balance.objects.get(staff=self.staff).balance, Decimal("0.00"))
+        self.assertEqual(AdminProfile.objects.get().balance, Decimal("0.00"))
+        self.assertEqual(UnifiedOrderResponse.objects.get(out_trade_no="ORDER1").status, "pending")
+
+
+class OrderStateTests(NotificationTestCase):
+    """Notifications move an order only forward, and only the move to 'paid' moves money."""
+
+    def status(self, out_trade_no):
+        return UnifiedOrderResponse.objects.get(out_trade_no=out_trade_no).status
+
+    def test_processing_then_paid_credits_the_client(self):
+        self.create_order("ORDER1", t_type=1, amount=1000)
+        self.assertEqual(self.notify("ORDER1", pay_status=0), b"SUCCESS")
+        self.assertEqual(self.status("ORDER1"), "processing")
+
+        self.assertEqual(self.notify("ORDER1", pay_status=1), b"SUCCESS")
+        self.assertEqual(self.status("ORDER1"), "paid")
+        self.assertEqual(Finances.objects.get(client=self.client_obj).balance, Decimal("1500.00"))
+
+    def test_late_processing_does_not_overwrite_paid(self):
+        self.create_order("ORDER1", t_type=1, amount=1000)
+        self.notify("ORDER1", pay_status=1)
+        self.assertEqual(self.notify("ORDER1", pay_status=0), b"SUCCESS")
+        self.assertEqual(self.notify("ORDER1", pay_status=2), b"SUCCESS")
+
+        self.assertEqual(self.status("ORDER1"), "paid")
+        self.assertEqual(Finances.objects.get(client=self.client_obj).balance, Decimal("1500.00"))
+        self.assertEqual(SystemEarnings.load().total_transactions, 1)
+
+    def test_transition_is_a_single_conditional_update(self):
+        self.create_order("ORDER1", t_type=1, amount=1000)
+        order_id = UnifiedOrderResponse.objects.get(out_trade_no="ORDER1").id
+        with self.assertNumQueries(1):
+            self.assertTrue(transition(PAID, id=order_id))
+        with self.assertNumQueries(1):
+            self.assertFalse(transition(PROCESSING, id=order_id))
+        self.assertEqual(transition_many(FAILED, [order_id]), set())
+        self.assertEqual(self.status("ORDER1"), "paid")
+
+
+class CoalescedBatchTests(NotificationTestCase):
+    """apply_batch writes each touched balance once, with the same totals as one-by-one application."""
+
+    def batch(self, out_trade_nos, pay_status=1):
+        return apply_batch({i: self.payload(o, pay_status) for i, o in enumerate(out_trade_nos, start=1)})
+
+    def count_queries(self, out_trade_nos):
+        with CaptureQueriesContext(connection) as queries:
+            results = self.batch(out_trade_nos)
+        self.assertEqual(set(results.values()), {"SUCCESS"})
+        return len(queries)
+
+    def test_statements_do_not_grow_with_notifications(self):
+        self.add_admins(3)
+        for i in range(3):
+            self.create_order(f"SMALL{i}", t_type=1, amount=1000)
+        for i in range(30):
+            self.create_order(f"LARGE{i}", t_type=1, amount=1000)
+        self.assertEqual(
+            self.count_queries([f"SMALL{i}" for i in range(3)]),
+            self.count_queries([f"LARGE{i}" for i in range(30)]),
+        )
+
+    def test_matches_one_by_one_totals(self):
+        self.add_admins(2)
+        for i in range(4):
+            self.create_order(f"ORDER{i}", t_type=1, amount=1000)
+        self.batch([f"ORDER{i}" for i in range(4)])
+
+        self.assertEqual(Finances.objects.get(client=self.client_obj).balance, Decimal("4500.00"))
+        self.assertEqual(Balance.objects.get(staff=self.staff).balance, Decimal("20.00"))
+        self.assertEqual(
+            sorted(AdminProfile.objects.values_list("balance", flat=True)), [Decimal("3.00"), Decimal("3.00")]
+        )
+        system = SystemEarnings.load()
+        self.assertEqual(system.total_earnings, Decimal("54.00"))
+        self.assertEqual(system.total_successful_transactions, 4)
+        self.assertEqual(PaymentNotification.objects.filter(processed=True).count(), 4)
+        self.assertEqual(set(UnifiedOrderResponse.objects.values_list("status", flat=True)), {"paid"})
+
+    def test_processing_and_late_processing(self):
+        self.create_order("ORDER1", t_type=1, amount=1000)
+        self.create_order("ORDER2", t_type=1, amount=1000)
+        self.notify("ORDER2")
+        self.assertEqual(set(self.batch(["ORDER1", "ORDER2"], pay_status=0).values()), {"SUCCESS"})
+
+        statuses = dict(UnifiedOrderResponse.objects.values_list("out_trade_no", "status"))
+        self.assertEqual(statuses, {"ORDER1": "processing", "ORDER2": "paid"})
+        self.assertEqual(self.batch(["ORDER1"]), {1: "SUCCESS"})
+        self.assertEqual(Finances.objects.get(client=self.client_obj).balance, Decimal("2500.00"))
+
+    def test_disbursement_sees_earlier_credits_and_fails_alone(self):
+        self.create_order("IN1", t_type=1, amount=1000)    # 500 -> 1500
+        self.create_order("OUT1", t_type=2, amount=1000)   # 1500 -> 500
+        self.create_order("OUT2", t_type=2, amount=1000)   # not enough left
+        results = self.batch(["IN1", "OUT1", "OUT2"])
+
+        self.assertEqual(results, {1: "SUCCESS", 2: "SUCCESS", 3: "FAILED"})
+        self.assertEqual(Finances.objects.get(client=self.client_obj).balance, Decimal("500.00"))
+        self.assertFalse(PaymentNotification.objects.filter(out_trade_no="OUT2").exists())
+        self.assertEqual(UnifiedOrderResponse.objects.get(out_trade_no="OUT2").status, "pending")
+
+
+class InboxWorkerTests(NotificationTestCase):
+    """process_webhooks applies stored notifications and reports what it did to backlog()."""
+
+    def test_rows_for_one_order_wait_for_the_row_another_worker_holds(self):
+        self.create_order("ORDER1", t_type=1, amount=1000)
+        self.create_order("ORDER2", t_type=1, amount=1000)
+        for out_trade_no, pay_status in (("ORDER1", 0), ("ORDER1", 1), ("ORDER2", 1)):
+            WebhookInbox.objects.create(out_trade_no=out_trade_no, payload=self.payload(out_trade_no, pay_status))
+        first, second, other = WebhookInbox.objects.order_by("id").values_list("id", flat=True)
+        holder = InboxWorker(batch_size=1)
+        self.assertEqual(holder.claim(), [first])
+
+        worker = InboxWorker(batch_size=10)
+        self.assertEqual(worker.claim(), [other])
+        self.assertEqual(worker.claim(), [])  # the second ORDER1 row still waits behind the first
+
+        self.assertEqual(holder._process(first), "done")
+        self.assertEqual(UnifiedOrderResponse.objects.get(out_trade_no="ORDER1").status, "processing")
+        self.assertEqual(worker.claim(), [second])
+        self.assertEqual(worker._process(second), "done")
+        self.assertEqual(UnifiedOrderResponse.objects.get(out_trade_no="ORDER1").status, "paid")
+
+    def test_backlog_counts_rows_by_state(self):
+        for status in ("pending", "pending", "processing", "failed", "done"):
+            WebhookInbox.objects.create(out_trade_no="ORDER1", payload={}, status=status)
+        WebhookInbox.objects.filter(status="pending").update(received_at=timezone.now() - timedelta(minutes=2))
+        WebhookInbox.objects.filter(status="done").update(received_at=timezone.now() - timedelta(hours=1))
+
+        stats = backlog()
+        self.assertEqual((stats["depth"], stats["processing"], stats["failed"]), (2, 1, 1))
+        self.assertGreaterEqual(stats["oldest_age_seconds"], 120)
+        self.assertLess(stats["oldest_age_seconds"], 3600)
+        self.assertEqual(stats["workers"], {})
+
+    def test_empty_backlog(self):
+        self.assertEqual(backlog(), {"depth": 0, "processing": 0, "failed": 0, "oldest_age_seconds": 0, "workers": {}})
+
+    def test_backlog_shows_the_workers_settled_order_counters(self):
+        self.create_order("ORDER1", t_type=1, amount=1000)
+        for _ in range(2):
+            WebhookInbox.objects.create(out_trade_no="ORDER1", payload=self.payload("ORDER1"))
+        worker = InboxWorker(coalesce=True)
+        for _ in range(2):  # the redelivery waits for the first row, then hits the cache
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(worker.run_once()["done"], 1)
+        worker.report()
+        WebhookWorker.objects.create(name="gone:1", reported_at=timezone.now() - WORKER_REPORT_MAX_AGE - timedelta(seconds=1))
+
+        workers = backlog()["workers"]
+        self.assertEqual(list(workers), [worker.name])
+        self.assertEqual(workers[worker.name]["hits"], 1)
+        self.assertEqual(workers[worker.name]["entries"], 1)
+
+
+class ReplayTests(NotificationTestCase):
+    """replay_chunk re-applies unprocessed notifications once, however often it is run."""
+
+    def store_unprocessed(self, out_trade_no):
+        notification, _ = _notification_kwargs(self.payload(out_trade_no))
+        fields = {**_notification_fields(**notification), 'processed': False, 'error_message': "outage"}
+        return PaymentNotification.objects.create(out_trade_no=out_trade_no, **fields)
+
+    def test_replay_applies_once(self):
+        self.create_order("ORDER1", t_type=1, amount=1000)
+        self.create_order("ORDER2", t_type=1, amount=1000)
+        ids = [self.store_unprocessed("ORDER1").id, self.store_unprocessed("ORDER2").id]
+
+        self.assertEqual(replay_chunk(ids)["SUCCESS"], 2)
+        self.assertEqual(replay_chunk(ids)["skipped"], 2)
+
+        self.assertEqual(Finances.objects.get(client=self.client_obj).balance, Decimal("2500.00"))
+        self.assertEqual(SystemEarnings.load().total_successful_transactions, 2)
+        self.assertFalse(PaymentNotification.objects.filter(Q(processed=False) | Q(error_message__isnull=False)).exists())
+
+    def test_failed_replay_keeps_the_row_for_next_time(self):
+        self.create_order("ORDER1", t_type=2, amount=1000)
+        notification = self.store_unprocessed("ORDER1")
+
+        self.assertEqual(replay_chunk([notification.id])["FAILED"], 1)
+        notification.refresh_from_db()
+        self.assertFalse(notification.processed)
+        self.assertEqual(notification.error_message, "Replay FAILED")
+        self.assertEqual(Finances.objects.get(client=self.client_obj).balance, Decimal("500.00"))
+
+
+class ShardedSystemEarningsTests(TransactionTestCase):
+    def setUp(self):
+        cache.delete(SYSTEM_EARNINGS_TOTAL_KEY)
+
+    def test_concurrent_increments_are_not_lost(self):
+        def record(_):
+            try:
+                for _ in range(25):
+                    with transaction.atomic():
+                        SystemEarnings.add(total_transactions=1, total_earnings=Decimal("0.10"))
+            finally:
+                close_old_connections()
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(record, range(8)))
+        totals = SystemEarnings.load()
+        self.assertEqual(totals.total_transactions, 200)
+        self.assertEqual(totals.total_earnings, Decimal("20.00"))
+        self.assertGreater(SystemEarnings.objects.count(), 1)
+        with self.assertRaises(ValueError):
+            totals.save()
+
+    def test_cached_total_lags_until_it_expires(self):
+        SystemEarnings.add(total_transactions=1)
+        self.assertEqual(SystemEarnings.load(cached=True).total_transactions, 1)
+        SystemEarnings.add(total_transactions=1)
+        self.assertEqual(SystemEarnings.load(cached=True).total_transactions, 1)
+        self.assertEqual(SystemEarnings.load().total_transactions, 2)
+
+    def test_monthly_snapshot_resets_every_shard(self):
+        for _ in range(20):
+            SystemEarnings.add(total_transactions=1, total_volume=Decimal("5"))
+        snapshot_monthly_earnings()
+        self.assertEqual(MonthlyEarnings.objects.get().total_transactions, 20)
+        self.assertEqual(MonthlyEarnings.objects.get().total_volume, Decimal("100"))
+        self.assertEqual(SystemEarnings.load().total_transactions, 0)
+
+    def test_monthly_snapshot_keeps_shards_created_after_it_started(self):
+        with mock.patch("finance.models.random.randint", return_value=1):
+            SystemEarnings.add(total_transactions=3)
+        create = MonthlyEarnings.objects.create
+
+        def payment_lands_mid_snapshot(**fields):
+            with mock.patch("finance.models.random.randint", return_value=2):
+                SystemEarnings.add(total_transactions=1)  # a shard that did not exist when the lock was taken
+            return create(**fields)
+        with mock.patch.object(MonthlyEarnings.objects, "create", side_effect=payment_lands_mid_snapshot):
+            snapshot_monthly_earnings()
+        self.assertEqual(MonthlyEarnings.objects.get().total_transactions, 3)
+        self.assertEqual(SystemEarnings.load().total_transactions, 1)
+
+
+class LedgerTests(NotificationTestCase):
+    def setUp(self):
+        super().setUp()
+        # What the opening-balance migration posts for the client's starting balance.
+        LedgerPosting.objects.bulk_create([
+            LedgerPosting(account=client_account(self.client_obj.id), amount=Decimal("500.00"), reference="opening"),
+            LedgerPosting(account=OPENING, amount=Decimal("-500.00"), reference="opening"),
+        ])
+
+    def test_every_entry_balances_and_matches_the_balance_columns(self):
+        self.add_admins(7)
+        self.create_order("ORDER1", t_type=1, amount=1000)
+        self.create_order("ORDER2", t_type=2, amount=300)
+        self.assertEqual(self.notify("ORDER1"), b"SUCCESS")
+        self.assertEqual(self.notify("ORDER2"), b"SUCCESS")
+
+        unbalanced = LedgerPosting.objects.values("reference").annotate(total=Sum("amount")).exclude(total=0)
+        self.assertFalse(unbalanced.exists())
+        self.assertEqual(balance_drift(), {})
+        self.assertEqual(balance_at(client_account(self.client_obj.id)), Decimal("1200.00"))
+        # 1.50 of admin commission over 7 admins is 0.21 each; the 0.03 left over goes to the platform.
+        order1 = dict(LedgerPosting.objects.filter(reference="notification:ORDER1").values_list("account", "amount"))
+        self.assertEqual(order1[PLATFORM], Decimal("13.53"))
+        self.assertEqual(order1[staff_account(self.staff.id)], Decimal("5.00"))
+
+    def test_debit_below_zero_is_refused(self):
+        journal = Journal()
+        journal.add("payout:1", [(staff_account(self.staff.id), Decimal("-5"))], counter_account=PAYOUTS)
+        with self.assertRaises(InsufficientFunds):
+            journal.write()
+        self.assertFalse(LedgerPosting.objects.filter(reference="payout:1").exists())
+        self.assertEqual(Balance.objects.get(staff=self.staff).balance, Decimal("0.00"))
+
+
+class LedgerSnapshotTests(TransactionTestCase):
+    """Postings carry their transaction's start time, so these run outside a test transaction."""
+
+    def post(self, amount):
+        journal = Journal()
+        journal.add("test", [(PLATFORM, amount)])
+        journal.write()
+
+    def test_point_in_time_balance_from_snapshot_plus_delta(self):
+        self.post(10)
+        between = timezone.now()
+        self.post(5)
+        self.assertEqual(take_snapshots(lag=0), 2)
+        self.post(1)
+
+        self.assertEqual(LedgerSnapshot.objects.get(account=PLATFORM).balance, Decimal("15.00"))
+        with self.assertNumQueries(2):
+            self.assertEqual(balance_at(PLATFORM), Decimal("16.00"))
+        self.assertEqual(balance_at(PLATFORM, between), Decimal("10.00"))
+        self.assertEqual(balances_at()["aggregator"], Decimal("-16.00"))
+
+        self.assertEqual(take_snapshots(lag=0), 2)
+        self.assertEqual(LedgerSnapshot.objects.filter(account=PLATFORM).latest("as_of").balance, Decimal("16.00"))
+
+
+class BalanceHoldTests(NotificationTestCase):
+    """Disbursements reserve their amount up front; the order's webhook captures or releases it."""
+
+    def held(self):
+        finances = Finances.objects.get(client=self.client_obj)
+        return finances.balance, finances.held
+
+    def hold_order(self, out_trade_no, amount):
+        hold = place_hold(self.client_obj.id, amount)
+        # The order request carries the amount in the aggregator's minor units.
+        self.create_order(out_trade_no, t_type=2, amount=amount * 100)
+        self.assertTrue(attach_hold(hold.id, out_trade_no))
+        return hold
+
+    def test_hold_is_refused_beyond_the_available_balance(self):
+        self.assertIsNotNone(place_hold(self.client_obj.id, Decimal("300")))
+        self.assertIsNone(place_hold(self.client_obj.id, Decimal("300")))
+        self.assertEqual(self.held(), (Decimal("500.00"), Decimal("300.00")))
+
+    def test_paid_webhook_captures_and_failed_webhook_releases(self):
+        paid = self.hold_order("OUT1", 200)
+        failed = self.hold_order("OUT2", 300)
+        self.assertEqual(self.notify("OUT1"), b"SUCCESS")
+        self.assertEqual(self.notify("OUT2", pay_status=2), b"SUCCESS")
+
+        self.assertEqual(self.held(), (Decimal("300.00"), Decimal("0.00")))
+        self.assertEqual(BalanceHold.objects.get(id=paid.id).status, "captured")
+        self.assertEqual(BalanceHold.objects.get(id=failed.id).status, "released")
+
+    def test_held_disbursement_is_debited_the_held_amount(self):
+        self.hold_order("OUT1", 200)
+        self.hold_order("OUT2", 300)
+        self.assertEqual(self.notify("OUT1"), b"SUCCESS")
+        self.assertEqual(apply_batch({1: self.payload("OUT2")}), {1: "SUCCESS"})
+
+        self.assertEqual(self.held(), (Decimal("0.00"), Decimal("0.00")))
+        debits = LedgerPosting.objects.filter(account=client_account(self.client_obj.id)).order_by("id")
+        self.assertEqual([posting.amount for posting in debits], [Decimal("-200.00"), Decimal("-300.00")])
+
+    def test_hold_moves_one_finances_row(self):
+        Finances.objects.create(client=self.client_obj, balance=Decimal("500.00"))
+        hold = place_hold(self.client_obj.id, Decimal("100"))
+        self.assertEqual(sorted(Finances.objects.filter(client=self.client_obj).values_list("held", flat=True)), [Decimal("0.00"), Decimal("100.00")])
+        release_unused(hold.id)
+        self.assertEqual(Finances.objects.filter(client=self.client_obj).aggregate(total=Sum("held"))["total"], Decimal("0.00"))
+
+    def test_debit_cannot_spend_money_held_for_another_order(self):
+        self.hold_order("OUT1", 300)
+        self.create_order("OUT2", t_type=2, amount=300)
+        self.assertEqual(self.notify("OUT2"), b"FAILED")
+        self.assertEqual(self.held(), (Decimal("500.00"), Decimal("300.00")))
+
+    def test_batch_captures_holds(self):
+        hold = self.hold_order("OUT1", 500)
+        self.assertEqual(apply_batch({1: self.payload("OUT1")}), {1: "SUCCESS"})
+        self.assertEqual(self.held(), (Decimal("0.00"), Decimal("0.00")))
+        self.assertEqual(BalanceHold.objects.get(id=hold.id).status, "captured")
+
+    def test_unused_and_expired_holds_are_released(self):
+        unused = place_hold(self.client_obj.id, Decimal("100"))
+        submitted = self.hold_order("OUT1", 100)
+        stale = place_hold(self.client_obj.id, Decimal("100"), ttl=0)
+
+        self.assertTrue(release_unused(unused.id))
+        self.assertFalse(release_unused(submitted.id))
+        self.assertEqual(expire_holds(), 1)
+        self.assertEqual(self.held(), (Decimal("500.00"), Decimal("100.00")))
+        self.assertEqual(BalanceHold.objects.get(id=stale.id).status, "expired")
+
+
+class ConcurrentBalanceHoldTests(TransactionTestCase):
+    def test_concurrent_holds_cannot_overspend(self):
+        user = CustomUser.objects.create(username="client", role="client")
+        client = Client.objects.create(user=user, name="Client")
+        Finances.objects.create(client=client, balance=Decimal("500.00"))
+
+        def hold(_):
+            try:
+                return place_hold(client.id, Decimal("100"))
+            finally:
+                close_old_connections()
+
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            holds = list(pool.map(hold, range(20)))
+        self.assertEqual(sum(1 for h in holds if h is not None), 5)
+        self.assertEqual(Finances.objects.get(client=client).held, Decimal("500.00"))
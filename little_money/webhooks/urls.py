@@ -1,9 +1,10 @@
 from django.urls import path
 
-from .views import payment_notification
+from .views import apayment_notification, payment_notification
 
 app_name = 'webhooks'
 
 urlpatterns = [
     path('payment-notification/', payment_notification, name='payment_notification'),
+    path('payment-notification-async/', apayment_notification, name='apayment_notification'),
 ]
\ No newline at end of file
@@ -1,22 +1,25 @@
 import json
 import config.base as settings
+from asgiref.sync import sync_to_async
 from datetime import datetime
 from django.views.decorators.csrf import csrf_exempt
 from django.http import HttpResponse, HttpResponseBadRequest
 from django.utils.timezone import make_aware, now
 from django.views.decorators.http import require_POST
 from django.db import transaction # Import transaction for atomicity
+from django.db.models import Exists, OuterRef, Subquery
 from decimal import Decimal # Import Decimal for financial calculations
-from config.transaction_orchestrator import PaymentInitiator
-from core.models import CustomUser
 
-from .models import PaymentNotification
+from .models import SETTLED_PAY_STATUSES, PaymentNotification, WebhookInbox
 from config.models import UnifiedOrderRequest, UnifiedOrderResponse 
-from clients.models import Client, Finances
-from staff.models import Balance, ClientAssignment, StaffCommissionHistory
-from admins.models import AdminCommissionHistory, AdminProfile
+from staff.models import ClientAssignment
+from clients.holds import settle_holds
+from finance.ledger import PLATFORM, Journal, admin_commission_shares, admin_profiles, client_account, staff_account
 from finance.models import SystemEarnings
-from config.Platform import PlatformEarnings 
+from config.platform_config import get_platform_config
+from config.balance_cache import balance_cache
+from config.finalized_orders import finalized_orders
+from config.order_status import FINAL_STATUSES, STATUS_BY_PAY_STATUS, transition
 from config.utils import verify_signature
 
 import logging
@@ -24,25 +27,75 @@ logger = logging.getLogger(__name__)
 
 PRIVATE_KEY =settings.PAYMENT_AGGREGATOR_API_KEY
 
+
 @csrf_exempt  
 @require_POST
 def payment_notification(request):
     logger.info("--- Received payment notification webhook ---")
-    print(request.body)
 
     if request.method != 'POST':
         logger.warning(f"Webhook received non-POST request: {request.method}")
         return HttpResponseBadRequest("Only POST allowed")
 
+    notification, error_response = _parse_notification(request.body)
+    if error_response:
+        return error_response
+    if settings.WEBHOOK_DEFERRED:
+        if notification['data']['OutTradeNo'] in finalized_orders:
+            # A redelivery for an order already settled: acknowledged without storing it again.
+            return HttpResponse("SUCCESS")
+        # Stored and acknowledged at once; manage.py process_webhooks applies it.
+        WebhookInbox.objects.create(out_trade_no=notification['data']['OutTradeNo'], payload=notification['data'])
+        return HttpResponse("SUCCESS")
+    return _apply_notification(**notification)
+
+
+@csrf_exempt
+@require_POST
+async def apayment_notification(request):
+    """
+    ASGI entry point for the aggregator webhook.
+    Parsing runs on the event loop; the bookkeeping runs in Django's sync thread.
+    """
+    logger.info("--- Received payment notification webhook (async) ---")
+    notification, error_response = _parse_notification(request.body)
+    if error_response:
+        return error_response
+    if settings.WEBHOOK_DEFERRED:
+        # The shared lookup may reach the cache backend, so it runs off the event loop.
+        if await sync_to_async(finalized_orders.get, thread_sensitive=False)(notification['data']['OutTradeNo']):
+            return HttpResponse("SUCCESS")
+        await WebhookInbox.objects.acreate(out_trade_no=notification['data']['OutTradeNo'], payload=notification['data'])
+        return HttpResponse("SUCCESS")
+    return await sync_to_async(_apply_notification)(**notification)
+
+
+def _parse_notification(body: bytes):
+    """
+    Decode and validate a webhook body.
+    Returns (notification kwargs, None) on success, or (None, error response).
+    """
     try:
-        body_unicode = request.body.decode('utf-8')
+        body_unicode = body.decode('utf-8')
         data = json.loads(body_unicode)
-        is_valid = verify_signature(data, PRIVATE_KEY)
         logger.info(f"Webhook payload: {data}")
-    except json.JSONDecodeError:
+    except (UnicodeDecodeError, json.JSONDecodeError):
         logger.error("Invalid JSON payload received in webhook.")
-        return HttpResponseBadRequest("Invalid JSON")
+        return None, HttpResponseBadRequest("Invalid JSON")
+
+    # Checked before anything is stored: an unsigned or forged payload never reaches the inbox.
+    if not isinstance(data, dict) or not verify_signature(data, PRIVATE_KEY):
+        logger.error("Signature verification failed for webhook.")
+        return None, HttpResponse("FAILED")
+
+    return _notification_kwargs(data)
+
 
+def _notification_kwargs(data: dict):
+    """
+    Validate a notification-shaped dict (webhook body or /orderquery Data).
+    Returns (notification kwargs, None) on success, or (None, error response).
+    """
     # Required fields check (excluding PayMessage)
     required_fields = ['PayStatus', 'PayTime', 'OutTradeNo', 'TransactionId',
                     'Amount', 'ActualPaymentAmount', 'ActualCollectAmount',
@@ -51,20 +104,13 @@ def payment_notification(request):
     for field in required_fields:
         if field not in data:
             logger.error(f"Missing required field in webhook payload: {field}")
-            return HttpResponseBadRequest(f"Missing field: {field}")
-
-    """if not is_valid:
-        logger.info(f"Raw webhook data: {json.dumps(data, indent=2)}")
-        logger.error("Signature verification failed for webhook.")
-        return HttpResponse("FAILED")"""
+            return None, HttpResponseBadRequest(f"Missing field: {field}")
 
     # Optionally log PayMessage
     pay_message = data.get("PayMessage")
     if pay_message:
         logger.info(f"PayMessage: {pay_message}")
 
-    # Signature valid – proceed with processing
-    logger.info("Signature verification passed.")
     # Parse PayTime safely
     pay_time = None
     if 'PayTime' in data and data['PayTime']:
@@ -85,189 +131,206 @@ def payment_notification(request):
         # Ensure your model fields for these are DecimalField
     except Exception as e:
         logger.error(f"Error converting amounts to Decimal in webhook: {e}")
-        return HttpResponseBadRequest("Invalid amount format in payload")
+        return None, HttpResponseBadRequest("Invalid amount format in payload")
 
+    return {
+        'data': data,
+        'pay_time': pay_time,
+        'notification_amount': notification_amount,
+        'actual_payment_amount': actual_payment_amount,
+        'actual_collect_amount': actual_collect_amount,
+        'payer_charge': payer_charge,
+        'payee_charge': payee_charge,
+    }, None
+
+
+def settle_order(data: dict) -> bool:
+    """
+    Apply a final order status learned outside the webhook (the reconciler's /orderquery).
+    It goes through the webhook path, so the order is settled once whichever arrives first.
+    """
+    notification, error_response = _notification_kwargs(data)
+    if error_response:
+        return False
+    data.setdefault('Sign', '')  # /orderquery results are not signed per order
+    return _apply_notification(**notification).content == b"SUCCESS"
+
+
+def _orders_with_context():
+    """
+    Order responses with their client, plus everything else the webhook needs
+    (request fields, assigned staff, whether it was already settled by a notification)
+    annotated on the same row.
+    """
+    order_requests = UnifiedOrderRequest.objects.filter(out_trade_no=OuterRef('out_trade_no'))
+    return UnifiedOrderResponse.objects.annotate(
+        request_amount=Subquery(order_requests.values('amount')[:1]),
+        request_t_type=Subquery(order_requests.values('transaction_type')[:1]),
+        staff_id=Subquery(ClientAssignment.objects.filter(client=OuterRef('client')).values('staff_id')[:1]),
+        notification_settled=Exists(PaymentNotification.objects.filter(out_trade_no=OuterRef('out_trade_no'), processed=True, pay_status__in=SETTLED_PAY_STATUSES)),
+    )
+
+
+def _load_order(out_trade_no: str):
+    """The order response for out_trade_no with its webhook context, in a single query."""
+    return _orders_with_context().filter(out_trade_no=out_trade_no).first()
+
+
+def _notification_fields(data, pay_time, notification_amount, actual_payment_amount,
+                         actual_collect_amount, payer_charge, payee_charge) -> dict:
+    """PaymentNotification column values for a parsed notification."""
+    return dict(
+        pay_status=int(data['PayStatus']),
+        pay_time=pay_time,
+        transaction_id=data['TransactionId'],
+        amount=notification_amount,
+        actual_payment_amount=actual_payment_amount,
+        actual_collect_amount=actual_collect_amount,
+        payer_charge=payer_charge,
+        payee_charge=payee_charge,
+        pay_message=data.get('PayMessage', ''),
+        sign=data['Sign'],
+        processed=True, # Mark as processed NOW
+        processed_at=now(),
+        error_message=None,
+    )
+
+
+def _split_fee(platform_config, base_amount: Decimal, has_staff: bool):
+    """(staff commission, admin commission total, platform profit) for a paid order."""
+    fee = platform_config.platform_fee(base_amount)
+    staff_commission = (fee * platform_config.staff_commission_percent / Decimal("100.0")) if has_staff else Decimal("0.0")
+    admin_commission_total = (fee - staff_commission) * platform_config.admin_commission_percent / Decimal("100.0")
+    return staff_commission, admin_commission_total, fee - staff_commission - admin_commission_total
+
+
+def _apply_notification(data, pay_time, notification_amount, actual_payment_amount,
+                        actual_collect_amount, payer_charge, payee_charge):
+    """
+    Record the notification and apply its order status and financial effects.
+
+    Runs in one transaction with a fixed number of statements however many admins
+    share the commission: one lookup for the order and its context, the
+    notification write, the ledger postings in one insert, then one set-based
+    UPDATE per balance that moves.
+    Repeats for an order this process already settled are acknowledged from
+    finalized_orders without touching the database.
+    """
+    out_trade_no = data['OutTradeNo']
+    if out_trade_no in finalized_orders:
+        logger.info(f"Duplicate notification for settled OutTradeNo {out_trade_no}; acknowledged from cache.")
+        return HttpResponse("SUCCESS")
+
+    order_request = _load_order(out_trade_no)
+
+    # If the order was already settled by a notification, return SUCCESS
+    if order_request is not None and order_request.notification_settled:
+        logger.info(f"Duplicate processed notification received for OutTradeNo: {out_trade_no}")
+        if order_request.status in FINAL_STATUSES:
+            finalized_orders.put(out_trade_no, order_request.status)
+        return HttpResponse("SUCCESS")
+
+    notification_fields = _notification_fields(
+        data, pay_time, notification_amount, actual_payment_amount,
+        actual_collect_amount, payer_charge, payee_charge,
+    )
+
+    if order_request is None:
+        # The webhook can arrive before the order response is saved: respond FAILED so the aggregator retries.
+        logger.error(f"UnifiedOrderResponse not found for OutTradeNo: {out_trade_no}.")
+        return HttpResponse("FAILED")
 
-    # Check for duplicates using OutTradeNo (your internal order number)
-    existing_notification = PaymentNotification.objects.filter(out_trade_no=data['OutTradeNo']).first()
-    
-    # If the notification exists and is already processed, return SUCCESS
-    if existing_notification:
-        if existing_notification.processed:
-            logger.info(f"Duplicate processed notification received for OutTradeNo: {data['OutTradeNo']}")
-            return HttpResponse("SUCCESS")
-        else:
-            # This case indicates a duplicate that was previously NOT fully processed.
-            # You might want to update the existing notification and re-run processing.
-            # For simplicity here, we'll proceed to update it.
-            logger.warning(f"Duplicate but unprocessed notification for OutTradeNo: {data['OutTradeNo']}. Re-processing.")
-            notification = existing_notification
-            # Update fields if necessary
-            notification.pay_status = int(data['PayStatus'])
-            notification.pay_time = pay_time
-            notification.transaction_id = data['TransactionId']
-            notification.amount = notification_amount
-            notification.actual_payment_amount = actual_payment_amount
-            notification.actual_collect_amount = actual_collect_amount
-            notification.payer_charge = payer_charge
-            notification.payee_charge = payee_charge
-            notification.pay_message = data.get('PayMessage', '')
-            notification.sign = data['Sign']
-            notification.processed = True # Mark as processed NOW
-            notification.processed_at = now()
-            notification.save()
-    else:
-        # Create a new notification record if it's not a duplicate
-        notification = PaymentNotification.objects.create(
-            pay_status=int(data['PayStatus']),
-            pay_time=pay_time,
-            out_trade_no=data['OutTradeNo'],
-            transaction_id=data['TransactionId'],
-            amount=notification_amount,
-            actual_payment_amount=actual_payment_amount,
-            actual_collect_amount=actual_collect_amount,
-            payer_charge=payer_charge,
-            payee_charge=payee_charge,
-            pay_message=data.get('PayMessage', ''),
-            sign=data['Sign'],
-            processed=True, # Mark as processed NOW
-            processed_at=now()
-        )
-        logger.info(f"New PaymentNotification created for OutTradeNo: {notification.out_trade_no}")
-
-    # --- Update UnifiedOrderRequest Status and Get Context ---
     try:
-        # Assuming 'OutTradeNo' from the webhook maps to 'out_trade_no' in your UnifiedOrderRequest
-        order_request = UnifiedOrderResponse.objects.get(out_trade_no=data['OutTradeNo'])
-        transactions = UnifiedOrderRequest.objects.get(out_trade_no=data['OutTradeNo'])
-
-        update = PaymentInitiator(
-                channel=transactions.channel,
-                t_type=2,
-                client_id=order_request.client.id,
-                base_amount=transactions.amount,
-                trader_id=transactions.trader_id,
-                message=transactions.description,
-                name=transactions.trader_full_name
-            )
-        # Get client, staff, and transaction type from your internal order request
-        # You MUST ensure these fields are available on your UnifiedOrderRequest model
-        # or can be derived from it.
-        # Example: order_request.client, order_request.t_type, order_request.base_amount
-        client = order_request.client
-        t_type = transactions.transaction_type # Assuming this field exists on UnifiedOrderRequest
-        base_amount_decimal = update.base_amount
-        
-        assignment = ClientAssignment.objects.filter(client=client).first()
-        staff = assignment.staff if assignment else None
-        
-        # Now determine the payment status from the webhook
-        pay_status = int(data['PayStatus'])
-        
-        if pay_status == 1:  # payment successful
-            order_request.status = 'paid'  # Update your order status
-            order_request.timestamp = pay_time or now()
-            order_request.transaction_id = data['TransactionId']
-            logger.info(f"UnifiedOrderRequest {order_request.out_trade_no} status updated to 'paid'.")
-
-            # --- Financial Updates (Business Logic) ---
-            
-
-            commission_record = StaffCommissionHistory.objects.order_by('-created_at').first()
-            staff_commission_percent = Decimal(str(commission_record.percentage)) if commission_record else Decimal("25.0")
-
-            admin_commission_record = AdminCommissionHistory.objects.order_by('-created_at').first()
-            admin_commission_percent = Decimal(str(admin_commission_record.percentage)) if admin_commission_record else Decimal("10.0")
-
-            # Recalculate fee and profits based on the confirmed amount from the webhook
-            # It's crucial here to ensure PlatformEarnings.calculate_platform_fee
-            # can work with the base_amount from your internal order_request if needed,
-            # or derive the fee directly from the webhook data if it includes a precise fee.
-            # Assuming 'base_amount' is the original amount *before* aggregator fees.
-            charge = PlatformEarnings()
-            # Use the original base_amount to calculate the fee, or use a fee value from the webhook if provided
-            fee = Decimal(str(charge.calculate_platform_fee(base_amount_decimal))) 
-
-            staff_commission = (fee * staff_commission_percent / Decimal("100.0")) if staff else Decimal("0.0")
-            admin_commission_total = (fee - staff_commission) * admin_commission_percent / Decimal("100.0")
-            platform_profit = fee - staff_commission - admin_commission_total
-
-            logger.info(f"Calculated for {order_request.out_trade_no}: Staff Comm: {staff_commission}, Admin Comm: {admin_commission_total}, Platform Profit: {platform_profit}")
-
-            if staff:
-                staff_balance, created = Balance.objects.get_or_create(staff=staff)
-                staff_balance.balance += staff_commission
-                staff_balance.save()
-                logger.info(f"Staff {staff.user.username} balance updated by {staff_commission}.")
-
-            client_finance, _ = Finances.objects.get_or_create(client=client)
-            
-            if t_type == 1: # Collection
-                client_finance.balance += base_amount_decimal
-            elif t_type == 2: # Disbursement
-                if client_finance.balance < base_amount_decimal: # Important check for disbursements
-                    raise ValueError("Insufficient funds for disbursement for client.")
-                client_finance.balance -= base_amount_decimal
-                logger.info(f"Client balance (Disbursement) decreased by {base_amount_decimal}.")
-            else:
-                raise ValueError(f"Unsupported transaction type (t_type) for financial update: {t_type}")
-            
-            client_finance.save()
-
-            admins = CustomUser.objects.filter(role='admin')
-            num_admins = admins.count()
-
-            if num_admins > 0:
-                share = admin_commission_total / num_admins
-                with transaction.atomic():
-                    for admin in admins:
-                        try:
-                            admin_profile = AdminProfile.objects.get(user=admin)
-                            admin_profile.balance += share
-                            admin_profile.save()
-                            logger.info(f"Admin {admin.username} balance updated by {share}.")
-                        except AdminProfile.DoesNotExist:
-                            logger.warning(f"AdminProfile not found for user {admin.username}.")
-            else:
-                logger.info("No active admins found for commission distribution.")
-            system = SystemEarnings.load()
-            system.total_transactions += 1 # Incremented for every processed notification
-            system.total_earnings += platform_profit
-            system.total_volume += base_amount_decimal
-            system.total_successful_transactions += 1
-            system.save()
-            logger.info(f"System earnings updated for successful transaction {order_request.out_trade_no}.")
-
-        elif pay_status == 2:  # payment failed
-            order_request.status= 'failed'
-            # Optionally, here you might reverse any pre-authorized funds or notify
-            # if needed. No commission/balance updates for failed payments.
-            system = SystemEarnings.load()
-            system.total_transactions += 1 # Still increment total transactions for failed ones
-            system.save()
-            logger.info(f"UnifiedOrderRequest {order_request.out_trade_no} status updated to 'payment_failed'.")
-        
-        elif pay_status == 0:  # processing (or other intermediate status)
-            order_request.status = 'processing'
-            logger.info(f"UnifiedOrderRequest {order_request.out_trade_no} status updated to 'processing'.")
-            # No financial updates for processing status typically
-        
-        order_request.save()
-        logger.info(f"UnifiedOrderRequest {order_request.out_trade_no} saved with status {order_request.status}.")
-
-    except UnifiedOrderRequest.DoesNotExist:
-        logger.error(f"UnifiedOrderRequest not found for OutTradeNo: {data['OutTradeNo']}. Cannot update order status or financial records.")
-        # Depending on business logic, you might return "FAILED" to trigger a retry
-        # from the aggregator if this is a critical error for you.
-        return HttpResponse("SUCCESS") # Acknowledge receipt even if internal order not found to avoid retries.
+        with transaction.atomic():
+            # Insert-or-detect in one statement: a concurrent delivery of the same order waits here and then sees it processed.
+            if not PaymentNotification.claim(out_trade_no, **notification_fields):
+                logger.info(f"Duplicate processed notification received for OutTradeNo: {out_trade_no}")
+                return HttpResponse("SUCCESS")
+
+            if order_request.request_amount is None:
+                # Acknowledge receipt even if internal order not found to avoid retries.
+                logger.error(f"UnifiedOrderRequest not found for OutTradeNo: {out_trade_no}. Cannot update order status or financial records.")
+                return HttpResponse("SUCCESS")
+
+            client_id = order_request.client_id
+            t_type = order_request.request_t_type
+            base_amount_decimal = Decimal(order_request.request_amount)
+            staff_id = order_request.staff_id
+
+            # Now determine the payment status from the webhook
+            pay_status = int(data['PayStatus'])
+            order_status = STATUS_BY_PAY_STATUS.get(pay_status)
+            if order_status is None:
+                logger.warning(f"Unhandled PayStatus {pay_status} for OutTradeNo {out_trade_no}; order status unchanged.")
+                return HttpResponse("SUCCESS")
+
+            # Compare-and-set: only an allowed transition goes on to move money, so a late
+            # 'processing' cannot overwrite 'paid' and a repeated outcome is a no-op.
+            if not transition(order_status, id=order_request.id):
+                logger.info(f"UnifiedOrderRequest {out_trade_no} is '{order_request.status}'; PayStatus {pay_status} changes nothing.")
+                return HttpResponse("SUCCESS")
+            logger.info(f"UnifiedOrderRequest {out_trade_no} status updated to '{order_status}'.")
+
+            captured = {}
+            if t_type == 2 and order_status in FINAL_STATUSES:
+                # Close the disbursement's hold first, so the debit below can spend what it kept.
+                captured = settle_holds({out_trade_no: pay_status == 1})
+
+            if pay_status == 1:  # payment successful
+                # --- Financial Updates (Business Logic) ---
+                staff_commission, admin_commission_total, platform_profit = _split_fee(
+                    get_platform_config(), base_amount_decimal, bool(staff_id)
+                )
+
+                logger.info(f"Calculated for {out_trade_no}: Staff Comm: {staff_commission}, Admin Comm: {admin_commission_total}, Platform Profit: {platform_profit}")
+
+                if t_type == 1: # Collection
+                    client_change = base_amount_decimal
+                elif t_type == 2: # Disbursement
+                    # A held disbursement costs what was reserved for it: the total in the client's
+                    # currency units, where the request amount is in the aggregator's minor units.
+                    client_change = -captured.get(out_trade_no, base_amount_decimal) # Refused below if the balance does not cover it
+                else:
+                    raise ValueError(f"Unsupported transaction type (t_type) for financial update: {t_type}")
+
+                amounts = [
+                    (client_account(client_id), client_change),
+                    (PLATFORM, platform_profit),
+                    *admin_commission_shares(admin_commission_total, admin_profiles()),
+                ]
+                if staff_id:
+                    amounts.append((staff_account(staff_id), staff_commission))
+                journal = Journal()
+                journal.add(f"notification:{out_trade_no}", amounts)
+                journal.write()
+
+                SystemEarnings.add(
+                    total_transactions=1, # Incremented for every processed notification
+                    total_earnings=platform_profit,
+                    total_volume=base_amount_decimal,
+                    total_successful_transactions=1,
+                )
+                logger.info(f"System earnings updated for successful transaction {out_trade_no}.")
+
+            elif pay_status == 2:  # payment failed
+                # No commission/balance updates for failed payments.
+                SystemEarnings.add(total_transactions=1) # Still increment total transactions for failed ones
+
+            if order_status in FINAL_STATUSES:
+                transaction.on_commit(lambda: finalized_orders.put(out_trade_no, order_status))
+
+        if pay_status in (1, 2):
+            # Money moved (or a hold was released) at the aggregator.
+            balance_cache.invalidate()
+
     except ValueError as ve:
-        logger.error(f"ValueError during financial update for OutTradeNo {data['OutTradeNo']}: {ve}", exc_info=True)
-        # Rollback automatically due to atomic, respond FAILED for aggregator retry
+        logger.error(f"ValueError during financial update for OutTradeNo {out_trade_no}: {ve}", exc_info=True)
+        # Rolled back with the transaction; respond FAILED for aggregator retry
         return HttpResponse("FAILED")
     except Exception as e:
-        logger.critical(f"Unhandled error during financial update for OutTradeNo {data['OutTradeNo']}: {e}", exc_info=True)
-        # Rollback automatically due to atomic, respond FAILED for aggregator retry
+        logger.critical(f"Unhandled error during financial update for OutTradeNo {out_trade_no}: {e}", exc_info=True)
+        # Rolled back with the transaction; respond FAILED for aggregator retry
         return HttpResponse("FAILED")
 
-    logger.info(f"Webhook processing complete for OutTradeNo: {data['OutTradeNo']}. Responding SUCCESS.")
-    return HttpResponse("SUCCESS") # Crucial: Always return SUCCESS if you processed it to avoid retries
\ No newline at end of file
+    logger.info(f"Webhook processing complete for OutTradeNo: {out_trade_no}. Responding SUCCESS.")
+    return HttpResponse("SUCCESS") # Crucial: Always return SUCCESS if you processed it to avoid retries